@@ -0,0 +1,344 @@
+"""
+叫號歷史統計（SQLite）
+
+    tickets  每個號碼一列 (epoch, number, issued, called)；號碼從 1 重新開始時 epoch +1
+    hourly   每小時彙總：發號數、叫號數、等候時間總和/最大值/分桶計數、叫號間隔總和
+    meta     目前的 epoch
+
+record_issued / record_called 只把事件放進記憶體，監控輪詢裡呼叫不碰磁碟；背景執行緒
+每 flush_interval 秒把累積的事件用一個交易寫入，同時更新 hourly。報表只讀 hourly，
+範圍再長也只是每小時一列；tickets 留最近 raw_days 天供查單張號碼。
+同一號碼重複發號/叫號（重開機、重播上游狀態）只算第一次。
+
+WaitEstimator 另外用最近幾次叫號的時間估目前每叫一號要幾秒，給票面的預估等候用；
+不碰資料庫，重開機時用 recent_calls() 接回。
+"""
+import bisect, collections, json, math, os, sqlite3, threading, time
+
+# 等候時間分桶上限（秒），最後再多一個「超過」桶；p50/p95 在桶內線性內插
+WAIT_BUCKETS = (15, 30, 45, 60, 90, 120, 180, 240, 300, 420, 600, 900,
+                1200, 1800, 2700, 3600, 5400, 7200)
+SERVICE_GAP_MAX = 1800    # 兩次叫號間隔超過這個秒數當成休息，不算進服務時間
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    epoch  INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    issued REAL,
+    called REAL,
+    source TEXT,
+    PRIMARY KEY (epoch, number)
+);
+CREATE INDEX IF NOT EXISTS tickets_seen ON tickets (coalesce(called, issued));
+CREATE TABLE IF NOT EXISTS hourly (
+    hour      INTEGER PRIMARY KEY,
+    issued    INTEGER NOT NULL DEFAULT 0,
+    called    INTEGER NOT NULL DEFAULT 0,
+    wait_sum  REAL    NOT NULL DEFAULT 0,
+    wait_n    INTEGER NOT NULL DEFAULT 0,
+    wait_max  REAL    NOT NULL DEFAULT 0,
+    wait_hist TEXT    NOT NULL DEFAULT '[]',
+    gap_sum   REAL    NOT NULL DEFAULT 0,
+    gap_n     INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _hour(ts: float) -> int:
+    return int(ts // 3600 * 3600)
+
+
+def quantile(hist, q: float, vmax: float = None):
+    """分桶計數 → 第 q 分位數（桶內線性內插）；落在「超過」桶時回傳 vmax"""
+    total = sum(hist)
+    if not total:
+        return None
+    target = q * total
+    seen = 0
+    for i, count in enumerate(hist):
+        if count and seen + count >= target:
+            if i >= len(WAIT_BUCKETS):
+                return vmax
+            lower = WAIT_BUCKETS[i - 1] if i else 0
+            upper = WAIT_BUCKETS[i]
+            if vmax is not None:
+                upper = min(upper, max(vmax, lower))
+            return lower + (upper - lower) * (target - seen) / count
+        seen += count
+    return vmax
+
+
+class _Hour:
+    """一個小時在這批事件裡的增量"""
+
+    def __init__(self):
+        self.issued = self.called = self.wait_n = self.gap_n = 0
+        self.wait_sum = self.wait_max = self.gap_sum = 0.0
+        self.hist = [0] * (len(WAIT_BUCKETS) + 1)
+
+
+class AnalyticsStore:
+    def __init__(self, path: str, flush_interval: float = 10.0, raw_days: int = 90,
+                 on_flush=None, log=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.raw_days = raw_days
+        self.on_flush = on_flush          # 回呼 (筆數, 秒數)，給指標用
+        self.log = log
+        self.cond = threading.Condition()
+        self.pending = []
+        self.db_lock = threading.Lock()
+        self.conn = None
+        self.epoch = 0
+        self.last_called = None
+        self.last_prune = 0.0
+        self.thread = None
+
+    # ---- 事件（只進記憶體） ----
+    def _push(self, event: tuple):
+        with self.cond:
+            self.pending.append(event)
+            self.cond.notify()
+        if self.thread is None:
+            self.start()
+
+    def record_issued(self, n: int, ts: float = None, source: str = "upstream"):
+        self._push(("issued", int(n), ts or time.time(), source))
+
+    def record_called(self, n: int, ts: float = None, source: str = "upstream"):
+        self._push(("called", int(n), ts or time.time(), source))
+
+    def reset(self, ts: float = None):
+        """號碼重新從 1 開始：之後的事件算新的一輪"""
+        self._push(("reset", None, ts or time.time(), None))
+
+    # ---- 寫入 ----
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name="analytics", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending, None)
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # 任何錯誤（含建資料夾失敗、on_flush 出錯）都不能讓背景執行緒結束
+                if self.log:
+                    self.log.exception("[統計寫入失敗]")
+                time.sleep(5)
+
+    def _db(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            row = conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()
+            self.epoch = int(row[0]) if row else 0
+            self.conn = conn
+        return self.conn
+
+    def flush(self) -> int:
+        """把累積的事件用一個交易寫入；回傳筆數"""
+        t0 = time.perf_counter()
+        with self.db_lock:            # 取批次也在鎖內，兩邊同時 flush 時事件才不會亂序
+            with self.cond:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return 0
+            try:
+                conn = self._db()
+                epoch, last_called = self.epoch, self.last_called
+                with conn:
+                    hours = {}
+                    for kind, n, ts, source in batch:
+                        if kind == "reset":
+                            epoch += 1
+                            last_called = None
+                            conn.execute("INSERT OR REPLACE INTO meta VALUES ('epoch', ?)", (str(epoch),))
+                        elif kind == "issued":
+                            cur = conn.execute("INSERT OR IGNORE INTO tickets (epoch, number, issued, source) "
+                                               "VALUES (?, ?, ?, ?)", (epoch, n, ts, source))
+                            if cur.rowcount:
+                                hours.setdefault(_hour(ts), _Hour()).issued += 1
+                        else:
+                            row = conn.execute("SELECT issued, called FROM tickets WHERE epoch = ? AND number = ?",
+                                               (epoch, n)).fetchone()
+                            if row and row[1] is not None:
+                                continue          # 已經叫過（重叫或重播）
+                            if row:
+                                conn.execute("UPDATE tickets SET called = ? WHERE epoch = ? AND number = ?",
+                                             (ts, epoch, n))
+                            else:             # 沒看過發號（例如監控啟動前就在等候）
+                                conn.execute("INSERT INTO tickets (epoch, number, called, source) "
+                                             "VALUES (?, ?, ?, ?)", (epoch, n, ts, source))
+                            h = hours.setdefault(_hour(ts), _Hour())
+                            h.called += 1
+                            if row and row[0] is not None:
+                                wait = max(0.0, ts - row[0])
+                                h.wait_sum += wait
+                                h.wait_n += 1
+                                h.wait_max = max(h.wait_max, wait)
+                                h.hist[bisect.bisect_left(WAIT_BUCKETS, wait)] += 1
+                            if last_called is not None and 0 < ts - last_called <= SERVICE_GAP_MAX:
+                                h.gap_sum += ts - last_called
+                                h.gap_n += 1
+                            last_called = ts
+                    for hour, d in hours.items():
+                        self._merge_hour(conn, hour, d)
+                    if time.time() - self.last_prune > 3600:
+                        conn.execute("DELETE FROM tickets WHERE coalesce(called, issued) < ?",
+                                     (time.time() - self.raw_days * 86400,))
+                        self.last_prune = time.time()
+            except (sqlite3.Error, OSError):
+                with self.cond:
+                    self.pending = batch + self.pending   # 下次再試
+                raise
+            self.epoch, self.last_called = epoch, last_called
+        if self.on_flush:
+            self.on_flush(len(batch), time.perf_counter() - t0)
+        return len(batch)
+
+    @staticmethod
+    def _merge_hour(conn, hour: int, d: _Hour):
+        row = conn.execute("SELECT issued, called, wait_sum, wait_n, wait_max, wait_hist, gap_sum, gap_n "
+                           "FROM hourly WHERE hour = ?", (hour,)).fetchone()
+        if row:
+            hist = json.loads(row[5]) or [0] * len(d.hist)
+            d.issued += row[0]
+            d.called += row[1]
+            d.wait_sum += row[2]
+            d.wait_n += row[3]
+            d.wait_max = max(d.wait_max, row[4])
+            d.hist = [a + b for a, b in zip(d.hist, hist)]
+            d.gap_sum += row[6]
+            d.gap_n += row[7]
+        conn.execute("INSERT OR REPLACE INTO hourly VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (hour, d.issued, d.called, d.wait_sum, d.wait_n, d.wait_max,
+                      json.dumps(d.hist), d.gap_sum, d.gap_n))
+
+    # ---- 報表 ----
+    def report(self, since: float, until: float) -> dict:
+        """[since, until) 之間的等候時間、每小時張數與尖峰時段（小時為單位）"""
+        self.flush()
+        with self.db_lock:
+            rows = self._db().execute(
+                "SELECT hour, issued, called, wait_sum, wait_n, wait_max, wait_hist, gap_sum, gap_n "
+                "FROM hourly WHERE hour >= ? AND hour < ? ORDER BY hour",
+                (_hour(since), until)).fetchall()
+        hist = [0] * (len(WAIT_BUCKETS) + 1)
+        issued = called = wait_n = gap_n = 0
+        wait_sum = wait_max = gap_sum = 0.0
+        hourly, by_hour_of_day, days = [], [0] * 24, set()
+        for hour, h_issued, h_called, h_wsum, h_wn, h_wmax, h_hist, h_gsum, h_gn in rows:
+            h_hist = json.loads(h_hist) or [0] * len(hist)
+            issued += h_issued
+            called += h_called
+            wait_sum += h_wsum
+            wait_n += h_wn
+            wait_max = max(wait_max, h_wmax)
+            gap_sum += h_gsum
+            gap_n += h_gn
+            hist = [a + b for a, b in zip(hist, h_hist)]
+            local = time.localtime(hour)
+            by_hour_of_day[local.tm_hour] += h_issued
+            days.add(local[:3])
+            hourly.append({"hour": hour, "issued": h_issued, "called": h_called,
+                           "avg_wait": round(h_wsum / h_wn, 1) if h_wn else None,
+                           "p95_wait": _round(quantile(h_hist, 0.95, h_wmax))})
+        active = [h for h in hourly if h["issued"] or h["called"]]
+        busiest = sorted(active, key=lambda h: -h["issued"])[:3]
+        return {
+            "since": since, "until": until,
+            "issued": issued, "called": called,
+            "wait": {"avg": round(wait_sum / wait_n, 1) if wait_n else None,
+                     "p50": _round(quantile(hist, 0.5, wait_max)),
+                     "p95": _round(quantile(hist, 0.95, wait_max)),
+                     "max": round(wait_max, 1) if wait_n else None,
+                     "samples": wait_n},
+            "service_time": round(gap_sum / gap_n, 1) if gap_n else None,
+            "tickets_per_hour": round(called / len(active), 1) if active else None,
+            "active_hours": len(active),
+            "peak_hours": [{"hour": h["hour"], "issued": h["issued"]} for h in busiest],
+            "hour_of_day": [round(c / len(days), 1) if days else 0 for c in by_hour_of_day],
+            "hourly": hourly,
+        }
+
+    def recent_calls(self, since: float):
+        """since 之後的叫號時間（舊到新），重開機時接回 WaitEstimator"""
+        self.flush()
+        with self.db_lock:
+            rows = self._db().execute("SELECT called FROM tickets WHERE called >= ? ORDER BY called",
+                                      (since,)).fetchall()
+        return [r[0] for r in rows]
+
+    def ticket(self, n: int, epoch: int = None):
+        """查單張號碼（預設目前這一輪）"""
+        self.flush()
+        with self.db_lock:
+            conn = self._db()
+            row = conn.execute("SELECT epoch, number, issued, called, source FROM tickets "
+                               "WHERE epoch = ? AND number = ?",
+                               (self.epoch if epoch is None else epoch, n)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("epoch", "number", "issued", "called", "source"), row))
+
+
+class WaitEstimator:
+    """最近的叫號速度 → 預估等候時間
+
+    只留最近 window 秒內、最多 size 筆叫號時間；每叫一號平均秒數 =
+    (最後一筆 - 第一筆) / (筆數 - 1)。observe 與估算都是 O(1)（過期的從左邊丟掉，攤銷計算），
+    少於 min_calls 筆時不估（回傳 None），票面就不印預估。
+    """
+
+    def __init__(self, size: int = 20, window: float = 1800, min_calls: int = 3):
+        self.calls = collections.deque(maxlen=size)
+        self.window = window
+        self.min_calls = min_calls
+        self.lock = threading.Lock()
+
+    def observe(self, ts: float = None):
+        ts = ts or time.time()
+        with self.lock:
+            if not self.calls or ts > self.calls[-1]:
+                self.calls.append(ts)
+
+    def seed(self, timestamps):
+        for ts in sorted(timestamps)[-self.calls.maxlen:]:
+            self.observe(ts)
+
+    def seconds_per_call(self, now: float = None):
+        now = now or time.time()
+        with self.lock:
+            while self.calls and now - self.calls[0] > self.window:
+                self.calls.popleft()
+            if len(self.calls) < self.min_calls:
+                return None
+            return (self.calls[-1] - self.calls[0]) / (len(self.calls) - 1)
+
+    def minutes(self, ahead: int, now: float = None):
+        """前面還要叫 ahead 號時的預估分鐘數（無條件進位，至少 1）；資料不足回傳 None"""
+        spc = self.seconds_per_call(now)
+        if spc is None:
+            return None
+        return max(1, math.ceil(ahead * spc / 60)) if ahead > 0 else 0
+
+    def stats(self):
+        spc = self.seconds_per_call()
+        with self.lock:
+            return {"seconds_per_call": None if spc is None else round(spc, 1),
+                    "samples": len(self.calls), "window": self.window}
+
+
+def _round(v):
+    return None if v is None else round(v, 1)
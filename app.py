@@ -1,8 +1,23 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for, send_file
-import requests, os, threading, time, urllib.parse, socket, math
-from io import BytesIO
-from gtts import gTTS
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, render_template, jsonify, request, redirect, url_for, send_file, Response
+import os, threading, time, logging, json, hashlib, multiprocessing, asyncio
+import shutil, subprocess, queue, re
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from metrics import Counter, Gauge, Histogram, render_all
+from logconf import setup_logging, get_logger
+from storage import StorageManager, Quota, StorageFull, atomic_write, atomic_open
+from journal import Journal
+from analytics import AnalyticsStore, WaitEstimator
+from lazy import lazy_import
+import lazy
+import queuepad
+from queuepad.escpos import (job_bytes as _escpos_job_bytes, nv_define as _nv_define, nv_delete as _nv_delete,
+                             parse_status, STATUS_QUERY, MODEL_QUERY)
+
+# 重量級模組延到第一次用到（或啟動後背景預熱）才載入，見 create_app()
+requests = lazy_import("requests")
+Image = lazy_import("PIL.Image")
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 
@@ -10,25 +25,124 @@ app = Flask(__name__, template_folder="templates", static_folder="static")
 ADS_FOLDER   = os.path.join(app.static_folder, "ads")
 AUDIO_FOLDER = os.path.join(app.static_folder, "audio")
 PRINT_FOLDER = os.path.join(app.static_folder, "print")
-os.makedirs(ADS_FOLDER, exist_ok=True)
-os.makedirs(AUDIO_FOLDER, exist_ok=True)
-os.makedirs(PRINT_FOLDER, exist_ok=True)
 
 ORDER_FILE        = os.path.join(ADS_FOLDER, "order.txt")
 CONFIG_FILE       = os.path.join(ADS_FOLDER, "ads_config.txt")            # muted/unmuted
 VOICE_CONFIG_FILE = os.path.join(AUDIO_FOLDER, "voice_config.txt")        # on/off
 
-QR_URL_FILE       = os.path.join(PRINT_FOLDER, "qr_url.txt")              # {number},{waiting}
+QR_URL_FILE       = os.path.join(PRINT_FOLDER, "qr_url.txt")              # {number},{waiting},{eta}
 PRINTER_IP_FILE   = os.path.join(PRINT_FOLDER, "printer_ip.txt")          # 例如 192.168.0.151
 PRINT_BG_FILE     = os.path.join(PRINT_FOLDER, "bg.jpg")                  # 票面滿版背景(16:9 cover)
 SERVER_URL_FILE   = os.path.join(PRINT_FOLDER, "server_url.txt")          # 伺服器網址
 PRINT_COUNT_FILE  = os.path.join(PRINT_FOLDER, "print_count.txt")         # 預設列印張數
+PRINTERS_FILE     = os.path.join(PRINT_FOLDER, "printers.txt")            # 多台印表機：每行 ip[:port] [dots] [raster]
+PRINT_POLICY_FILE = os.path.join(PRINT_FOLDER, "print_policy.txt")        # round_robin/least_busy/split
+NV_LOGO_CONFIG_FILE = os.path.join(PRINT_FOLDER, "nv_logo.txt")           # on/off：背景存在印表機 NV 記憶體
+NV_LOGO_STATE_FILE  = os.path.join(PRINT_FOLDER, "nv_logo.json")          # 各印表機已上傳的背景版本
 
 # 你的上游叫號狀態 API
 # API_URL 已被 get_server_url() 函數取代，可通過設定頁面配置
 
 # 熱敏機最大寬度(點)；多數 80mm 機種為 576，可依實際機型微調
 PRINTER_MAX_DOTS = int(os.getenv("PRINTER_MAX_DOTS", "384"))
+# 印表機 RAW 埠（XPrinter 預設 9100）；測試時可指到本機假印表機
+PRINTER_PORT = int(os.getenv("PRINTER_PORT", "9100"))
+# 多螢幕：standalone（單機，預設）/ hub（輪詢上游、生成語音、出單，並推播給各顯示端）/
+# edge（只當顯示端：訂閱 HUB_URL 的事件串流、鏡像語音檔，不碰上游與印表機）
+QUEUEPAD_ROLE = os.getenv("QUEUEPAD_ROLE", "standalone")
+HUB_URL = os.getenv("HUB_URL", "").rstrip("/")
+
+# ---------------- 指標 ----------------
+POLL_LATENCY    = Histogram("queuepad_upstream_poll_seconds", "上游 /status 輪詢延遲", ["source"])
+UPSTREAM_ERRORS = Counter("queuepad_upstream_errors_total", "上游輪詢失敗次數", ["source"])
+RENDER_TIME     = Histogram("queuepad_ticket_render_seconds", "票面合成時間")
+PRINT_SEND_TIME = Histogram("queuepad_printer_send_seconds", "單份票送到印表機的時間", ["printer"])
+PRINT_FAILURES  = Counter("queuepad_print_failures_total", "列印失敗次數")
+PRINT_RETRIES   = Counter("queuepad_print_retries_total", "列印重試次數")
+PRINTED_TOTAL   = Counter("queuepad_tickets_printed_total", "成功列印的票數（含多份）", ["printer"])
+PRINT_BYTES     = Counter("queuepad_printer_bytes_total", "送到印表機的位元組數", ["printer"])
+TTS_TIME        = Histogram("queuepad_tts_seconds", "gTTS 生成音檔時間")
+AUDIO_POST_TIME = Histogram("queuepad_audio_postprocess_seconds", "音檔去靜音/正規化時間")
+SPEAK_LATENCY   = Histogram("queuepad_speak_request_seconds", "/api/speak 回應時間")
+CACHE_HITS      = Counter("queuepad_cache_hits_total", "快取命中", ["cache"])
+CACHE_MISSES    = Counter("queuepad_cache_misses_total", "快取未命中", ["cache"])
+PRINT_QUEUE     = Gauge("queuepad_print_queue_depth", "等待列印的號碼數")
+PRINTER_UP      = Gauge("queuepad_printer_up", "印表機狀態正常=1（缺紙/開蓋/離線=0）", ["printer"])
+WAITING_LEN     = Gauge("queuepad_waiting_length", "目前等候人數")
+DISPLAY_FRAME_TIME = Histogram("queuepad_display_frame_seconds", "顯示端每格畫面時間", ["display"],
+                               buckets=(0.008, 0.017, 0.025, 0.033, 0.05, 0.1, 0.25, 0.5, 1.0))
+DISPLAY_JANK    = Counter("queuepad_display_janky_frames_total", "顯示端超過 50ms 的畫面數", ["display", "announcing"])
+
+# ---------------- 日誌 ----------------
+# handler（stdout、輪替檔、背景 listener）由 create_app() 呼叫 setup_logging() 掛上
+log_monitor = get_logger("monitor")
+log_printer = get_logger("printer")
+log_tts     = get_logger("tts")
+log_ads     = get_logger("ads")
+log_display = get_logger("display")
+log_app     = get_logger("app")
+
+# ---------------- 後端 ----------------
+# 出單機 / 語音 / 上游各自可替換（介面與實作在 queuepad/），預設行為與原本相同
+PRINTER_BACKEND_NAME  = os.getenv("QUEUEPAD_PRINTER", "network")    # network / fake / file
+TTS_BACKEND_NAMES     = os.getenv("QUEUEPAD_TTS", "gtts")           # gtts / concat / cache，逗號串後援順序
+UPSTREAM_BACKEND_NAME = os.getenv("QUEUEPAD_UPSTREAM", "poll")      # poll / webhook / sim
+PRINTER_SINK_DIR   = os.getenv("PRINTER_SINK_DIR", os.path.join(PRINT_FOLDER, "sink"))   # file 印表機
+TTS_CLIPS_DIR      = os.getenv("TTS_CLIPS_DIR", os.path.join(AUDIO_FOLDER, "clips"))     # concat 語音片段
+UPSTREAM_TRACE     = os.getenv("UPSTREAM_TRACE", "")                 # sim 重播的 JSONL 軌跡
+UPSTREAM_SIM_SPEED = float(os.getenv("UPSTREAM_SIM_SPEED", "1"))
+
+_BACKEND_ARGS = {
+    ("printer", "file"): lambda: {"folder": PRINTER_SINK_DIR},
+    ("tts", "concat"): lambda: {"folder": TTS_CLIPS_DIR},
+    ("upstream", "poll"): lambda: {"url": lambda: get_server_url()},   # 設定頁改網址後立即生效
+    ("upstream", "sim"): lambda: {"trace_path": UPSTREAM_TRACE, "speed": UPSTREAM_SIM_SPEED},
+}
+
+def make_backend(kind: str, name: str):
+    return queuepad.create(kind, name, **_BACKEND_ARGS.get((kind, name), dict)())
+
+# 由 create_app() 建立（sim 上游會讀軌跡檔，不在 import 時做）
+PRINTER_BACKEND = None
+TTS_BACKENDS = []
+UPSTREAM = None
+
+def init_backends():
+    global PRINTER_BACKEND, TTS_BACKENDS, UPSTREAM
+    PRINTER_BACKEND = make_backend("printer", PRINTER_BACKEND_NAME)
+    TTS_BACKENDS = [make_backend("tts", name.strip()) for name in TTS_BACKEND_NAMES.split(",") if name.strip()]
+    UPSTREAM = make_backend("upstream", UPSTREAM_BACKEND_NAME)
+
+def backends_report():
+    return {"printer": PRINTER_BACKEND.stats(), "tts": [b.stats() for b in TTS_BACKENDS],
+            "upstream": UPSTREAM.stats()}
+
+# ---------------- 空間管理 ----------------
+# 各資料夾配額（MB）；音檔與票面圖超過時刪最久沒用的，廣告影片不自動刪、超過就拒收。
+# 整張卡另外保留 STORAGE_MIN_FREE_MB，上傳吃到這塊一律拒收，出單永遠有地方寫。
+STORAGE_AUDIO_MB    = int(os.getenv("STORAGE_AUDIO_MB", "50"))
+STORAGE_PRINT_MB    = int(os.getenv("STORAGE_PRINT_MB", "20"))
+STORAGE_ADS_MB      = int(os.getenv("STORAGE_ADS_MB", "2048"))
+STORAGE_MIN_FREE_MB = int(os.getenv("STORAGE_MIN_FREE_MB", "200"))
+STORAGE_INTERVAL    = 60      # 背景檢查配額的秒數
+
+STORAGE_BYTES = Gauge("queuepad_storage_bytes", "各資料夾用量", ["dir"])
+
+def _audio_in_use():
+    """目前號碼與等候中號碼的音檔不能刪"""
+    keep = getattr(MONITOR, "keep", set()) | LAST_WAITING
+    return {f"{n}{ext}" for n in keep for ext in AUDIO_EXTS}
+
+STORAGE = StorageManager(STORAGE_MIN_FREE_MB * 1024 * 1024, log=log_ads)
+STORAGE.add(Quota("audio", AUDIO_FOLDER, STORAGE_AUDIO_MB * 1024 * 1024, "lru", "[0-9]*", _audio_in_use))
+STORAGE.add(Quota("print", PRINT_FOLDER, STORAGE_PRINT_MB * 1024 * 1024, "lru", "ticket_*.png"))
+STORAGE.add(Quota("ads", ADS_FOLDER, STORAGE_ADS_MB * 1024 * 1024, "refuse"))
+
+def storage_report():
+    report = STORAGE.report()
+    for name, d in report["dirs"].items():
+        STORAGE_BYTES.set(d["bytes"], dir=name)
+    return report
 
 # ---------------- 中文數字 ----------------
 def num_to_chinese(n: int) -> str:
@@ -59,33 +173,118 @@ def num_to_chinese(n: int) -> str:
 # ---------------- 語音 ----------------
 def generate_audio(n: int, save_path: str):
     text = f"請 {num_to_chinese(n)} 號取餐"
-    gTTS(text=text, lang="zh-tw").save(save_path)
-    print(f"[生成音檔] {n}")
+    # 先寫暫存檔再換名：逾時被放棄的生成不會留下半個 mp3 被播出去
+    tmp = f"{save_path}.{threading.get_ident()}.tmp"
+    errors = []
+    try:
+        # 依 QUEUEPAD_TTS 的順序試，前一個生不出來（缺片段 / cache-only / 網路錯誤）才換下一個
+        for backend in TTS_BACKENDS:
+            try:
+                with TTS_TIME.time():
+                    backend.synthesize(text, tmp)
+            except Exception as e:
+                errors.append(f"{backend.name}: {e!r}")
+                continue
+            os.replace(tmp, save_path)
+            log_tts.info("[生成音檔] %s (%s)", n, backend.name, extra={"number": n, "backend": backend.name})
+            return
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    raise queuepad.TTSUnavailable("; ".join(errors) or "沒有可用的語音後端")
 
 def cleanup_audio(keep_numbers):
     keep = {int(x) for x in keep_numbers if str(x).isdigit()}
     for f in os.listdir(AUDIO_FOLDER):
-        if f.endswith(".mp3"):
+        if f.endswith(AUDIO_EXTS):
             try:
                 num = int(os.path.splitext(f)[0])
                 if num not in keep:
                     os.remove(os.path.join(AUDIO_FOLDER, f))
-                    print(f"[刪除音檔] {num}")
+                    log_tts.debug("[刪除音檔] %s", num, extra={"number": num})
             except:
                 continue
 
+# ---------------- 音檔後處理 ----------------
+# gTTS 的原始 mp3 頭尾有靜音、音量也不一致；生成後在背景用 ffmpeg 處理一次：
+# 去頭尾靜音 → 響度正規化 →（選用）轉成 Opus 小檔。處理完就地換檔，/api/speak 只讀檔。
+# 沒裝 ffmpeg 時直接略過，播原始檔。
+AUDIO_EXTS = (".mp3", ".ogg")
+AUDIO_FFMPEG = shutil.which("ffmpeg")
+AUDIO_POSTPROCESS = os.getenv("AUDIO_POSTPROCESS", "on") == "on"
+AUDIO_LOUDNESS = os.getenv("AUDIO_LOUDNESS", "-16")          # 目標響度 (LUFS)
+AUDIO_CODEC = os.getenv("AUDIO_CODEC", "mp3")                # mp3 / opus
+AUDIO_POST_TIMEOUT = 20
+_AUDIO_MARK = "queuepad-post"   # 寫進 ID3 comment，用來辨識處理過的 mp3
+_AUDIO_SILENCE = ("silenceremove=start_periods=1:start_threshold=-45dB:start_silence=0.05,"
+                  "areverse,silenceremove=start_periods=1:start_threshold=-45dB:start_silence=0.1,areverse")
+
+def audio_path(n: int):
+    """n 號目前可播的音檔（處理過的 .ogg 優先）；沒有時回傳 None"""
+    for ext in (".ogg", ".mp3"):
+        path = os.path.join(AUDIO_FOLDER, f"{n}{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def audio_processed(path: str) -> bool:
+    if path.endswith(".ogg"):
+        return True
+    try:
+        with open(path, "rb") as f:
+            return _AUDIO_MARK.encode() in f.read(512)
+    except OSError:
+        return False
+
+def postprocess_audio(n: int) -> bool:
+    """處理 n 號音檔；已處理過、沒有 ffmpeg 或關閉時回傳 False"""
+    src = os.path.join(AUDIO_FOLDER, f"{n}.mp3")
+    if not (AUDIO_POSTPROCESS and AUDIO_FFMPEG) or not os.path.exists(src) or audio_processed(src):
+        return False
+    if AUDIO_CODEC == "opus":
+        dst, codec = os.path.join(AUDIO_FOLDER, f"{n}.ogg"), ["-c:a", "libopus", "-b:a", "24k", "-ar", "24000"]
+    else:
+        dst, codec = src, ["-c:a", "libmp3lame", "-b:a", "48k", "-ar", "24000", "-id3v2_version", "3"]
+    tmp = f"{dst}.{threading.get_ident()}.tmp"
+    cmd = [AUDIO_FFMPEG, "-nostdin", "-loglevel", "error", "-y", "-i", src,
+           "-af", f"{_AUDIO_SILENCE},loudnorm=I={AUDIO_LOUDNESS}:TP=-1.5:LRA=11",
+           "-ac", "1", *codec, "-metadata", f"comment={_AUDIO_MARK}",
+           "-f", "ogg" if AUDIO_CODEC == "opus" else "mp3", tmp]
+    try:
+        with AUDIO_POST_TIME.time():
+            subprocess.run(cmd, check=True, capture_output=True, timeout=AUDIO_POST_TIMEOUT)
+        os.replace(tmp, dst)
+        if dst != src:
+            os.remove(src)
+    except (OSError, subprocess.SubprocessError) as e:
+        err = getattr(e, "stderr", b"") or b""
+        log_tts.warning("[音檔後處理失敗] %s %r %s", n, e, err.decode(errors="replace")[-200:],
+                        extra={"number": n})
+        return False
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    log_tts.info("[音檔後處理] %s", n, extra={"number": n})
+    return True
+
 # ---------------- 狀態設定（語音/影片） ----------------
 def get_voice_enabled():
     return os.path.exists(VOICE_CONFIG_FILE) and open(VOICE_CONFIG_FILE).read().strip() == "on"
 
 def set_voice_enabled(enabled: bool):
-    open(VOICE_CONFIG_FILE, "w").write("on" if enabled else "off")
+    atomic_write(VOICE_CONFIG_FILE, "on" if enabled else "off")
 
 def get_muted():
     return os.path.exists(CONFIG_FILE) and open(CONFIG_FILE).read().strip() == "muted"
 
 def set_muted(muted: bool):
-    open(CONFIG_FILE, "w").write("muted" if muted else "unmuted")
+    atomic_write(CONFIG_FILE, "muted" if muted else "unmuted")
+
+def get_nv_logo_enabled():
+    return os.path.exists(NV_LOGO_CONFIG_FILE) and open(NV_LOGO_CONFIG_FILE).read().strip() == "on"
+
+def set_nv_logo_enabled(enabled: bool):
+    atomic_write(NV_LOGO_CONFIG_FILE, "on" if enabled else "off")
 
 # ---------------- 列印設定 ----------------
 def get_qr_url_template():
@@ -93,21 +292,66 @@ def get_qr_url_template():
         else "https://example.com/?no={number}&waiting={waiting}"
 
 def set_qr_url_template(url: str):
-    open(QR_URL_FILE, "w").write(url.strip())
+    atomic_write(QR_URL_FILE, url.strip())
 
 def get_printer_ip():
     return open(PRINTER_IP_FILE).read().strip() if os.path.exists(PRINTER_IP_FILE) \
         else "192.168.0.151"
 
 def set_printer_ip(ip: str):
-    open(PRINTER_IP_FILE, "w").write(ip.strip())
+    atomic_write(PRINTER_IP_FILE, ip.strip())
+
+def get_print_policy():
+    policy = open(PRINT_POLICY_FILE).read().strip() if os.path.exists(PRINT_POLICY_FILE) else ""
+    return policy if policy in PRINT_POLICIES else "round_robin"
+
+def set_print_policy(policy: str):
+    atomic_write(PRINT_POLICY_FILE, policy.strip())
+
+def parse_printer_line(line: str):
+    """printers.txt 的一行 → (ip, port, dots, raster)；空行/註解回傳 None，格式錯誤丟 ValueError"""
+    line = line.split("#", 1)[0].strip()
+    if not line:
+        return None
+    parts = line.split()
+    host, _, port = parts[0].partition(":")
+    if not host:
+        raise ValueError(f"缺少 IP: {line}")
+    return (host, int(port or PRINTER_PORT),
+            int(parts[1]) if len(parts) > 1 else PRINTER_MAX_DOTS,
+            parts[2] if len(parts) > 2 else PRINTER_RASTER_MODE)
+
+def get_printers():
+    """回傳 [(ip, port, dots, raster)]；沒有 printers.txt 時退回單台 printer_ip.txt"""
+    printers = []
+    if os.path.exists(PRINTERS_FILE):
+        for line in open(PRINTERS_FILE).read().splitlines():
+            try:
+                printer = parse_printer_line(line)
+            except ValueError:
+                log_printer.warning("[印表機設定] 無法解析: %s", line)
+                continue
+            if printer:
+                printers.append(printer)
+    return printers or [(get_printer_ip(), PRINTER_PORT, PRINTER_MAX_DOTS, PRINTER_RASTER_MODE)]
+
+def set_printers(lines):
+    """lines 必須是字串陣列；任何一行解析失敗就丟 ValueError，不寫檔"""
+    if not isinstance(lines, list) or not all(isinstance(x, str) for x in lines):
+        raise ValueError("printers 必須是字串陣列")
+    for line in lines:
+        try:
+            parse_printer_line(line)
+        except ValueError:
+            raise ValueError(f"無法解析: {line}") from None
+    atomic_write(PRINTERS_FILE, "\n".join(x.strip() for x in lines if x.strip()))
 
 def get_server_url():
     return open(SERVER_URL_FILE).read().strip() if os.path.exists(SERVER_URL_FILE) \
         else "https://ticket-server-246181962314.asia-east1.run.app/status"
 
 def set_server_url(url: str):
-    open(SERVER_URL_FILE, "w").write(url.strip())
+    atomic_write(SERVER_URL_FILE, url.strip())
 
 def get_print_count():
     try:
@@ -116,9 +360,10 @@ def get_print_count():
         return 1
 
 def set_print_count(count: int):
-    open(PRINT_COUNT_FILE, "w").write(str(count))
+    atomic_write(PRINT_COUNT_FILE, str(count))
 
 def save_print_bg(file_storage):
+    STORAGE.reserve("print", 512 * 1024)   # 720x1280 JPEG 約數百 KB
     # 將上傳圖轉成 1280x720 的 cover 圖
     img = Image.open(file_storage.stream).convert("RGB")
     target_w, target_h = 720, 1280
@@ -128,253 +373,818 @@ def save_print_bg(file_storage):
     img = img.resize((nw, nh), Image.LANCZOS)
     left, top = (nw - target_w)//2, (nh - target_h)//2
     img = img.crop((left, top, left + target_w, top + target_h))
-    img.save(PRINT_BG_FILE, "JPEG", quality=92)
-    print("[列印背景] 已更新")
+    with atomic_open(PRINT_BG_FILE, "wb") as f:
+        img.save(f, "JPEG", quality=92)
+    log_printer.info("[列印背景] 已更新")
+    # 背景換了就重新上傳到印表機 NV 記憶體（背景執行，不卡住請求）
+    if get_nv_logo_enabled():
+        threading.Thread(target=nv_upload_all, daemon=True).start()
 
 # ---------------- 票面合成 ----------------
-def _load_font(size: int):
-    # 專案自帶字體
-    proj_font = os.path.join(app.static_folder, "fonts", "NotoSansTC-SemiBold.ttf")
-    if os.path.exists(proj_font):
-        try:
-            return ImageFont.truetype(proj_font, size)
-        except Exception as e:
-            print("[字體載入失敗]", e)
-
-    # 如果自帶字體失敗，才退回系統字體
-    candidates = [
-        "/usr/share/fonts/truetype/noto/NotoSansTC-Regular.otf",
-        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-        "/System/Library/Fonts/Supplemental/Songti.ttc",
-        "/System/Library/Fonts/PingFang.ttc"
-    ]
-    for p in candidates:
-        if os.path.exists(p):
-            try:
-                return ImageFont.truetype(p, size)
-            except:
-                pass
-
-    # 最後 fallback
-    return ImageFont.load_default()
+# 合成 / 二值化 / 打包本體在 ticket_render.py（render 子行程也用同一份）
+from ticket_render import TICKET_W, TICKET_H, ticket_dynamic_rows, ticket_raster
+from ticket_render import load_font as _load_font
+import ticket_render
 
+def ticket_eta(waiting: int):
+    """票面的預估等候分鐘數（依最近的叫號速度）；資料不足時 None
 
+    waiting 是票面上的等候人數，已經把這張票算進去，前面只有 waiting - 1 人
+    """
+    return ETA.minutes(max(0, waiting - 1))
 
-def build_qr_img(number: int, waiting: int):
-    # 使用線上服務產 QR（PNG）
-    url_tpl = get_qr_url_template()
-    final_url = url_tpl.format(number=number, waiting=waiting)
-    # 改善 QR code 品質：增加尺寸、邊距，使用更高解析度
-    qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size=800x800&format=png&margin=2&ecc=M&data={urllib.parse.quote(final_url, safe='')}"
-    r = requests.get(qr_url, timeout=6)
-    r.raise_for_status()
-    return Image.open(BytesIO(r.content)).convert("RGBA")
+def build_qr_img(number: int, waiting: int, eta=None):
+    eta = ticket_eta(waiting) if eta is None else eta
+    return ticket_render.build_qr_img(number, waiting, get_qr_url_template(), eta)
 
-def draw_centered_text(draw, text, font, y, fill=(0,0,0), canvas_width=384):
-    """在指定 y 座標，文字水平置中繪製"""
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_w = bbox[2] - bbox[0]
-    x = (canvas_width - text_w) // 2
-    draw.text((x, y), text, font=font, fill=fill)
+def _cover_bg(W: int, H: int):
+    """讀取列印背景並 cover 裁切到 W x H；沒有背景時回傳 None"""
+    return ticket_render.cover_bg(PRINT_BG_FILE, W, H)
 
+# ---------------- raster 傳輸模式 ----------------
+# plain：整張一個 GS v 0；bands：空白列改用 ESC J 走紙，只送有內容的區段
+RASTER_MODES = ("plain", "bands")
+PRINTER_RASTER_MODE = os.getenv("PRINTER_RASTER_MODE", "auto")   # auto/plain/bands
+# 指令編碼本體（GS v 0、ESC J、GS ( L、狀態解析）在 queuepad/escpos.py
 
-def compose_ticket_image(number: int, waiting: int):
-    # 58mm 出單機：寬度 384 dots，高度 640
-    W, H = 384, 640
-    canvas = Image.new("RGB", (W, H), (255, 255, 255))
+def _send_escpos_bytes(ip: str, payload: bytes, port: int = None):
+    PRINTER_BACKEND.send(ip, port or PRINTER_PORT, payload)
 
-    # 背景 (cover 到 384x640)
-    if os.path.exists(PRINT_BG_FILE):
-        bg = Image.open(PRINT_BG_FILE).convert("RGB")
-        sw, sh = bg.size
-        scale = max(W / sw, H / sh)
-        bg = bg.resize((int(sw * scale), int(sh * scale)), Image.LANCZOS)
-
-        # === 調整垂直偏移 ===
-        vertical_offset = 0   # 負數=往上移，正數=往下移
-        left = (bg.size[0] - W) // 2
-        top  = (bg.size[1] - H) // 2 + vertical_offset
-
-        # 避免超界
-        if top < 0:
-            top = 0
-        if top + H > bg.size[1]:
-            top = bg.size[1] - H
+def _detect_raster_mode(ip: str, port: int = None, timeout: float = 1.0) -> str:
+    """用 GS I 1（印表機型號 ID）探測；有回應的完整 ESC/POS 機種才用 bands"""
+    try:
+        return "bands" if PRINTER_BACKEND.query(ip, port or PRINTER_PORT, MODEL_QUERY, 1, timeout) else "plain"
+    except OSError:
+        return "plain"
+
+
+# ---------------- 印表機 NV 背景圖 ----------------
+# 背景每張都一樣：二值化後把「只有背景」的列區段存進印表機 NV 記憶體 (GS ( L)，
+# 之後每張票只送號碼、等候人數、QR 這幾段 raster，其餘用 key 叫出來印。
+NV_MIN_SEGMENT = 8        # 太短的靜態區段不值得存，直接併入動態區段
+NV_RETRY_AFTER = 60       # 上傳失敗後隔多久才再試，避免每張票都重傳一次
+_NV_PLAN = {"mtime": None, "plan": None}
+_NV_LOCK = threading.Lock()
+_NV_STATE = None          # nv_logo.json 的記憶體副本，只在第一次用到時讀檔
+_NV_RETRY = {}            # "host:port" → 上傳失敗後下次可以再試的時間
+
+def _nv_bg_plan():
+    """背景 → {"segments": [(y0, y1, key or None)], ...}；key=None 為每張都要送的動態區段"""
+    if not os.path.exists(PRINT_BG_FILE):
+        return None
+    mtime = os.path.getmtime(PRINT_BG_FILE)
+    with _NV_LOCK:
+        if _NV_PLAN["mtime"] == mtime:
+            return _NV_PLAN["plan"]
+
+        canvas = Image.new("RGB", (TICKET_W, TICKET_H), (255, 255, 255))
+        canvas.paste(_cover_bg(TICKET_W, TICKET_H), (0, 0))
+        raster, wb, h = ticket_raster(canvas, TICKET_W)
+
+        segments, y = [], 0
+        for d0, d1 in ticket_dynamic_rows() + [(h, h)]:
+            if d0 - y >= NV_MIN_SEGMENT:
+                segments.append((y, d0, b"B" + bytes([ord("0") + len([s for s in segments if s[2]])])))
+            elif d0 > y:
+                d0 = y
+            if d1 > d0:
+                segments.append((d0, d1, None))
+            y = max(y, d1)
+        with open(PRINT_BG_FILE, "rb") as f:
+            digest = hashlib.sha1(f.read() + repr(segments).encode()).hexdigest()[:12]
+        plan = {"hash": digest, "segments": segments, "raster": raster, "width_bytes": wb, "height": h}
+        _NV_PLAN.update(mtime=mtime, plan=plan)
+        return plan
+
+def _nv_state():
+    global _NV_STATE
+    if _NV_STATE is None:
+        try:
+            with open(NV_LOGO_STATE_FILE) as f:
+                _NV_STATE = json.load(f)
+        except (OSError, ValueError):
+            _NV_STATE = {}
+    return dict(_NV_STATE)
+
+def _nv_upload(host: str, port: int, plan: dict) -> bool:
+    """把靜態背景區段寫進印表機 NV 記憶體（只在背景換過時做，避免磨損快閃記憶體）"""
+    wb = plan["width_bytes"]
+    data = bytearray(b'\x1B\x40')
+    for y0, y1, key in plan["segments"]:
+        if key:
+            data += _nv_delete(key) + _nv_define(key, plan["raster"][y0 * wb:y1 * wb], wb, y1 - y0)
+    try:
+        _send_escpos_bytes(host, bytes(data), port)
+    except OSError as e:
+        log_printer.error("[NV 背景] 上傳失敗 %s:%s %s（%s 秒後再試）", host, port, e, NV_RETRY_AFTER)
+        _NV_RETRY[f"{host}:{port}"] = time.time() + NV_RETRY_AFTER
+        return False
+    global _NV_STATE
+    with _NV_LOCK:
+        state = _nv_state()
+        state[f"{host}:{port}"] = plan["hash"]
+        atomic_write(NV_LOGO_STATE_FILE, json.dumps(state))
+        _NV_STATE = state
+    _NV_RETRY.pop(f"{host}:{port}", None)
+    log_printer.info("[NV 背景] 已上傳 %s:%s（%s bytes）", host, port, len(data))
+    return True
+
+def nv_plan_for(host: str, port: int, dots: int):
+    """這台印表機可用的 NV 計畫；未啟用、寬度不符或上傳失敗時回傳 None（整張送 raster）"""
+    if not get_nv_logo_enabled() or dots != TICKET_W:
+        return None
+    plan = _nv_bg_plan()
+    if plan is None or not any(key for _, _, key in plan["segments"]):
+        return None
+    key = f"{host}:{port}"
+    if _nv_state().get(key) != plan["hash"]:
+        # 上傳失敗後的冷卻期間先整張送 raster
+        if time.time() < _NV_RETRY.get(key, 0) or not _nv_upload(host, port, plan):
+            return None
+    return plan
+
+def nv_upload_all():
+    # 手動開啟或啟動時不受上次失敗的冷卻限制
+    _NV_RETRY.clear()
+    for p in PRINTER_POOL.reload():
+        nv_plan_for(p.host, p.port, p.dots)
+
+
+# ---------------- 多台印表機 ----------------
+PRINT_POLICIES = ("round_robin", "least_busy", "split")
+PRINTER_COOLDOWN = 30     # 印表機失敗後暫停派工的秒數
+COPY_INTERVAL = 0.5       # 同一台連續出多份之間的間隔
+# 送完後隔多久再查一次狀態確認真的印出（缺紙/開蓋會在這時被發現）
+PRINT_CONFIRM_DELAY = float(os.getenv("PRINT_CONFIRM_DELAY", "1.0"))
+PRINTER_STATUS_INTERVAL = 5   # 背景輪詢印表機狀態的秒數
+
+
+class PrinterState:
+    """單台印表機的健康狀態與吞吐統計"""
+
+    def __init__(self, host: str, port: int, dots: int, raster: str = "auto"):
+        self.host, self.port, self.dots = host, port, dots
+        self.raster = raster
+        self.raster_mode = raster if raster in RASTER_MODES else None   # auto 探測後才決定
+        self.busy = 0
+        self.down_until = 0.0
+        self.last_error = ""
+        self.problem = ""         # 由即時狀態得知的問題（paper_out / cover_open ...）
+        self.status = None
+        self.copies = 0
+        self.failures = 0
+        self.bytes = 0
+        self.send_seconds = 0.0
+        self.since = time.time()
+
+    @property
+    def key(self):
+        return f"{self.host}:{self.port}"
+
+    def available(self):
+        return not self.problem and time.time() >= self.down_until
+
+    def mark_down(self, reason: str):
+        self.failures += 1
+        self.last_error = reason
+        self.down_until = time.time() + PRINTER_COOLDOWN
+
+    def resolve_raster_mode(self):
+        if self.raster_mode is None:
+            self.raster_mode = _detect_raster_mode(self.host, self.port)
+            log_printer.info("[印表機] %s raster 模式: %s", self.key, self.raster_mode,
+                             extra={"printer": self.key})
+        return self.raster_mode
+
+    def update_status(self):
+        """查即時狀態；回傳是否可以列印（狀態未知視為可以）"""
+        status = _query_printer_status(self.host, self.port)
+        self.status = status
+        problem = (status or {}).get("problem", "")
+        if problem != self.problem:
+            if problem:
+                log_printer.warning("[印表機狀態] %s %s，暫停派工", self.key, problem, extra={"printer": self.key})
+            else:
+                log_printer.info("[印表機狀態] %s 已恢復", self.key, extra={"printer": self.key})
+                self.down_until = 0.0
+        self.problem = problem
+        PRINTER_UP.set(0 if problem else 1, printer=self.key)
+        return not problem
+
+    def stats(self):
+        elapsed = max(time.time() - self.since, 1e-9)
+        return {
+            "printer": self.key,
+            "dots": self.dots,
+            "raster": self.raster_mode or self.raster,
+            "online": self.available(),
+            "problem": self.problem,
+            "status": self.status,
+            "busy": self.busy,
+            "copies": self.copies,
+            "failures": self.failures,
+            "bytes": self.bytes,
+            "avg_send_ms": round(self.send_seconds / self.copies * 1000, 1) if self.copies else None,
+            "copies_per_min": round(self.copies / elapsed * 60, 2),
+            "last_error": self.last_error,
+        }
+
+
+def _split_shares(copies: int, n: int):
+    """copies 份平均拆成 n 份，零頭給前面幾台"""
+    return [copies // n + (1 if i < copies % n else 0) for i in range(n)]
+
+
+class PrinterPool:
+    """依 printers.txt 分派列印工作；離線的印表機自動跳過"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.printers = {}
+        self.rr = 0
+        self.config_key = None
+
+    @staticmethod
+    def _config_key():
+        """printers.txt / printer_ip.txt 的 (inode, mtime, 大小)；沒變就不必重新解析"""
+        key = []
+        for path in (PRINTERS_FILE, PRINTER_IP_FILE):
+            try:
+                st = os.stat(path)
+                key.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                key.append(None)
+        return tuple(key)
+
+    def reload(self, force: bool = False):
+        """設定檔有變（或 force）才重新讀取；回傳目前的印表機"""
+        key = self._config_key()
+        with self.lock:
+            if not force and key == self.config_key:
+                return list(self.printers.values())
+            self.config_key = key
+            current = {}
+            for host, port, dots, raster in get_printers():
+                p = self.printers.get(f"{host}:{port}")
+                if p is None or p.raster != raster:
+                    p = PrinterState(host, port, dots, raster)
+                p.dots = dots
+                current[p.key] = p
+            self.printers = current
+            return list(current.values())
+
+    def _candidates(self, exclude=()):
+        printers = [p for p in self.reload() if p.key not in exclude and not p.problem]
+        up = [p for p in printers if p.available()]
+        # 只是冷卻中（沒有缺紙/開蓋）就照樣試，避免整台停擺
+        return up or printers
+
+    def refresh_status(self):
+        """輪詢所有印表機的即時狀態；回傳是否至少一台可用"""
+        printers = self.reload()
+        return any([p.update_status() for p in printers])
+
+    def healthy(self):
+        return any(not p.problem for p in self.reload())
+
+    def pick(self, policy: str, exclude=()):
+        printers = self._candidates(exclude)
+        if not printers:
+            return None
+        with self.lock:
+            if policy == "least_busy":
+                return min(printers, key=lambda p: (p.busy, p.copies))
+            self.rr += 1
+            return printers[self.rr % len(printers)]
+
+    def widths(self):
+        """目前所有印表機的寬度（點）；票面依這些寬度各打包一份 raster"""
+        return sorted({p.dots for p in self.reload()})
+
+    def _print_on(self, p: PrinterState, ticket: dict, copies: int):
+        """在同一台印出 copies 份；ticket = {寬度: (raster, width_bytes, height)}
+
+        回傳 (送出份數, 是否未確認)。送出後狀態確認失敗時份數照算、標記未確認：
+        資料已進印表機緩衝區，可能已經印出或恢復後會印，不能再改派別台重印。
+        """
+        with self.lock:
+            p.busy += 1
+        try:
+            # 同一台的多份共用同一份編碼結果
+            payload = _escpos_job_bytes(*ticket[p.dots], p.resolve_raster_mode(),
+                                        nv_plan_for(p.host, p.port, p.dots))
+            for i in range(copies):
+                t0 = time.perf_counter()
+                try:
+                    _send_escpos_bytes(p.host, payload, p.port)
+                except OSError as e:
+                    log_printer.error("[GS v 0 列印失敗] %s", e, extra={"printer": p.key})
+                    PRINT_FAILURES.inc()
+                    with self.lock:
+                        p.mark_down(f"send failed: {e}")
+                    return i, False
+                elapsed = time.perf_counter() - t0
+                PRINT_SEND_TIME.observe(elapsed, printer=p.key)
+                PRINTED_TOTAL.inc(printer=p.key)
+                PRINT_BYTES.inc(len(payload), printer=p.key)
+                with self.lock:
+                    p.copies += 1
+                    p.send_seconds += elapsed
+                    p.bytes += len(payload)
+                if i < copies - 1:
+                    time.sleep(COPY_INTERVAL)
+
+            # sendall 回傳只代表資料進了印表機緩衝區，再查一次狀態才算確認
+            if PRINT_CONFIRM_DELAY:
+                time.sleep(PRINT_CONFIRM_DELAY)
+                if not p.update_status():
+                    PRINT_FAILURES.inc()
+                    with self.lock:
+                        p.mark_down(p.problem)
+                    log_printer.error("[列印未確認] %s 送出後狀態異常（%s），不改派，請現場確認",
+                                      p.key, p.problem, extra={"printer": p.key})
+                    return copies, True
+            return copies, False
+        finally:
+            with self.lock:
+                p.busy -= 1
+
+    def print_copies(self, ticket: dict, copies: int, policy: str = None) -> bool:
+        """印 copies 份；沒送出的份數改派其他印表機，已送出但未確認的不改派（回傳 False）"""
+        policy = policy or get_print_policy()
+        tried = set()
+        remaining = copies
+        while remaining > 0:
+            if policy == "split":
+                printers = [p for p in self._candidates(tried)][:remaining]
+                if not printers:
+                    return False
+                shares = _split_shares(remaining, len(printers))
+                results = [(0, False)] * len(printers)
+
+                def run(i):
+                    results[i] = self._print_on(printers[i], ticket, shares[i])
+
+                threads = [threading.Thread(target=run, args=(i,)) for i in range(1, len(printers))]
+                for t in threads:
+                    t.start()
+                run(0)
+                for t in threads:
+                    t.join()
+                done = sum(r for r, _ in results)
+                unconfirmed = any(u for _, u in results)
+                tried.update(p.key for p, (r, _), sh in zip(printers, results, shares) if r < sh)
+            else:
+                p = self.pick(policy, tried)
+                if p is None:
+                    return False
+                done, unconfirmed = self._print_on(p, ticket, remaining)
+                if done < remaining:
+                    tried.add(p.key)
+            if unconfirmed:
+                return False
+            remaining -= done
+            if remaining > 0:
+                if len(tried) >= len(self.printers):
+                    return False
+                PRINT_RETRIES.inc()
+                log_printer.warning("[列印改派] 剩 %s 份改送其他印表機", remaining)
+        return True
 
-        bg = bg.crop((left, top, left + W, top + H))
-        canvas.paste(bg, (0, 0))
+    def _session_on(self, p: PrinterState, items):
+        """同一條連線連續送多張票（每張各自切紙）
 
-    draw = ImageDraw.Draw(canvas)
-    f_big = _load_font(90)
-    f_mid = _load_font(20)
+        回傳 (每張送出的份數, 是否確認)。送完後狀態確認失敗時 confirmed=False：
+        已送出的份數在這台的緩衝區裡（未確認，不可改派），沒送出的份數才可以改派。
+        """
+        sent = [0] * len(items)
+        with self.lock:
+            p.busy += 1
+        try:
+            mode, nv = p.resolve_raster_mode(), nv_plan_for(p.host, p.port, p.dots)
+            payloads = [_escpos_job_bytes(*ticket[p.dots], mode, nv) for ticket, _ in items]
+            with PRINTER_BACKEND.open(p.host, p.port, timeout=10) as s:
+                for i, ((_, copies), payload) in enumerate(zip(items, payloads)):
+                    for _ in range(copies):
+                        t0 = time.perf_counter()
+                        s.sendall(payload)
+                        sent[i] += 1
+                        elapsed = time.perf_counter() - t0
+                        PRINT_SEND_TIME.observe(elapsed, printer=p.key)
+                        PRINTED_TOTAL.inc(printer=p.key)
+                        PRINT_BYTES.inc(len(payload), printer=p.key)
+                        with self.lock:
+                            p.copies += 1
+                            p.send_seconds += elapsed
+                            p.bytes += len(payload)
+        except OSError as e:
+            log_printer.error("[批次列印失敗] %s", e, extra={"printer": p.key})
+            PRINT_FAILURES.inc()
+            with self.lock:
+                p.mark_down(f"send failed: {e}")
+        finally:
+            with self.lock:
+                p.busy -= 1
+
+        # 和單張一樣，送完再查一次狀態
+        if PRINT_CONFIRM_DELAY and any(sent):
+            time.sleep(PRINT_CONFIRM_DELAY)
+            if not p.update_status():
+                PRINT_FAILURES.inc()
+                with self.lock:
+                    p.mark_down(p.problem)
+                return sent, False
+        return sent, True
+
+    def print_batch(self, items, policy: str = None):
+        """items = [(ticket, copies)]；分給各台後每台只開一條連線，沒送出的份數改派其他台
+
+        split 策略和 print_copies 一樣，每張票的份數拆給多台同時印。
+        回傳每張的 (沒送出的份數, 未確認的印表機或 None)；有未確認的份數時其餘份數不再改派，
+        等那台恢復後再補印
+        """
+        policy = policy or get_print_policy()
+        held = [None] * len(items)
+        remaining = [copies for _, copies in items]
+        pending = list(range(len(items)))
+        tried = set()
+        while pending:
+            if policy == "least_busy":
+                p = self.pick(policy, tried)
+                printers = [p] if p else []
+            else:
+                printers = self._candidates(tried)
+            if not printers:
+                break
+            with self.lock:
+                self.rr += 1
+                start = self.rr
+            # parts[k] = 第 k 台要印的 [(票的索引, 份數)]
+            parts = [[] for _ in printers]
+            for n, idx in enumerate(pending):
+                if policy == "split":
+                    # 和 print_copies 相同的拆法，起點輪替讓零頭平均落在各台
+                    used = min(remaining[idx], len(printers))
+                    for i, share in enumerate(_split_shares(remaining[idx], used)):
+                        parts[(start + n + i) % len(printers)].append((idx, share))
+                else:
+                    parts[(start + n) % len(printers)].append((idx, remaining[idx]))
+            sessions = [(p, part) for p, part in zip(printers, parts) if part]
+            outcomes = {}
+
+            def run(p, part):
+                outcomes[p.key] = self._session_on(p, [(items[idx][0], share) for idx, share in part])
+
+            threads = [threading.Thread(target=run, args=sess) for sess in sessions[1:]]
+            for t in threads:
+                t.start()
+            run(*sessions[0])
+            for t in threads:
+                t.join()
+
+            for p, part in sessions:
+                sent, confirmed = outcomes[p.key]
+                for (idx, share), n in zip(part, sent):
+                    remaining[idx] -= n
+                    if n and not confirmed and held[idx] is None:
+                        held[idx] = p.key
+                    if n < share or not confirmed:
+                        tried.add(p.key)
+            pending = [idx for idx in pending if remaining[idx] and held[idx] is None]
+            if pending:
+                if len(tried) >= len(self.printers):
+                    break
+                PRINT_RETRIES.inc()
+                log_printer.warning("[列印改派] 批次中 %s 張改送其他印表機", len(pending))
+        return list(zip(remaining, held))
+
+    def printer_ok(self, key: str):
+        """查單台即時狀態；設定裡已沒有這台時回傳 None"""
+        p = next((p for p in self.reload() if p.key == key), None)
+        return None if p is None else p.update_status()
+
+    def stats(self):
+        with self.lock:
+            return [p.stats() for p in self.printers.values()]
+
+
+PRINTER_POOL = PrinterPool()
+
+
+# ---------------- 票面渲染服務 ----------------
+# 合成 + 二值化 + 打包是純 CPU，執行緒會互搶 GIL；改交給子行程池才吃得到 Pi 的多核心。
+# 子行程用 spawn 啟動，不 fork 帶著監控/日誌執行緒與鎖的主行程；回傳的是打包好的 raster。
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(max(1, (os.cpu_count() or 1) - 1))))   # 0=不開子行程
+RENDER_THREADS = 4        # RENDER_WORKERS=0 時合成票面的執行緒數
+
+
+class RenderService:
+    """(號碼, 等候人數, 預估分鐘) → {印表機寬度: (raster, width_bytes, height)}"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def _pool(self):
+        with self.lock:
+            if self.executor is None:
+                if self.workers > 0:
+                    self.executor = ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context("spawn"),
+                        initializer=ticket_render.init_worker, initargs=(PRINT_BG_FILE,))
+                else:
+                    self.executor = ThreadPoolExecutor(RENDER_THREADS)
+            return self.executor
+
+    def _reset(self, executor):
+        # 子行程被 OOM 砍掉時整個池會變成 broken，換一個新的
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+        log_printer.warning("[票面渲染] 子行程池異常，重新建立")
+
+    def start(self):
+        """啟動時先把子行程拉起來並載好字體與背景，第一批票不用等 spawn"""
+        pool = self._pool()
+        if self.workers > 0:
+            for f in [pool.submit(ticket_render.init_worker, PRINT_BG_FILE) for _ in range(self.workers)]:
+                f.result()
+        log_printer.info("[票面渲染] %s", f"{self.workers} 個子行程" if self.workers else "本行程執行緒")
+
+    def submit(self, number: int, waiting: int, widths=None, eta=None):
+        template = {"bg": PRINT_BG_FILE, "qr": get_qr_url_template()}
+        widths = tuple(widths or PRINTER_POOL.widths())
+        pool = self._pool()
+        t0 = time.perf_counter()
+        try:
+            fut = pool.submit(ticket_render.render_rasters, number, waiting, template, widths, eta)
+        except BrokenProcessPool:
+            self._reset(pool)
+            pool = self._pool()
+            fut = pool.submit(ticket_render.render_rasters, number, waiting, template, widths, eta)
+
+        def done(f):
+            if isinstance(f.exception(), BrokenProcessPool):
+                self._reset(pool)
+            else:
+                RENDER_TIME.observe(time.perf_counter() - t0)
+        fut.add_done_callback(done)
+        return fut
 
-    # 號碼置中
-    draw_centered_text(draw, str(number), f_big, 140, fill=(255, 255, 255), canvas_width=W)
 
-    # 等候人數置中
-    draw_centered_text(draw, f"目前 {waiting} 人等候中", f_mid, 290, fill=(0, 0, 0), canvas_width=W)
+RENDERER = RenderService(RENDER_WORKERS)
 
-    # QR code 底部留白
-    qr = build_qr_img(number, waiting)
-    qr_size = int(W * 0.45)  # 保持原本尺寸
-    qr = qr.resize((qr_size, qr_size), Image.LANCZOS)
-    qr_x = (W - qr_size) // 2
-    qr_y = H - qr_size - 100  # 保持原本位置
-    canvas.paste(qr, (qr_x, qr_y), qr)
 
-    out_path = os.path.join(PRINT_FOLDER, f"ticket_{number}.png")
-    canvas.save(out_path, "PNG")
-    return out_path
+# ---------------- 列印佇列 ----------------
+PRINT_QUEUE_FILE = os.path.join(PRINT_FOLDER, "print_queue.json")
+BATCH_MAX = 10            # 一次連線最多連印幾張
 
 
+class PrintJobQueue:
+    """持久化的列印佇列：印表機異常時暫停，恢復後續印；確認印出才寫入 printed.log"""
 
+    def __init__(self, path: str):
+        self.path = path
+        self.cond = threading.Condition()
+        self.jobs = []            # create_app() 時由 load() 接回上次沒印完的票
+        self.paused = ""
+        self.thread = None
+        self.generation = 0       # 號碼重置時 +1，避免把舊號碼記進新一輪
 
-# ---------------- 影像 → ESC/POS (GS v 0) ----------------
-def _img_to_1bpp(img: Image.Image, target_width=PRINTER_MAX_DOTS, high_quality=False) -> Image.Image:
-    # 轉寬度到印表機最大，等比縮放；二值化成黑白
-    w, h = img.size
-    if w != target_width:
-        nh = int(h * (target_width / w))
-        img = img.resize((target_width, nh), Image.LANCZOS)
-    
-    # 高品質模式：保持原本尺寸，只優化處理參數
-    if high_quality:
-        # 不進行尺寸調整，只優化處理參數
-        pass
-    
-    img = img.convert("L")
-    
-    # 改善二值化處理：使用更寬鬆的閾值，並加入銳化處理
-    # 先進行銳化處理
-    from PIL import ImageEnhance
-    enhancer = ImageEnhance.Sharpness(img)
-    img = enhancer.enhance(1.5)  # 銳化 1.5 倍
-    
-    # 使用更寬鬆的閾值，並加入抖動處理
-    if high_quality:
-        threshold = 105  # 高品質模式使用更寬鬆的閾值
-    else:
-        threshold = 110  # 標準模式
-    
-    img = img.point(lambda x: 0 if x < threshold else 255, '1')
-    
-    return img  # mode '1'
-
-def _pack_bits_raster(img_1b: Image.Image) -> bytes:
-    # 依 GS v 0 Raster 格式（每列打包成 bytes）
-    w, h = img_1b.size
-    width_bytes = (w + 7) // 8
-    out = bytearray(width_bytes * h)
-    px = img_1b.load()
-    o = 0
-    for y in range(h):
-        for xb in range(width_bytes):
-            b = 0
-            for bit in range(8):
-                x = xb * 8 + bit
-                if x < w:
-                    # mode '1'：黑=0，白=255；黑點要印 → bit=1
-                    if px[x, y] == 0:
-                        b |= (1 << (7 - bit))
-            out[o] = b
-            o += 1
-    return bytes(out), width_bytes, h
-
-def _send_escpos_raster(ip: str, img: Image.Image):
-    """使用 GS v 0 raster bit image 列印 (相容 XPrinter 58mm)"""
-    try:
-        target_width = 384
-        w, h = img.size
-        if w != target_width:
-            nh = int(h * (target_width / w))
-            img = img.resize((target_width, nh), Image.LANCZOS)
-
-        # 黑白化
-        img = img.convert("L")
-        img = img.point(lambda x: 0 if x < 128 else 255, '1')
-
-        px = img.load()
-        width_bytes = target_width // 8
-        height = h
-
-        # 打包像素
-        raster = bytearray()
-        for y in range(height):
-            for xb in range(width_bytes):
-                b = 0
-                for bit in range(8):
-                    x = xb * 8 + bit
-                    if px[x, y] == 0:
-                        b |= (1 << (7 - bit))
-                raster.append(b)
-
-        # ESC/POS 指令
-        init = b'\x1B\x40'            # 初始化
-        line_spacing = b'\x1B\x32'    # 標準行距
-        xL = width_bytes & 0xFF
-        xH = (width_bytes >> 8) & 0xFF
-        yL = height & 0xFF
-        yH = (height >> 8) & 0xFF
-        header = b'\x1D\x76\x30\x00' + bytes([xL, xH, yL, yH])  # GS v 0
-        feed_cut = b'\n\n\n' + b'\x1D\x56\x00'  # 走紙 + 切紙
-
-        # 傳送
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(10)
-            s.connect((ip, 9100))
-            s.sendall(init + line_spacing + header + raster + feed_cut)
-            return True
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return [j for j in json.load(f) if isinstance(j, dict) and "number" in j]
+        except (OSError, ValueError):
+            return []
+
+    def load(self):
+        """讀回佇列檔；之前已經送進來的票排在後面"""
+        saved = self._load()
+        with self.cond:
+            numbers = {j["number"] for j in saved}
+            self.jobs = saved + [j for j in self.jobs if j["number"] not in numbers]
+            PRINT_QUEUE.set(len(self.jobs))
+
+    def _save(self):
+        atomic_write(self.path, json.dumps(self.jobs))
+        PRINT_QUEUE.set(len(self.jobs))
+
+    def submit(self, number: int, waiting: int, count: int = None) -> bool:
+        with self.cond:
+            if has_printed(number) or any(j["number"] == number for j in self.jobs):
+                return False
+            # 預估等候在發號當下算好存進工作，重印/補印的票面都一樣
+            self.jobs.append({"number": number, "waiting": waiting, "count": count, "ts": time.time(),
+                              "eta": ticket_eta(waiting)})
+            self._save()
+            self.cond.notify()
+        return True
 
-    except Exception as e:
-        print(f"[GS v 0 列印失敗] {e}")
-        return False
+    def clear(self):
+        with self.cond:
+            if self.jobs:
+                log_printer.warning("[列印佇列] 號碼重置，丟棄未印出的 %s",
+                                    [j["number"] for j in self.jobs])
+            self.jobs = []
+            self.generation += 1
+            self._save()
+
+    def status(self):
+        with self.cond:
+            return {"paused": self.paused, "pending": [j["number"] for j in self.jobs],
+                    "unconfirmed": [{"number": j["number"], "printer": j["unconfirmed"],
+                                     "since": j.get("unconfirmed_ts"), "left": j.get("left", 0)}
+                                    for j in self.jobs if j.get("unconfirmed")]}
+
+    def _mark_printed(self, done):
+        # 去重紀錄與佇列都只寫一次；呼叫端持有 self.cond
+        PRINTED_NUMBERS.update(done)
+        save_printed_numbers(done)
+        JOURNAL.append("printed", numbers=done)
+        self.jobs = [j for j in self.jobs if j["number"] not in done]
+        self._save()
+
+    def _settle(self, job: dict):
+        """未確認的份數算已印出；還有沒送出的份數就只補印那幾份。呼叫端持有 self.cond"""
+        left = job.pop("left", 0)
+        job.pop("unconfirmed", None)
+        job.pop("unconfirmed_ts", None)
+        if left:
+            job["count"] = left
+            self._save()
+        else:
+            self._mark_printed([job["number"]])
+        return left
+
+    def resolve(self, number: int, action: str) -> bool:
+        """店員處理未確認的票：printed＝確認已印出（只補沒送出的份數）；reprint＝整張重新送印"""
+        with self.cond:
+            job = next((j for j in self.jobs if j["number"] == number and j.get("unconfirmed")), None)
+            if job is None:
+                return False
+            if action == "printed":
+                self._settle(job)
+            else:
+                for key in ("unconfirmed", "unconfirmed_ts", "left"):
+                    job.pop(key, None)
+                self._save()
+            self.cond.notify()
+        log_printer.info("[列印未確認] %s 由店員處理：%s", number, action, extra={"number": number})
+        return True
 
+    def _check_unconfirmed(self, held):
+        """未確認的票所在印表機恢復正常時，資料已在它的緩衝區裡，視為已印出（不重印）"""
+        recovered = [j["number"] for j in held if PRINTER_POOL.printer_ok(j["unconfirmed"])]
+        if not recovered:
+            return
+        with self.cond:
+            refill = {j["number"]: self._settle(j) for j in self.jobs if j["number"] in recovered}
+        log_printer.warning("[列印未確認] %s 的印表機已恢復，視為已印出（未重印），請現場確認；補印份數 %s",
+                            recovered, {n: c for n, c in refill.items() if c}, extra={"numbers": recovered})
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        checked = 0.0
+        while True:
+            with self.cond:
+                # 只剩未確認的票時也照常等，不會空轉
+                if all(j.get("unconfirmed") for j in self.jobs):
+                    self.cond.wait(PRINTER_STATUS_INTERVAL)
+                held = [dict(j) for j in self.jobs if j.get("unconfirmed")]
+                batch = [dict(j) for j in self.jobs if not j.get("unconfirmed")][:BATCH_MAX]
+                generation = self.generation
+
+            # 未確認的票只卡住它自己，其他票照樣派給正常的印表機
+            if held and time.time() - checked >= PRINTER_STATUS_INTERVAL:
+                checked = time.time()
+                self._check_unconfirmed(held)
+
+            if not batch:
+                # 閒置時順便更新印表機狀態（/api/printers、/metrics 用）
+                PRINTER_POOL.refresh_status()
+                continue
 
+            if not PRINTER_POOL.refresh_status():
+                if not self.paused:
+                    log_printer.warning("[列印佇列] 印表機異常，暫停列印（待印 %s 張）", len(self.jobs))
+                self.paused = "printer unavailable"
+                time.sleep(PRINTER_STATUS_INTERVAL)
+                continue
+            if self.paused:
+                log_printer.info("[列印佇列] 印表機恢復，繼續列印")
+                self.paused = ""
 
+            results = print_batch(batch)
+            with self.cond:
+                if generation != self.generation:
+                    continue
+                done = [n for n, (_, left, printer) in results.items() if not left and printer is None]
+                if done:
+                    self._mark_printed(done)
+                for j in self.jobs:
+                    if j["number"] not in results or j["number"] in done:
+                        continue
+                    copies, left, printer = results[j["number"]]
+                    if printer:
+                        # 留在佇列裡但不再送印，等那台恢復或店員處理；沒送出的份數記在 left
+                        j.update(unconfirmed=printer, unconfirmed_ts=time.time(), left=left, count=copies)
+                    elif left < copies:
+                        j["count"] = left          # 已印出的份數不再重印
+                self._save()
+            if any(left for _, left, printer in results.values() if printer is None):
+                PRINT_RETRIES.inc()
+                self.paused = "print failed"
+                time.sleep(PRINTER_STATUS_INTERVAL)
+
+
+def render_ticket(number: int, waiting: int, eta=None) -> dict:
+    return RENDERER.submit(number, waiting, eta=eta).result()
+
+def print_batch(jobs):
+    """一批號碼：平行合成票面，每台印表機一條連線連續印完
+
+    回傳 {號碼: (這次要印的份數, 沒送出的份數, 未確認的印表機或 None)}
+    """
+    if not jobs:
+        return {}
+    futures = [RENDERER.submit(j["number"], j["waiting"], eta=j.get("eta")) for j in jobs]
+    items, owners, out = [], [], {}
+    for job, fut in zip(jobs, futures):
+        copies = job.get("count") or get_print_count()
+        try:
+            items.append((fut.result(), copies))
+            owners.append(job["number"])
+        except Exception as e:
+            PRINT_FAILURES.inc()
+            log_printer.error("[票面合成失敗] %s %s", job["number"], e, extra={"number": job["number"]})
+            out[job["number"]] = (copies, copies, None)
+
+    for n, (_, copies), (left, printer) in zip(owners, items, PRINTER_POOL.print_batch(items)):
+        out[n] = (copies, left, printer)
+    done = [n for n, (_, left, printer) in out.items() if not left and printer is None]
+    if done:
+        log_printer.info("[列印成功] %s", done, extra={"numbers": done})
+    unconfirmed = {n: printer for n, (_, _, printer) in out.items() if printer}
+    if unconfirmed:
+        log_printer.error("[列印未確認] %s 已送出但狀態確認失敗，不改派", unconfirmed,
+                          extra={"numbers": list(unconfirmed)})
+    failed = {n: left for n, (_, left, printer) in out.items() if left and printer is None}
+    if failed:
+        log_printer.error("[列印失敗] %s（號碼: 沒印出的份數）", failed, extra={"numbers": list(failed)})
+    return out
 
 def print_ticket(number: int, waiting: int, count: int = None):
-    """合成票面 → 送到 XPrinter (9100)"""
+    """合成票面 → 送到 XPrinter (9100)；成功回傳 True"""
     if count is None:
         count = get_print_count()
     
     try:
-        ip = get_printer_ip()
-        img_path = compose_ticket_image(number, waiting)
-        img = Image.open(img_path)
-        
-        # 列印指定張數
-        for i in range(count):
-            success = _send_escpos_raster(ip, img)
-            if not success:
-                print(f"[列印失敗] {number}")
-                return
-            
-            if i < count - 1:
-                time.sleep(0.5)
+        ticket = render_ticket(number, waiting, ticket_eta(waiting))
+
+        # 列印指定張數（多台時依 print_policy.txt 分派）
+        if not PRINTER_POOL.print_copies(ticket, count):
+            log_printer.error("[列印失敗] %s", number, extra={"number": number})
+            return False
         
-        print(f"[列印成功] {number} x{count}張")
+        log_printer.info("[列印成功] %s x%s張", number, count, extra={"number": number, "count": count})
+        return True
 
     except Exception as e:
-        print("[列印失敗]", e)
+        PRINT_FAILURES.inc()
+        log_printer.error("[列印失敗] %s", e, extra={"number": number})
+        return False
 
-def _test_printer_connection(ip: str):
+def _test_printer_connection(ip: str, port: int = None):
     """測試印表機連線和基本功能"""
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(5)
-            s.connect((ip, 9100))
-            
-            # 發送簡單的測試指令
-            test_command = b'\x1B\x40' + b'\x1B\x32' + b'Test Print\n\n\n' + b'\x1D\x56\x00'
-            s.sendall(test_command)
-            
-            print(f"[印表機測試] 連線成功，發送測試指令")
-            return True
-            
+        # 發送簡單的測試指令
+        test_command = b'\x1B\x40' + b'\x1B\x32' + b'Test Print\n\n\n' + b'\x1D\x56\x00'
+        PRINTER_BACKEND.send(ip, port or PRINTER_PORT, test_command, timeout=5)
+
+        log_printer.info("[印表機測試] 連線成功，發送測試指令", extra={"printer": ip})
+        return True
+
     except Exception as e:
-        print(f"[印表機測試] 連線失敗: {e}")
+        log_printer.error("[印表機測試] 連線失敗: %s", e, extra={"printer": ip})
         return False
 
+def _query_printer_status(ip: str, port: int = None, timeout: float = 2.0):
+    """用 DLE EOT 1/2/4 即時狀態查詢；印表機不回應時回傳 None（狀態未知）"""
+    try:
+        reply = PRINTER_BACKEND.query(ip, port or PRINTER_PORT, STATUS_QUERY, 3, timeout)
+    except TimeoutError:
+        return None
+    except OSError as e:
+        return {"online": False, "problem": f"unreachable: {e}"}
+    return parse_status(reply)
+
 # ---------------- Ads ----------------
 def get_ads():
     files = [f for f in os.listdir(ADS_FOLDER) if f.lower().endswith(".mp4")]
@@ -384,8 +1194,41 @@ def get_ads():
     return files
 
 def save_order(files):
-    with open(ORDER_FILE, "w") as f:
-        f.write("\n".join(files))
+    atomic_write(ORDER_FILE, "\n".join(files))
+
+# 內容雜湊只在檔案大小或 mtime 變了才重算，數十 MB 的影片不會每次都讀一遍
+_AD_HASHES = {}               # 檔名 → (大小, mtime_ns, 雜湊)
+_AD_HASH_LOCK = threading.Lock()
+
+def ad_hash(name: str) -> str:
+    path = os.path.join(ADS_FOLDER, name)
+    st = os.stat(path)
+    with _AD_HASH_LOCK:
+        hit = _AD_HASHES.get(name)
+        if hit and hit[:2] == (st.st_size, st.st_mtime_ns):
+            return hit[2]
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()[:16]
+        _AD_HASHES[name] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+def ads_manifest():
+    """顯示端的廣告清單：每支影片的網址帶內容雜湊，內容沒變網址就不變，
+    Service Worker 只重新下載雜湊變了的檔；version 是整份清單（含靜音設定）的雜湊"""
+    items = []
+    for f in get_ads():
+        try:
+            digest = ad_hash(f)
+            size = os.path.getsize(os.path.join(ADS_FOLDER, f))
+        except OSError:
+            continue          # 剛好被刪除
+        items.append({"name": f, "url": f"/static/ads/{f}?v={digest}", "hash": digest, "size": size})
+    muted = get_muted()
+    version = hashlib.sha1(json.dumps([items, muted]).encode()).hexdigest()[:12]
+    return {"version": version, "ads": items, "muted": muted}
 
 # ---------------- 背景監控 ----------------
 PRINTED_FILE = os.path.join(PRINT_FOLDER, "printed.log")
@@ -400,6 +1243,10 @@ def save_printed_number(n: int):
     with open(PRINTED_FILE, "a") as f:
         f.write(f"{n}\n")
 
+def save_printed_numbers(numbers):
+    with open(PRINTED_FILE, "a") as f:
+        f.write("".join(f"{n}\n" for n in numbers))
+
 def has_printed(n: int) -> bool:
     """檢查號碼是否已經列印過"""
     if n in PRINTED_NUMBERS:
@@ -417,60 +1264,681 @@ def has_printed(n: int) -> bool:
     return False
 
 
-PRINTED_NUMBERS = load_printed_numbers()
+PRINTED_NUMBERS = set()          # create_app() 時從 printed.log 載入；has_printed 查不到也會再讀檔
 LAST_WAITING = set()
+PRINT_JOBS = PrintJobQueue(PRINT_QUEUE_FILE)
+
+# ---------------- 狀態日誌 ----------------
+JOURNAL_FILE      = os.path.join(PRINT_FOLDER, "journal.log")          # 上游快照與列印/語音/重置紀錄
+JOURNAL_CHECKPOINT = os.path.join(PRINT_FOLDER, "journal.ckpt.json")   # 壓縮後的狀態
+
+JOURNAL_FSYNC = Histogram("queuepad_journal_fsync_seconds", "狀態日誌一批寫入 + fsync 的時間")
+JOURNAL = Journal(JOURNAL_FILE, JOURNAL_CHECKPOINT,
+                  on_fsync=lambda n, secs: JOURNAL_FSYNC.observe(secs))
+
+# ---------------- 歷史統計 ----------------
+ANALYTICS_FILE = os.path.join(PRINT_FOLDER, "analytics.sqlite3")   # 發號/叫號時間與每小時彙總
+ANALYTICS_RAW_DAYS = int(os.getenv("ANALYTICS_RAW_DAYS", "90"))      # 單張號碼紀錄保留天數
+
+ANALYTICS_FLUSH = Histogram("queuepad_analytics_flush_seconds", "統計一批寫入 SQLite 的時間")
+ANALYTICS = AnalyticsStore(ANALYTICS_FILE, raw_days=ANALYTICS_RAW_DAYS, log=log_monitor,
+                           on_flush=lambda n, secs: ANALYTICS_FLUSH.observe(secs))
+
+# 票面的預估等候：最近 ETA_WINDOW 秒內的叫號速度，每次換號 O(1) 更新
+ETA_WINDOW = int(os.getenv("ETA_WINDOW", "1800"))
+ETA = WaitEstimator(window=ETA_WINDOW)
+
+def resume_from_journal():
+    """重播日誌接回 LAST_WAITING 與已印號碼；回傳還沒生成語音的等候號碼"""
+    global LAST_WAITING
+    t0 = time.perf_counter()
+    state = JOURNAL.recover()
+    LAST_WAITING = set(state["waiting"])
+    PRINTED_NUMBERS.update(state["printed"])
+    # 快照已記下、但還沒進列印佇列就斷電的號碼補送一次（submit 本身會去重）
+    # 離線時本機發的號碼一併補上
+    numbers = list(state["waiting"]) + [n for n in state["local_waiting"] if n not in state["waiting"]]
+    resubmitted = [n for n in numbers if PRINT_JOBS.submit(int(n), len(numbers))]
+    missing = [n for n in numbers if n not in state["audio_ready"]]
+    log_monitor.info("[日誌重播] %.1f ms，重播 %s 筆，等候 %s 人，補印 %s，補語音 %s",
+                     (time.perf_counter() - t0) * 1000, state["replayed"], len(state["waiting"]),
+                     resubmitted, missing, extra={"replayed": state["replayed"]})
+    # 叫到的號碼還沒有顯示端回報播出：/api/status 的 announced=False 會讓顯示頁重播
+    current = state["current"]
+    if current is not None and current not in state["announced"]:
+        log_monitor.info("[日誌重播] 目前號碼 %s 尚未播報，等顯示端重播", current, extra={"number": current})
+    return missing
+
+
+# ---------------- 監控核心 (asyncio) ----------------
+# 輪詢、送列印、gTTS、清音檔各自是一個 task，用 asyncio.Queue 串起來；
+# 任何一步慢（gTTS 卡住、上游延遲）都只卡自己那個 task，不會拖到下一次輪詢。
+# 阻塞呼叫（requests / gTTS / 檔案）丟到 to_thread，外面再包 wait_for 當逾時。
+POLL_INTERVAL   = 2       # 上游輪詢間隔（秒）
+POLL_TIMEOUT    = 5       # 單次輪詢含 JSON 解析的上限
+SUBMIT_TIMEOUT  = 5       # 寫入列印佇列的上限
+TTS_TIMEOUT     = 20      # 單個 gTTS 音檔的上限
+CLEANUP_TIMEOUT = 10      # 清音檔的上限
+AUDIO_MAX_AGE   = 86400   # 帶版本的 /api/speak 網址給瀏覽器快取的秒數
+OFFLINE_AFTER   = 10      # 連續這麼久輪詢不到上游就進入離線模式
+
+MONITOR_TIMEOUTS = Counter("queuepad_monitor_timeouts_total", "監控 task 逾時次數", ["task"])
+MONITOR_QUEUE    = Gauge("queuepad_monitor_queue_depth", "監控核心內部佇列長度", ["queue"])
+
+
+def fetch_upstream(source: str, timeout: float = 3):
+    """向上游後端取 (current, waiting)；current 為空時以 waiting 第一個代替"""
+    with POLL_LATENCY.time(source=source):
+        return UPSTREAM.fetch(timeout)
+
+
+class MonitorCore:
+    """在獨立執行緒裡跑的 asyncio 事件迴圈；HTTP 端點透過 call() 跨執行緒把工作丟進來"""
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.main_task = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.last_poll = None
+        self.last_error = ""
+        self.snapshot = None          # 最後一次成功輪詢的 {"current", "waiting", "ts"}
+        self.started = None
+
+    # ---- 對外（任何執行緒都可呼叫） ----
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._thread_main, name="monitor-core", daemon=True)
+            self.thread.start()
+            self.ready.wait(5)
+
+    def stop(self, timeout: float = 5):
+        if self.loop and self.main_task:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+        if self.thread:
+            self.thread.join(timeout)
+
+    def running(self):
+        return self.loop is not None and self.loop.is_running()
+
+    def call(self, coro_fn, *args, timeout: float = None):
+        """在事件迴圈裡執行 coro_fn(*args) 並等結果；逾時會取消該 coroutine"""
+        fut = asyncio.run_coroutine_threadsafe(coro_fn(*args), self.loop)
+        try:
+            return fut.result(timeout)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            raise
+
+    def fresh_snapshot(self, max_age: float = POLL_INTERVAL * 2 + POLL_TIMEOUT):
+        """夠新的輪詢結果；監控沒在跑或太舊時回傳 None（呼叫端自己問上游）"""
+        with self.lock:
+            snap = self.snapshot
+        if snap and time.time() - snap["ts"] <= max_age:
+            return snap
+        return None
+
+    def offline(self):
+        """監控在跑、但已超過 OFFLINE_AFTER 秒沒有成功輪詢到上游"""
+        with self.lock:
+            ref = self.last_poll or self.started
+        return self.running() and ref is not None and time.time() - ref > OFFLINE_AFTER
+
+    def status(self):
+        offline = self.offline()
+        with self.lock:
+            return {
+                "running": self.running(),
+                "offline": offline,
+                "last_poll": self.last_poll,
+                "last_error": self.last_error,
+                "tasks": {name: ("done" if t.done() else "running") for name, t in self.tasks.items()},
+                "queues": {"print": self.print_q.qsize(), "tts": self.tts_q.qsize(),
+                           "postprocess": self.post_q.qsize()} if self.running() else {},
+            }
+
+    # ---- 事件迴圈內 ----
+    def _thread_main(self):
+        try:
+            asyncio.run(self._main())
+        except asyncio.CancelledError:
+            pass
+        log_monitor.info("[監控核心] 已停止")
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        self.print_q = asyncio.Queue()
+        self.tts_q = asyncio.Queue()
+        self.post_q = asyncio.Queue()
+        self.keep = set()
+        self.cleanup_needed = asyncio.Event()
+        self.audio_jobs = {}          # 號碼 → 生成中的 Task，監控與 /api/speak 共用同一個
+        self.started = time.time()
+        # 從統計接回最近的叫號速度，補印的票也有預估等候
+        try:
+            ETA.seed(await asyncio.to_thread(ANALYTICS.recent_calls, time.time() - ETA_WINDOW))
+        except Exception as e:
+            log_monitor.warning("[預估等候] 讀取最近叫號失敗 %r", e)
+        # 從日誌接續上次的狀態：重開機後已看過的號碼不會被當成新號碼
+        for n in await asyncio.to_thread(resume_from_journal):
+            self.tts_q.put_nowait(n)
+        with self.lock:
+            self.tasks = {
+                "poll": asyncio.create_task(self._supervise("poll", self._poll_loop)),
+                "print": asyncio.create_task(self._supervise("print", self._print_loop)),
+                "tts": asyncio.create_task(self._supervise("tts", self._tts_loop)),
+                "cleanup": asyncio.create_task(self._supervise("cleanup", self._cleanup_loop)),
+                "postprocess": asyncio.create_task(self._supervise("postprocess", self._postprocess_loop)),
+            }
+        self.ready.set()
+        log_monitor.info("[監控核心] 已啟動")
+        try:
+            await asyncio.gather(*self.tasks.values())
+        finally:
+            for t in self.tasks.values():
+                t.cancel()
+
+    async def _supervise(self, name, loop_fn):
+        """task 內未預期的例外只記錄並重啟該 task，不影響其他 task"""
+        while True:
+            try:
+                await loop_fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_monitor.exception("[監控核心] %s task 例外，1 秒後重啟: %s", name, e)
+                await asyncio.sleep(1)
 
-def monitor_waiting():
-    global LAST_WAITING, PRINTED_NUMBERS
-
-    while True:
+    async def _blocking(self, task: str, timeout: float, fn, *args):
         try:
-            # 使用可設定的伺服器網址
-            server_url = get_server_url()
-            r = requests.get(server_url, timeout=3)
-            data = r.json()
-            waiting = data.get("waiting", []) or []
-            current = data.get("current")
-            # === 偵測從 1 開始 ===
-            if waiting and min(waiting) == 1:
-                clear_logs_and_prints()
-
-            if current is None and waiting:
-                current = waiting[0]
-
-            keep_numbers = set(waiting)
-            if current is not None:
-                keep_numbers.add(current)
-
-            new_numbers = set(waiting) - LAST_WAITING
-
-            # === 列印新號碼 (一定要查 log) ===
-            for n in sorted(new_numbers):
-                if not has_printed(int(n)):
-                    try:
-                        print_ticket(int(n), len(waiting))
-                        PRINTED_NUMBERS.add(n)
-                        save_printed_number(n)   # 寫入 log
-                    except Exception as e:
-                        print("[列印新號碼失敗]", n, e)
-
-            # === 生成語音 ===
-            for n in sorted(new_numbers):
+            return await asyncio.wait_for(asyncio.to_thread(fn, *args), timeout)
+        except asyncio.TimeoutError:
+            MONITOR_TIMEOUTS.inc(task=task)
+            raise
+
+    async def _poll_loop(self):
+        global LAST_WAITING
+        last_payload = last_journaled = offline_since = last_current = None
+        while True:
+            t0 = self.loop.time()
+            try:
+                current, waiting = await self._blocking("poll", POLL_TIMEOUT, fetch_upstream, "monitor")
+                WAITING_LEN.set(len(waiting))
+                # === 偵測從 1 開始 ===
+                # 只在 1 號「新出現」時重置；重開機後 LAST_WAITING 由日誌接回，不會重複清除
+                if waiting and min(waiting) == 1 and 1 not in LAST_WAITING:
+                    await asyncio.to_thread(reset_numbers)
+                    LAST_WAITING = set()
+
+                # 上游恢復：本機發的號碼出現在上游清單裡，表示店員已在上游補登，改由上游接手
+                local = JOURNAL.snapshot()
+                adopted = [n for n in local["local_waiting"] if n in waiting or n == current]
+                if adopted:
+                    JOURNAL.append("adopted", numbers=adopted)
+                if offline_since is not None:
+                    log_monitor.info("[離線模式] 上游恢復（離線 %.0f 秒），上游接手 %s，本機仍等候 %s",
+                                     time.time() - offline_since, adopted,
+                                     [n for n in local["local_waiting"] if n not in adopted],
+                                     extra={"adopted": adopted})
+                    offline_since = None
+
+                keep_numbers = set(waiting) | set(local["local_waiting"])
+                if current is not None:
+                    keep_numbers.add(current)
+                if local["local_current"] is not None:
+                    keep_numbers.add(local["local_current"])
+
+                new_numbers = sorted(set(waiting) - LAST_WAITING)
+                # 列印排在語音前面：兩個佇列各自消化，gTTS 慢不會拖到出單
+                for n in new_numbers:
+                    self.print_q.put_nowait((int(n), len(waiting)))
+                for n in new_numbers:
+                    self.tts_q.put_nowait(int(n))
+                # 統計只記進記憶體，背景批次寫入 SQLite
+                for n in new_numbers:
+                    ANALYTICS.record_issued(n)
+                if current is not None and current != last_current:
+                    ANALYTICS.record_called(current)
+                    if last_current is not None:      # 啟動後第一次看到的不是換號
+                        ETA.observe()
+                last_current = current
+                MONITOR_QUEUE.set(self.print_q.qsize(), queue="print")
+                MONITOR_QUEUE.set(self.tts_q.qsize(), queue="tts")
+
+                self.keep = keep_numbers
+                self.cleanup_needed.set()
+                if (current, sorted(waiting)) != last_journaled:
+                    last_journaled = (current, sorted(waiting))
+                    JOURNAL.append("snapshot", current=current, waiting=list(waiting))
+                LAST_WAITING = set(waiting)
+                with self.lock:
+                    self.last_poll = time.time()
+                    self.last_error = ""
+                    self.snapshot = {"current": current, "waiting": list(waiting), "ts": self.last_poll}
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(source="monitor")
+                log_monitor.warning("[監控錯誤] %r", e)
+                with self.lock:
+                    self.last_error = repr(e)
+                if offline_since is None and self.offline():
+                    offline_since = self.last_poll or self.started
+                    log_monitor.warning("[離線模式] 上游 %d 秒無回應，改用最後已知狀態，可用本機發號",
+                                        OFFLINE_AFTER)
+            # 狀態或音檔清單有變才推播給顯示端（離線時推一次 stale 狀態）
+            try:
+                payload = await asyncio.to_thread(display_state, self.offline())
+                if payload != last_payload:
+                    last_payload = payload
+                    EVENTS.publish("status", payload)
+            except Exception as e:
+                log_monitor.warning("[推播狀態失敗] %r", e)
+            await asyncio.sleep(max(0.0, POLL_INTERVAL - (self.loop.time() - t0)))
+
+    async def _print_loop(self):
+        # === 列印新號碼：交給列印佇列（確認印出後才寫入 log） ===
+        while True:
+            n, waiting_len = await self.print_q.get()
+            MONITOR_QUEUE.set(self.print_q.qsize(), queue="print")
+            try:
+                await self._blocking("print", SUBMIT_TIMEOUT, PRINT_JOBS.submit, n, waiting_len)
+            except Exception as e:
+                log_monitor.error("[列印新號碼失敗] %s %r", n, e, extra={"number": n})
+
+    async def _tts_loop(self):
+        # === 生成語音 ===
+        while True:
+            n = await self.tts_q.get()
+            MONITOR_QUEUE.set(self.tts_q.qsize(), queue="tts")
+            try:
+                await self.ensure_audio(n)
+            except Exception as e:
+                log_tts.error("[生成語音失敗] %s %r", n, e, extra={"number": n})
+
+    async def ensure_audio(self, n: int) -> str:
+        """確保 n 的音檔存在並回傳路徑；同一個號碼同時只會呼叫一次 gTTS"""
+        path = audio_path(n)
+        if path:
+            return path
+        job = self.audio_jobs.get(n)
+        if job is None:
+            CACHE_MISSES.inc(cache="audio")
+            path = os.path.join(AUDIO_FOLDER, f"{n}.mp3")
+            job = asyncio.create_task(self._blocking("tts", TTS_TIMEOUT, generate_audio, n, path))
+            self.audio_jobs[n] = job
+
+            def generated(t):
+                self.audio_jobs.pop(n, None)
+                if not t.cancelled() and t.exception() is None:
+                    self.post_q.put_nowait(n)
+                    JOURNAL.append("audio_ready", number=n)
+            job.add_done_callback(generated)
+        # shield：呼叫端逾時被取消時，不要連帶取消共用的生成工作
+        await asyncio.shield(job)
+        return audio_path(n)
+
+    async def _postprocess_loop(self):
+        # 啟動時把還沒處理過的舊音檔補做一次
+        for f in sorted(os.listdir(AUDIO_FOLDER)):
+            stem, ext = os.path.splitext(f)
+            if ext == ".mp3" and stem.isdigit() and not audio_processed(os.path.join(AUDIO_FOLDER, f)):
+                self.post_q.put_nowait(int(stem))
+        while True:
+            n = await self.post_q.get()
+            MONITOR_QUEUE.set(self.post_q.qsize(), queue="postprocess")
+            if not (AUDIO_POSTPROCESS and AUDIO_FFMPEG):
+                continue
+            try:
+                await self._blocking("postprocess", AUDIO_POST_TIMEOUT + 5, postprocess_audio, n)
+            except Exception as e:
+                log_tts.warning("[音檔後處理失敗] %s %r", n, e, extra={"number": n})
+
+    async def _cleanup_loop(self):
+        last_quota = 0.0
+        while True:
+            await self.cleanup_needed.wait()
+            self.cleanup_needed.clear()
+            keep = set(self.keep) | set(self.audio_jobs)
+            try:
+                await self._blocking("cleanup", CLEANUP_TIMEOUT, cleanup_audio, keep)
+            except Exception as e:
+                log_tts.warning("[清理音檔失敗] %r", e)
+            # 配額檢查不用每次輪詢都做
+            if self.loop.time() - last_quota >= STORAGE_INTERVAL:
+                last_quota = self.loop.time()
                 try:
-                    path = os.path.join(AUDIO_FOLDER, f"{n}.mp3")
-                    if not os.path.exists(path):
-                        generate_audio(int(n), path)
+                    await self._blocking("cleanup", CLEANUP_TIMEOUT, STORAGE.enforce_all)
+                    await asyncio.to_thread(storage_report)
                 except Exception as e:
-                    print("[生成語音失敗]", n, e)
+                    log_ads.warning("[空間管理失敗] %r", e)
+
+
+MONITOR = MonitorCore()
+
 
-            cleanup_audio(keep_numbers)
-            LAST_WAITING = set(waiting)
+# ---------------- 多螢幕 (hub / edge) ----------------
+SSE_HEARTBEAT = 15        # 沒事件時送註解行保持連線（秒）
+EDGE_RETRY_MAX = 30       # edge 重連的最長間隔（秒）
 
+
+class EventBus:
+    """一對多推播：每個訂閱者一個有上限的 queue；新訂閱者先收到每種事件的最新一筆"""
+
+    def __init__(self, maxsize: int = 100):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.subscribers = set()
+        self.seq = 0
+        self.last = {}
+
+    def publish(self, event: str, data, sticky: bool = True):
+        """sticky=False 的事件（一次性指令）不會重播給之後才連上的訂閱者"""
+        with self.lock:
+            self.seq += 1
+            msg = (self.seq, event, data)
+            if sticky:
+                self.last[event] = msg
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                # 太慢的訂閱者直接斷線，重連時會拿到最新狀態
+                with self.lock:
+                    self.subscribers.discard(q)
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(None)
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.subscribers)
+
+    def stream(self):
+        q = queue.Queue(self.maxsize)
+        with self.lock:
+            self.subscribers.add(q)
+            backlog = sorted(self.last.values())
+        try:
+            for msg in backlog:
+                yield self._format(msg)
+            while True:
+                try:
+                    msg = q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if msg is None:
+                    return
+                yield self._format(msg)
+        finally:
+            with self.lock:
+                self.subscribers.discard(q)
+
+    @staticmethod
+    def _format(msg):
+        seq, event, data = msg
+        return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+EVENTS = EventBus()
+
+
+def iter_sse(resp):
+    """把 SSE 回應拆成 (event, data)；data 以 JSON 解析"""
+    event, data = "message", []
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].lstrip())
+
+
+class EdgeMirror:
+    """edge 顯示端：訂閱 hub 的狀態串流，並把 hub 已生成的音檔鏡像到本機"""
+
+    def __init__(self, hub_url: str):
+        self.hub = hub_url
+        self.state = None
+        self.connected = False
+        self.last_event = None
+        self.last_error = ""
+        self.reconnects = 0
+        self.mirrored = 0
+        self.versions = {}        # 號碼 → hub 音檔網址（含版本）
+        self.lock = threading.Lock()
+        self.downloader = ThreadPoolExecutor(2)
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="edge-mirror", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        delay = 1
+        while True:
+            try:
+                with requests.get(f"{self.hub}/api/events", stream=True,
+                                  timeout=(5, SSE_HEARTBEAT * 2)) as r:
+                    r.raise_for_status()
+                    self.connected, delay = True, 1
+                    log_display.info("[edge] 已連上 hub %s", self.hub)
+                    for event, data in iter_sse(r):
+                        self.last_event = time.time()
+                        if event == "status":
+                            self._on_status(data)
+                        elif event == "control":
+                            EVENTS.publish("control", data, sticky=False)   # 轉給本機的顯示頁
+            except Exception as e:
+                self.last_error = repr(e)
+                UPSTREAM_ERRORS.inc(source="hub")
+            if self.connected:
+                log_display.warning("[edge] 與 hub 斷線：%s", self.last_error)
+            self.connected = False
+            self.reconnects += 1
+            time.sleep(delay)
+            delay = min(delay * 2, EDGE_RETRY_MAX)
+
+    def _on_status(self, data):
+        self.state = {"current": data.get("current"), "waiting": data.get("waiting") or [],
+                      "stale": bool(data.get("stale")), "since": data.get("since"), "ts": time.time()}
+        WAITING_LEN.set(len(self.state["waiting"]))
+        audio = data.get("audio") or {}
+        for n, url in audio.items():
+            with self.lock:
+                if self.versions.get(int(n)) == url:
+                    continue
+                self.versions[int(n)] = url
+            self.downloader.submit(self._download, int(n), url)
+        keep = set(self.state["waiting"]) | ({self.state["current"]} if self.state["current"] is not None else set())
+        with self.lock:
+            for n in [n for n in self.versions if n not in keep]:
+                del self.versions[n]
+        self.downloader.submit(cleanup_audio, keep)
+
+    def _download(self, n: int, url: str):
+        try:
+            r = requests.get(f"{self.hub}{url}", timeout=10)
+            r.raise_for_status()
+            ext = ".ogg" if "ogg" in r.headers.get("Content-Type", "") else ".mp3"
+            STORAGE.reserve("audio", len(r.content))
+            atomic_write(os.path.join(AUDIO_FOLDER, f"{n}{ext}"), r.content)
+            other = os.path.join(AUDIO_FOLDER, f"{n}{'.mp3' if ext == '.ogg' else '.ogg'}")
+            if os.path.exists(other):
+                os.remove(other)
+            self.mirrored += 1
         except Exception as e:
-            print("[監控錯誤]", e)
+            with self.lock:
+                self.versions.pop(n, None)      # 下次狀態推播再試
+            log_display.warning("[edge] 鏡像音檔失敗 %s %r", n, e, extra={"number": n})
+
+    def fetch_audio(self, n: int):
+        """本機還沒有這號的音檔時直接跟 hub 要（hub 端會即時生成）"""
+        self._download(n, f"/api/speak/{n}")
+        if not audio_path(n):
+            raise RuntimeError(f"hub 沒有 {n} 號音檔")
+
+    def stats(self):
+        return {"hub": self.hub, "connected": self.connected, "last_event": self.last_event,
+                "last_error": self.last_error, "reconnects": self.reconnects,
+                "mirrored_audio": self.mirrored}
 
+
+EDGE = EdgeMirror(HUB_URL)
+
+
+# ---------------- 顯示端控制 ----------------
+# 透過 /api/events 的 control 事件要顯示頁就地處理，不必對瀏覽器按 F5 或重開：
+#     reload  重新載入頁面（廣告由 Service Worker 快取，不會重新下載）
+#     ads     重新讀廣告清單與靜音設定，立刻換片
+#     status  重設畫面並重新取號碼狀態
+# 顯示頁收到後回 /api/display/ack（edge 會轉給 hub）。要求備援的指令在
+# CONTROL_ACK_TIMEOUT 秒內都沒有顯示頁回應時，才在背景重啟本機 Chromium。
+CONTROL_ACTIONS = ("reload", "ads", "status")
+CONTROL_ACK_TIMEOUT = float(os.getenv("CONTROL_ACK_TIMEOUT", "10"))
+CONTROL_KEEP = 50         # 保留最近幾筆指令的回應紀錄
+CHROMIUM_CMD = ["chromium-browser", "--kiosk", "--disable-web-security",
+                "--user-data-dir=/tmp/chromium-kiosk"]
+
+
+def restart_chromium():
+    """最後手段：結束並重新啟動本機 kiosk Chromium；會 sleep，只在背景執行緒呼叫"""
+    try:
+        if subprocess.run(["pgrep", "-f", "chromium"], capture_output=True, timeout=5).returncode != 0:
+            log_display.info("[Chromium 重啟] 本機沒有執行中的 Chromium，略過")
+            return False
+        subprocess.run(["pkill", "-f", "chromium"], capture_output=True, timeout=5)
         time.sleep(2)
+        subprocess.Popen(CHROMIUM_CMD, start_new_session=True,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.SubprocessError) as e:
+        log_display.error("[Chromium 重啟失敗] %r", e)
+        return False
+    log_display.info("[Chromium 重啟] 已重新啟動")
+    return True
+
+
+class DisplayControl:
+    """送出顯示端指令並記錄哪些顯示頁回應了"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acks = {}            # 指令 id → {"action", "sent", "acks": {display: 時間}}
+        self.displays = {}        # display → 最後一次回應時間
+        self.restarts = 0
+
+    def send(self, action: str, fallback: bool = False) -> str:
+        if action not in CONTROL_ACTIONS:
+            raise ValueError(f"未知的指令: {action}（可用: {', '.join(CONTROL_ACTIONS)}）")
+        cid = f"{int(time.time()):x}-{os.urandom(3).hex()}"    # hub 與 edge 各自發號也不會撞
+        with self.lock:
+            self.acks[cid] = {"action": action, "sent": time.time(), "acks": {}}
+            for old in list(self.acks)[:-CONTROL_KEEP]:
+                del self.acks[old]
+        EVENTS.publish("control", {"id": cid, "action": action}, sticky=False)
+        log_display.info("[顯示控制] 送出 %s (%s)，訂閱者 %d", action, cid, EVENTS.subscriber_count())
+        if fallback:
+            threading.Thread(target=self._fallback, args=(cid,), name="control-fallback",
+                             daemon=True).start()
+        return cid
+
+    def ack(self, cid: str, display: str) -> bool:
+        with self.lock:
+            now = time.time()
+            self.displays[display] = now
+            entry = self.acks.get(cid)
+            if entry is None:
+                return False
+            entry["acks"][display] = now
+            return True
 
+    def _fallback(self, cid: str):
+        time.sleep(CONTROL_ACK_TIMEOUT)
+        with self.lock:
+            acked = bool(self.acks.get(cid, {}).get("acks"))
+        if acked:
+            return
+        log_display.warning("[顯示控制] %s 在 %.0f 秒內沒有顯示頁回應，改為重啟 Chromium",
+                            cid, CONTROL_ACK_TIMEOUT)
+        if restart_chromium():
+            with self.lock:
+                self.restarts += 1
+
+    def stats(self):
+        with self.lock:
+            return {"displays": dict(self.displays), "restarts": self.restarts,
+                    "recent": {cid: {**e, "acks": dict(e["acks"])} for cid, e in self.acks.items()}}
+
+
+CONTROL = DisplayControl()
+
+
+# ---------------- 離線模式 ----------------
+# 上游連不上時顯示端改看最後已知狀態（stale=True），店員可用本機號段繼續發號/叫號；
+# 本機號碼從 LOCAL_ISSUE_START 起跳，避開上游號碼。上游恢復後，出現在上游清單裡的
+# 本機號碼由上游接手，其餘照樣併在等候清單裡，直到本機叫到為止。
+LOCAL_ISSUE_START = int(os.getenv("LOCAL_ISSUE_START", "900"))
+_LOCAL_LOCK = threading.Lock()
+
+
+def display_state(stale: bool = False, upstream=None):
+    """顯示端看到的狀態：上游（或日誌裡最後已知）狀態 + 本機發號"""
+    st = JOURNAL.snapshot()
+    current, waiting = upstream if upstream is not None else (st["current"], st["waiting"])
+    local = [n for n in st["local_waiting"] if n not in waiting]
+    # 本機叫號比上游最後一次換號還新時，顯示本機叫的號
+    if st["local_current"] is not None and (st["local_called_ts"] or 0) >= (st["current_ts"] or 0):
+        current = st["local_current"]
+    waiting = list(waiting) + local
+    return {"current": current, "waiting": waiting, "audio": _audio_manifest(current, waiting),
+            "announced": current is None or current in st["announced"],
+            "stale": stale, "since": st["ts"], "local": local}
+
+
+def local_issue(force: bool = False) -> int:
+    """本機發一個號：寫日誌、排列印、預先生成語音；上游正常時需 force"""
+    if not force and not MONITOR.offline():
+        raise RuntimeError("上游連線正常，請用上游發號（或加 force=1）")
+    with _LOCAL_LOCK:
+        st = JOURNAL.snapshot()
+        n = max(LOCAL_ISSUE_START, st["local_next"])
+        JOURNAL.append("issued", number=n)
+        JOURNAL.flush()
+    ANALYTICS.record_issued(n, source="local")
+    PRINT_JOBS.submit(n, len(st["waiting"]) + len(st["local_waiting"]) + 1)
+    if MONITOR.running():
+        MONITOR.loop.call_soon_threadsafe(MONITOR.tts_q.put_nowait, n)
+    log_monitor.info("[離線模式] 本機發號 %s", n, extra={"number": n})
+    return n
+
+
+def local_call(n: int = None) -> int:
+    """本機叫號：預設叫本機等候中最小的號碼"""
+    with _LOCAL_LOCK:
+        st = JOURNAL.snapshot()
+        if n is None:
+            if not st["local_waiting"]:
+                raise LookupError("本機沒有等候中的號碼")
+            n = min(st["local_waiting"])
+        JOURNAL.append("called", number=n)
+        JOURNAL.flush()
+    ANALYTICS.record_called(n, source="local")
+    ETA.observe()
+    if MONITOR.running():
+        MONITOR.loop.call_soon_threadsafe(MONITOR.tts_q.put_nowait, n)
+    log_monitor.info("[離線模式] 本機叫號 %s", n, extra={"number": n})
+    return n
 
 
 def clear_logs_and_prints():
@@ -484,107 +1952,81 @@ def clear_logs_and_prints():
                 os.remove(os.path.join(PRINT_FOLDER, f))
             except:
                 pass
-    print("[清理] 已清除 printed.log 和票面圖片")
+    log_monitor.info("[清理] 已清除 printed.log 和票面圖片")
     # 重置記憶體紀錄
     global PRINTED_NUMBERS
     PRINTED_NUMBERS = set()
 
 
+def reset_numbers():
+    """上游號碼從 1 重新開始：清列印紀錄，丟掉上一輪還沒印的票，日誌與統計換新一輪"""
+    clear_logs_and_prints()
+    PRINT_JOBS.clear()
+    JOURNAL.append("reset")
+    ANALYTICS.reset()
+
+
 # ---------------- API ----------------
 @app.route("/api/refresh")
 def api_refresh():
-    """控制樹莓派 Chromium 瀏覽器更新的 API"""
+    """要顯示畫面重新整理：經 /api/events 推送 reload 指令，立即回應；
+    沒有顯示頁回應時才在背景重啟 Chromium"""
+    action = request.args.get("action", "reload")
     try:
-        # 方法1: 使用 xdotool 發送 F5 鍵到 Chromium 視窗
-        import subprocess
-        
-        # 嘗試使用 xdotool 發送 F5 鍵到 Chromium
-        try:
-            # 查找 Chromium 視窗並發送 F5 鍵
-            subprocess.run([
-                "xdotool", "search", "--name", "Chromium", "key", "F5"
-            ], check=True, capture_output=True, timeout=5)
-            print("[Chromium 刷新] 使用 xdotool 發送 F5 鍵成功")
-            return jsonify({
-                "status": "success", 
-                "method": "xdotool_F5",
-                "message": "Chromium 已刷新 (F5)"
-            })
-        except subprocess.CalledProcessError:
-            print("[Chromium 刷新] xdotool 發送 F5 失敗，嘗試其他方法")
-        except FileNotFoundError:
-            print("[Chromium 刷新] xdotool 未安裝，嘗試其他方法")
-        
-        # 方法2: 使用 wmctrl 和 xdotool 組合
-        try:
-            # 先找到 Chromium 視窗，然後發送 F5
-            result = subprocess.run([
-                "wmctrl", "-l"
-            ], capture_output=True, text=True, timeout=5)
-            
-            if result.returncode == 0:
-                for line in result.stdout.split('\n'):
-                    if 'chromium' in line.lower() or 'chrome' in line.lower():
-                        # 提取視窗 ID
-                        window_id = line.split()[0]
-                        # 發送 F5 鍵到該視窗
-                        subprocess.run([
-                            "xdotool", "windowactivate", window_id, "key", "F5"
-                        ], check=True, capture_output=True, timeout=5)
-                        print(f"[Chromium 刷新] 使用 wmctrl + xdotool 成功，視窗 ID: {window_id}")
-                        return jsonify({
-                            "status": "success", 
-                            "method": "wmctrl_xdotool",
-                            "window_id": window_id,
-                            "message": "Chromium 已刷新 (F5)"
-                        })
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print("[Chromium 刷新] wmctrl 方法失敗")
-        
-        # 方法3: 使用 pkill 重啟 Chromium 進程
-        try:
-            # 檢查是否有 Chromium 進程在運行
-            result = subprocess.run([
-                "pgrep", "-f", "chromium"
-            ], capture_output=True, text=True, timeout=5)
-            
-            if result.returncode == 0:
-                # 殺死 Chromium 進程
-                subprocess.run([
-                    "pkill", "-f", "chromium"
-                ], check=True, capture_output=True, timeout=5)
-                
-                # 等待一下再重啟
-                import time
-                time.sleep(2)
-                
-                # 重啟 Chromium（假設在 kiosk 模式下運行）
-                subprocess.Popen([
-                    "chromium-browser", "--kiosk", "--disable-web-security", 
-                    "--user-data-dir=/tmp/chromium-kiosk"
-                ], start_new_session=True)
-                
-                print("[Chromium 刷新] 使用 pkill 重啟成功")
-                return jsonify({
-                    "status": "success", 
-                    "method": "pkill_restart",
-                    "message": "Chromium 已重啟"
-                })
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print("[Chromium 刷新] pkill 方法失敗")
-        
-        # 如果所有方法都失敗，返回錯誤
-        return jsonify({
-            "status": "error",
-            "message": "無法刷新 Chromium，請檢查系統環境"
-        }), 500
-        
-    except Exception as e:
-        print(f"[Chromium 刷新錯誤] {e}")
-        return jsonify({
-            "status": "error",
-            "message": f"刷新過程中發生錯誤: {str(e)}"
-        }), 500
+        cid = CONTROL.send(action, fallback=request.args.get("fallback", "1") != "0")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({
+        "status": "success",
+        "method": "sse",
+        "id": cid,
+        "subscribers": EVENTS.subscriber_count(),
+        "message": "已通知顯示畫面重新整理",
+    })
+
+@app.route("/api/display/control", methods=["GET", "POST"])
+def api_display_control():
+    """GET：各顯示頁最後回應時間與最近指令；POST：送出 reload / ads / status"""
+    if request.method == "GET":
+        return jsonify(CONTROL.stats())
+    if request.args.get("pw") != "yellowgirl":
+        return "Unauthorized", 403
+    body = request.get_json(silent=True) or {}
+    action = body.get("action") or request.args.get("action", "")
+    fallback = bool(body.get("fallback", request.args.get("fallback") == "1"))
+    try:
+        cid = CONTROL.send(action, fallback=fallback)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": True, "id": cid, "subscribers": EVENTS.subscriber_count()})
+
+@app.route("/api/display/ack", methods=["POST"])
+def api_display_ack():
+    """顯示頁收到 control 指令後回報 {id, display}"""
+    body = request.get_json(silent=True) or {}
+    cid = str(body.get("id", ""))
+    display = str(body.get("display") or request.remote_addr)[:64]
+    known = CONTROL.ack(cid, display)
+    if QUEUEPAD_ROLE == "edge" and not known:
+        # 指令來自 hub：回應也要讓 hub 知道，hub 才不會去重啟瀏覽器
+        EDGE.downloader.submit(requests.post, f"{EDGE.hub}/api/display/ack",
+                               json={"id": cid, "display": display}, timeout=5)
+    return jsonify({"ok": True})
+
+@app.route("/api/display/played", methods=["POST"])
+def api_display_played():
+    """顯示頁播完叫號語音後回報 {number, display}；日誌的 announced 只在這裡寫入"""
+    body = request.get_json(silent=True) or {}
+    try:
+        n = int(body.get("number"))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "number 必須是整數"}), 400
+    if QUEUEPAD_ROLE == "edge":
+        EDGE.downloader.submit(requests.post, f"{EDGE.hub}/api/display/played",
+                               json={"number": n, "display": body.get("display")}, timeout=5)
+    elif n not in JOURNAL.snapshot()["announced"]:
+        JOURNAL.append("announced", number=n)
+    return jsonify({"ok": True})
 
 @app.route("/api/close_chromium")
 def close_chromium():
@@ -608,7 +2050,7 @@ def close_chromium():
                     "pkill", "-f", "chromium"
                 ], check=True, capture_output=True, timeout=10)
                 
-                print(f"[Chromium 關閉] 成功關閉 {process_count} 個 Chromium 進程")
+                log_display.info("[Chromium 關閉] 成功關閉 %s 個 Chromium 進程", process_count)
                 return jsonify({
                     "status": "success",
                     "method": "pkill",
@@ -616,31 +2058,31 @@ def close_chromium():
                     "message": f"已關閉 {process_count} 個 Chromium 進程"
                 })
             else:
-                print("[Chromium 關閉] 沒有找到運行中的 Chromium 進程")
+                log_display.info("[Chromium 關閉] 沒有找到運行中的 Chromium 進程")
                 return jsonify({
                     "status": "info",
                     "message": "沒有運行中的 Chromium 進程"
                 })
                 
         except subprocess.CalledProcessError as e:
-            print(f"[Chromium 關閉] pkill 執行失敗: {e}")
+            log_display.warning("[Chromium 關閉] pkill 執行失敗: %s", e)
             # 嘗試使用 killall 作為備用方法
             try:
                 subprocess.run([
                     "killall", "chromium-browser"
                 ], check=True, capture_output=True, timeout=10)
                 
-                print("[Chromium 關閉] 使用 killall 成功關閉")
+                log_display.info("[Chromium 關閉] 使用 killall 成功關閉")
                 return jsonify({
                     "status": "success",
                     "method": "killall",
                     "message": "已關閉 Chromium 瀏覽器"
                 })
             except subprocess.CalledProcessError:
-                print("[Chromium 關閉] killall 也失敗")
+                log_display.error("[Chromium 關閉] killall 也失敗")
                 
         except FileNotFoundError:
-            print("[Chromium 關閉] 系統命令不可用")
+            log_display.error("[Chromium 關閉] 系統命令不可用")
             return jsonify({
                 "status": "error",
                 "message": "系統命令不可用，無法關閉 Chromium"
@@ -653,7 +2095,7 @@ def close_chromium():
         }), 500
         
     except Exception as e:
-        print(f"[Chromium 關閉錯誤] {e}")
+        log_display.error("[Chromium 關閉錯誤] %s", e)
         return jsonify({
             "status": "error",
             "message": f"關閉過程中發生錯誤: {str(e)}"
@@ -661,34 +2103,218 @@ def close_chromium():
 
 @app.route("/api/status")
 def status():
+    if QUEUEPAD_ROLE == "edge":
+        state = EDGE.state
+        if state is None:
+            return jsonify({"error": f"hub not connected: {EDGE.last_error}"}), 503
+        current, waiting = state["current"], state["waiting"]
+        return jsonify({"current": current, "waiting": waiting, "audio": _audio_manifest(current, waiting),
+                        "stale": state["stale"] or not EDGE.connected, "since": state["since"]})
+    # 監控核心在跑時一律用它的結果（離線時是最後已知狀態 + 本機發號），不必每個瀏覽器請求都打一次上游
+    if MONITOR.running():
+        return jsonify(display_state(stale=MONITOR.offline()))
     try:
-        # 使用可設定的伺服器網址
-        server_url = get_server_url()
-        r = requests.get(server_url, timeout=3)
-        data = r.json()
-        waiting = data.get("waiting", []) or []
-        current = data.get("current")
-        if current is None and waiting:
-            current = waiting[0]
-        return jsonify({"current": current, "waiting": waiting})
+        return jsonify(display_state(upstream=fetch_upstream("status")))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        UPSTREAM_ERRORS.inc(source="status")
+        if JOURNAL.snapshot()["ts"] is None:
+            return jsonify({"error": str(e)}), 500
+        return jsonify(display_state(stale=True))
+
+# ---- 顯示端畫面時間 ----
+DISPLAY_JANK_MS = 50
+DISPLAY_MAX = 16          # 最多分開記幾台；display 由前端自報，超過的併成 "other"，避免指標標籤無限增加
+DISPLAY_FRAMES = {}       # display → 最近一次回報的摘要
+
+@app.route("/api/display/frames", methods=["GET", "POST"])
+def api_display_frames():
+    """顯示端每 30 秒回報 requestAnimationFrame 間隔 (ms)；GET 看各台最近一次摘要"""
+    if request.method == "GET":
+        return jsonify(DISPLAY_FRAMES)
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"ok": False, "error": "body 必須是 JSON 物件"}), 400
+    display = re.sub(r"[^\w.:-]", "", str(data.get("display") or request.remote_addr or ""))[:40] or "unknown"
+    if display not in DISPLAY_FRAMES and len(DISPLAY_FRAMES) >= DISPLAY_MAX:
+        display = "other"
+    try:
+        samples = sorted(float(x) for x in (data.get("samples") or [])[:4000] if 0 < float(x) < 60000)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "invalid samples"}), 400
+    if not samples:
+        return jsonify({"ok": True, "frames": 0})
+    for ms in samples:
+        DISPLAY_FRAME_TIME.observe(ms / 1000, display=display)
+    jank = sum(1 for ms in samples if ms > DISPLAY_JANK_MS)
+    if jank:
+        DISPLAY_JANK.inc(jank, display=display, announcing=str(bool(data.get("announcing"))).lower())
+    p95 = samples[int(len(samples) * 0.95)]
+    DISPLAY_FRAMES[display] = {"frames": len(samples), "janky": jank, "p50_ms": samples[len(samples) // 2],
+                               "p95_ms": p95, "max_ms": samples[-1], "ts": time.time()}
+    if p95 > DISPLAY_JANK_MS:
+        log_display.warning("[畫面卡頓] %s p95 %.0f ms", display, p95,
+                            extra={"display": display, **DISPLAY_FRAMES[display]})
+    return jsonify({"ok": True, "frames": len(samples)})
+
+@app.route("/api/local/issue", methods=["POST"])
+def api_local_issue():
+    """離線時本機發號並出單"""
+    if request.args.get("pw") != "yellowgirl":
+        return "Unauthorized", 403
+    try:
+        n = local_issue(force=request.args.get("force") == "1")
+    except RuntimeError as e:
+        return jsonify({"ok": False, "error": str(e)}), 409
+    return jsonify({"ok": True, "number": n})
+
+@app.route("/api/local/call", methods=["POST"])
+def api_local_call():
+    """本機叫號；不帶 number 時叫本機等候中最小的號碼"""
+    if request.args.get("pw") != "yellowgirl":
+        return "Unauthorized", 403
+    number = request.args.get("number")
+    try:
+        n = local_call(int(number) if number else None)
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid number"}), 400
+    except LookupError as e:
+        return jsonify({"ok": False, "error": str(e)}), 409
+    return jsonify({"ok": True, "number": n})
+
+@app.route("/api/events")
+def api_events():
+    """SSE 事件串流；edge 顯示端與瀏覽器都可以訂閱"""
+    return Response(EVENTS.stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/fleet")
+def api_fleet():
+    """多螢幕角色與連線狀態"""
+    info = {"role": QUEUEPAD_ROLE, "subscribers": EVENTS.subscriber_count()}
+    if QUEUEPAD_ROLE == "edge":
+        info.update(EDGE.stats())
+    return jsonify(info)
+
+def _audio_manifest(current, waiting):
+    """目前號碼與等候中號碼已備好的音檔 {號碼: 網址}；顯示端據此預先下載"""
+    if not get_voice_enabled():
+        return {}
+    out = {}
+    for n in ([current] if current is not None else []) + list(waiting):
+        try:
+            url = audio_url(int(n))
+        except (TypeError, ValueError):
+            continue
+        if url:
+            out[str(n)] = url
+    return out
 
 @app.route("/api/speak/<number>")
 def speak(number):
+    with SPEAK_LATENCY.time():
+        return _speak(number)
+
+def _speak(number):
     if not get_voice_enabled():
         return jsonify({"error": "voice disabled"}), 403
     try:
         n = int(number)
     except:
         return jsonify({"error": "invalid number"}), 400
-    path = os.path.join(AUDIO_FOLDER, f"{n}.mp3")
-    if not os.path.exists(path):
+    if audio_path(n):
+        CACHE_HITS.inc(cache="audio")
+    else:
+        try:
+            # 即時補檔（避免 race）；監控核心已在生成同一號時直接等它那份
+            # 後處理不在這條路徑上：先回原始檔，處理好後網址版本會變，顯示端再重新預載
+            if QUEUEPAD_ROLE == "edge":
+                EDGE.fetch_audio(n)
+            elif MONITOR.running():
+                MONITOR.call(MONITOR.ensure_audio, n, timeout=TTS_TIMEOUT + 1)
+            else:
+                CACHE_MISSES.inc(cache="audio")
+                generate_audio(n, os.path.join(AUDIO_FOLDER, f"{n}.mp3"))
+        except Exception as e:
+            return jsonify({"error": f"TTS failed: {e!r}"}), 500
+    # 帶 ?v=版本 的網址內容不會變，讓瀏覽器長期快取；沒帶版本的照舊用 ETag 重新驗證
+    max_age = AUDIO_MAX_AGE if request.args.get("v") else None
+    for _ in range(2):
+        path = audio_path(n)
+        if path is None:
+            continue          # 剛好在新舊檔交換之間，重找一次
+        try:
+            return send_file(path, mimetype="audio/ogg" if path.endswith(".ogg") else "audio/mpeg",
+                             max_age=max_age)
+        except FileNotFoundError:
+            continue          # 剛好被後處理換成 .ogg，重找一次
+    return jsonify({"error": "audio missing"}), 404
+
+def audio_url(n: int):
+    """已生成音檔的可快取網址（版本取自 mtime + 大小）；還沒生成時回傳 None"""
+    try:
+        st = os.stat(audio_path(n))
+    except (OSError, TypeError):
+        return None
+    return f"/api/speak/{n}?v={st.st_mtime_ns // 1000000:x}-{st.st_size:x}"
+
+@app.route("/api/backends")
+def api_backends():
+    """目前使用的出單機 / 語音 / 上游後端與其統計"""
+    return jsonify(backends_report())
+
+@app.route("/api/upstream/webhook", methods=["POST"])
+def api_upstream_webhook():
+    """QUEUEPAD_UPSTREAM=webhook 時由上游推送 {current, waiting}"""
+    if request.args.get("pw") != "yellowgirl":
+        return "Unauthorized", 403
+    if not isinstance(UPSTREAM, queuepad.WebhookUpstream):
+        return jsonify({"ok": False, "error": f"upstream backend is {UPSTREAM.name}"}), 409
+    try:
+        UPSTREAM.push(request.get_json(force=True) or {})
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": True})
+
+@app.route("/api/storage")
+def api_storage():
+    """各資料夾用量、配額與整張卡剩餘空間"""
+    return jsonify(storage_report())
+
+@app.route("/api/monitor")
+def api_monitor():
+    """監控核心各 task 狀態、內部佇列長度與最後一次成功輪詢時間"""
+    return jsonify(MONITOR.status())
+
+@app.route("/api/analytics")
+def api_analytics():
+    """歷史統計：平均/p95 等候、每小時張數、尖峰時段
+    ?hours=N 或 ?days=N 往回看；?since=&until= 指定 unix 時間；預設今天 0 點起。?number=N 查單張"""
+    if QUEUEPAD_ROLE == "edge":
         try:
-            generate_audio(n, path)  # 即時補檔（避免 race）
+            r = requests.get(f"{HUB_URL}/api/analytics", params=request.args, timeout=5)
+            return Response(r.content, status=r.status_code, mimetype="application/json")
         except Exception as e:
-            return jsonify({"error": f"gTTS failed: {e}"}), 500
-    return send_file(path, mimetype="audio/mpeg")
+            return jsonify({"error": f"hub unreachable: {e!r}"}), 502
+    try:
+        if "number" in request.args:
+            return jsonify(ANALYTICS.ticket(int(request.args["number"])) or {"error": "not found"})
+        until = float(request.args.get("until") or time.time())
+        if request.args.get("since"):
+            since = float(request.args["since"])
+        elif request.args.get("hours") or request.args.get("days"):
+            since = until - float(request.args.get("hours") or 0) * 3600 \
+                          - float(request.args.get("days") or 0) * 86400
+        else:
+            lt = time.localtime(until)
+            since = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1))
+    except ValueError:
+        return jsonify({"error": "invalid range"}), 400
+    return jsonify(ANALYTICS.report(since, until) | {"eta": ETA.stats()})
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus 文字格式指標"""
+    return Response(render_all(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/api/ads")
 def api_ads():
@@ -698,6 +2324,76 @@ def api_ads():
 def api_muted():
     return {"muted": get_muted()}
 
+@app.route("/api/ads/manifest")
+def api_ads_manifest():
+    """廣告清單 + 內容雜湊 + 靜音設定，顯示端一次取得"""
+    resp = jsonify(ads_manifest())
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/sw.js")
+def service_worker():
+    """顯示端 Service Worker；要從根路徑提供，作用範圍才涵蓋 / 與 /api"""
+    resp = send_file(os.path.join(app.static_folder, "sw.js"), mimetype="application/javascript")
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/api/nv_logo", methods=["GET", "POST"])
+def api_nv_logo():
+    """NV 背景圖開關；開啟時立即上傳到所有印表機"""
+    if request.method == "POST":
+        if request.args.get("pw") != "yellowgirl":
+            return "Unauthorized", 403
+        enabled = bool((request.get_json(silent=True) or {}).get("enabled"))
+        set_nv_logo_enabled(enabled)
+        if enabled:
+            threading.Thread(target=nv_upload_all, daemon=True).start()
+    plan = _nv_bg_plan()
+    return jsonify({
+        "enabled": get_nv_logo_enabled(),
+        "hash": plan and plan["hash"],
+        "segments": plan and [[y0, y1, key.decode() if key else None] for y0, y1, key in plan["segments"]],
+        "printers": _nv_state(),
+    })
+
+@app.route("/api/printers", methods=["GET", "POST"])
+def api_printers():
+    """多台印表機狀態；POST 可更新 printers.txt 與分派策略"""
+    if request.method == "POST":
+        if request.args.get("pw") != "yellowgirl":
+            return "Unauthorized", 403
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"error": "body 必須是 JSON 物件"}), 400
+        if "policy" in data and data["policy"] not in PRINT_POLICIES:
+            return jsonify({"error": f"策略必須是 {', '.join(PRINT_POLICIES)}"}), 400
+        # 先全部驗證再寫檔，錯誤的請求不會只寫進一半
+        if "printers" in data:
+            try:
+                set_printers(data["printers"])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        if "policy" in data:
+            set_print_policy(data["policy"])
+    PRINTER_POOL.reload(force=request.method == "POST")
+    return jsonify({"policy": get_print_policy(), "printers": PRINTER_POOL.stats(),
+                    "queue": PRINT_JOBS.status()})
+
+@app.route("/api/print_queue/resolve", methods=["POST"])
+def api_print_queue_resolve():
+    """店員處理已送出但未確認的票：action=printed 確認已印出、reprint 重新送印"""
+    if request.args.get("pw") != "yellowgirl":
+        return "Unauthorized", 403
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "body 必須是 JSON 物件"}), 400
+    number, action = data.get("number"), data.get("action")
+    if not isinstance(number, int) or action not in ("printed", "reprint"):
+        return jsonify({"error": "需要 number 與 action（printed 或 reprint）"}), 400
+    if not PRINT_JOBS.resolve(number, action):
+        return jsonify({"error": "佇列裡沒有這張未確認的票"}), 404
+    return jsonify({"ok": True, "queue": PRINT_JOBS.status()})
+
 # （可選）後台測試列印
 @app.route("/api/print_test", methods=["POST"])
 def api_print_test():
@@ -711,9 +2407,7 @@ def api_print_test():
         else:
             count = get_print_count()
         
-        r = requests.get(get_server_url(), timeout=3)
-        data = r.json()
-        wlen = len(data.get("waiting", []) or [])
+        wlen = len(fetch_upstream("status")[1])
     except:
         wlen = 0
     
@@ -855,11 +2549,9 @@ def api_save_printer_ip():
 # 保存列印張數
 @app.route("/api/save_print_count", methods=["POST"])
 def api_save_print_count():
-    print(f"[DEBUG] 收到保存列印張數請求")
-    print(f"[DEBUG] 請求方法: {request.method}")
-    print(f"[DEBUG] 請求參數: {request.args}")
-    print(f"[DEBUG] 請求表單: {request.form}")
-    print(f"[DEBUG] 請求 JSON: {request.get_json(silent=True)}")
+    if log_printer.isEnabledFor(logging.DEBUG):
+        log_printer.debug("[列印張數] 收到保存請求 %s args=%s form=%s json=%s", request.method,
+                          dict(request.args), dict(request.form), request.get_json(silent=True))
     
     if request.args.get("pw") != "yellowgirl":
         return jsonify({"error": "未授權"}), 403
@@ -871,17 +2563,17 @@ def api_save_print_count():
         # 從 URL 參數獲取
         if request.args.get("print_count"):
             print_count = request.args.get("print_count")
-            print(f"[DEBUG] 從 URL 參數獲取: {print_count}")
+            log_printer.debug("[列印張數] 從 URL 參數獲取: %s", print_count)
         
         # 從表單數據獲取
         elif request.form.get("print_count"):
             print_count = request.form.get("print_count")
-            print(f"[DEBUG] 從表單數據獲取: {print_count}")
+            log_printer.debug("[列印張數] 從表單數據獲取: %s", print_count)
         
         # 從 JSON 獲取
         elif request.get_json(silent=True) and request.get_json().get("print_count"):
             print_count = request.get_json().get("print_count")
-            print(f"[DEBUG] 從 JSON 獲取: {print_count}")
+            log_printer.debug("[列印張數] 從 JSON 獲取: %s", print_count)
         
         if not print_count:
             return jsonify({"error": "缺少列印張數參數"}), 400
@@ -890,13 +2582,11 @@ def api_save_print_count():
             return jsonify({"error": "列印張數必須是數字"}), 400
             
         count = int(print_count)
-        print(f"[DEBUG] 解析後的列印張數: {count}")
-        
         if count < 1 or count > 10:
             return jsonify({"error": "列印張數必須在 1-10 之間"}), 400
         
         set_print_count(count)
-        print(f"[DEBUG] 列印張數已保存: {count}")
+        log_printer.info("[列印張數] 已保存: %s", count)
         
         return jsonify({
             "ok": True, 
@@ -905,7 +2595,7 @@ def api_save_print_count():
         })
         
     except Exception as e:
-        print(f"[ERROR] 保存列印張數時發生錯誤: {e}")
+        log_printer.error("[保存列印張數失敗] %s", e)
         return jsonify({"error": f"保存失敗: {str(e)}"}), 500
 
 # 上傳背景圖片
@@ -938,15 +2628,30 @@ def ads_page():
         return "Unauthorized", 403
 
     if request.method == "POST":
+        # 表單解析前先擋：werkzeug 會把上傳內容暫存到卡上
+        try:
+            STORAGE.check_free(ADS_FOLDER, request.content_length or 0)
+        except StorageFull as e:
+            log_ads.warning("[上傳拒收] %s", e)
+            return f"上傳失敗：{e}", 413
+
         # 上傳影片
         if "file" in request.files and request.files["file"].filename:
             file = request.files["file"]
             if file.filename.lower().endswith(".mp4"):
-                file.save(os.path.join(ADS_FOLDER, file.filename))
+                try:
+                    with STORAGE.upload("ads", os.path.join(ADS_FOLDER, file.filename),
+                                        request.content_length) as f:
+                        shutil.copyfileobj(file.stream, f, 1024 * 1024)
+                except StorageFull as e:
+                    log_ads.warning("[廣告上傳拒收] %s %s", file.filename, e)
+                    return f"上傳失敗：{e}", 413
+                log_ads.info("[廣告上傳] %s", file.filename)
                 files = get_ads()
                 if file.filename not in files:
                     files.append(file.filename)
                     save_order(files)
+                CONTROL.send("ads")
                 return redirect(url_for("ads_page", pw="yellowgirl"))
 
         # 列印設定
@@ -967,7 +2672,7 @@ def ads_page():
             try:
                 save_print_bg(request.files["print_bg"])
             except Exception as e:
-                print("[背景圖更新失敗]", e)
+                log_printer.error("[背景圖更新失敗] %s", e)
 
         return redirect(url_for("ads_page", pw="yellowgirl"))
 
@@ -995,6 +2700,7 @@ def delete_ad(name):
     if name in files:
         files.remove(name)
         save_order(files)
+    CONTROL.send("ads")
     return redirect(url_for("ads_page", pw="yellowgirl"))
 
 @app.route("/ads/move/<name>/<direction>")
@@ -1009,6 +2715,7 @@ def move_ad(name, direction):
         elif direction == "down" and idx < len(files)-1:
             files[idx], files[idx+1] = files[idx+1], files[idx]
         save_order(files)
+    CONTROL.send("ads")
     return redirect(url_for("ads_page", pw="yellowgirl"))
 
 @app.route("/ads/toggle_mute")
@@ -1016,6 +2723,7 @@ def toggle_mute():
     if request.args.get("pw") != "yellowgirl":
         return "Unauthorized", 403
     set_muted(not get_muted())
+    CONTROL.send("ads")
     return redirect(url_for("ads_page", pw="yellowgirl"))
 
 @app.route("/ads/toggle_voice")
@@ -1033,10 +2741,57 @@ def clear_cache():
     return redirect(url_for("ads_page", pw="yellowgirl"))
 
 # ---------------- 啟動 ----------------
+# import app 只定義路由與物件，不碰檔案也不載 gTTS / PIL / requests；
+# 掛日誌 handler、建後端、建資料夾、讀回列印佇列與已印號碼、啟動背景服務都在 create_app()。
+# WSGI 伺服器請用工廠：gunicorn "app:create_app()"
+QUEUEPAD_PORT = int(os.getenv("QUEUEPAD_PORT", "8000"))
+QUEUEPAD_WARMUP = os.getenv("QUEUEPAD_WARMUP", "on") == "on"   # 啟動後背景預熱重量級模組
+_CREATED = threading.Lock()
+_created = False
+
+
+def warm_up():
+    """背景預先載入各子系統，第一張票、第一段語音不用等 import / 字體解析"""
+    t0 = time.perf_counter()
+    modules = (requests,) if QUEUEPAD_ROLE == "edge" else (requests, queuepad.tts.gtts, Image)
+    loaded = lazy.warm_up(*modules)
+    if QUEUEPAD_ROLE != "edge" and RENDER_WORKERS <= 0:
+        ticket_render.init_worker(PRINT_BG_FILE)     # 票面在本行程合成時才需要
+    log_app.info("[預熱] %.0f ms %s", (time.perf_counter() - t0) * 1000, loaded,
+                 extra={"modules": loaded})
+
+
+def create_app(start_services: bool = True, warmup: bool = None):
+    """初始化並回傳 app；重複呼叫只會初始化一次"""
+    global _created
+    with _CREATED:
+        if _created:
+            return app
+        _created = True
+    setup_logging()
+    init_backends()
+    for folder in (ADS_FOLDER, AUDIO_FOLDER, PRINT_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+    PRINTED_NUMBERS.update(load_printed_numbers())
+    PRINT_JOBS.load()
+    if start_services:
+        if QUEUEPAD_ROLE == "edge":
+            if not HUB_URL:
+                raise SystemExit("QUEUEPAD_ROLE=edge 需要設定 HUB_URL")
+            log_app.info("[系統啟動] edge 顯示端，訂閱 %s", HUB_URL)
+            EDGE.start()
+        else:
+            threading.Thread(target=RENDERER.start, daemon=True).start()
+            PRINT_JOBS.start()
+            MONITOR.start()
+    if QUEUEPAD_WARMUP if warmup is None else warmup:
+        threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+    return app
+
+
 if __name__ == "__main__":
-    print("[系統啟動] 啟動 Flask + 監控線程 (僅一次)")
-    t = threading.Thread(target=monitor_waiting, daemon=True)
-    t.start()
-    app.run(host="0.0.0.0", port=8000, debug=False, use_reloader=False)
+    application = create_app()
+    log_app.info("[系統啟動] 啟動 Flask + 監控線程 (僅一次)")
+    application.run(host="0.0.0.0", port=QUEUEPAD_PORT, debug=False, use_reloader=False)
 
 
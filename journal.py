@@ -0,0 +1,186 @@
+"""
+叫號狀態日誌（append-only，批次 fsync，定期 checkpoint）
+
+每一行一筆 JSON 紀錄，帶遞增的 seq：
+    {"seq": 12, "t": "snapshot", "current": 5, "waiting": [6, 7], "ts": ...}
+    {"seq": 13, "t": "printed", "numbers": [6]}
+    {"seq": 14, "t": "audio_ready", "number": 6}  語音檔已生成
+    {"seq": 15, "t": "announced", "number": 6}    顯示端回報已播出
+    {"seq": 16, "t": "reset"}
+    {"seq": 17, "t": "issued", "number": 900}     離線時本機發號
+    {"seq": 18, "t": "called", "number": 900}     本機叫號
+    {"seq": 19, "t": "adopted", "numbers": [900]} 上游恢復後已接手的本機號碼
+
+append() 只把紀錄放進記憶體；背景執行緒每 flush_interval 秒把累積的紀錄一次寫入
+並 fsync（group commit），SD 卡上一批只花一次 fsync。每 checkpoint_every 筆把
+目前狀態寫成 checkpoint（原子換檔）再清空日誌，重播時間固定在毫秒級。
+斷電時最後一行可能只寫了一半，重播時會略過。
+"""
+import json, os, threading, time
+
+from storage import atomic_write
+
+
+def empty_state():
+    return {"seq": 0, "current": None, "waiting": [], "ts": None, "current_ts": None,
+            "printed": [], "audio_ready": [], "announced": [], "resets": 0,
+            "local_waiting": [], "local_current": None, "local_called_ts": None, "local_next": 0}
+
+
+def apply(state: dict, rec: dict):
+    """把一筆紀錄套到狀態上"""
+    t = rec.get("t")
+    if t == "snapshot":
+        if rec.get("current") != state["current"]:
+            state["current_ts"] = rec.get("ts")
+        state["current"] = rec.get("current")
+        state["waiting"] = list(rec.get("waiting") or [])
+        state["ts"] = rec.get("ts")
+    elif t == "printed":
+        printed = set(state["printed"])
+        printed.update(rec.get("numbers") or [])
+        state["printed"] = sorted(printed)
+    elif t in ("audio_ready", "announced"):
+        if rec.get("number") not in state[t]:
+            state[t].append(rec.get("number"))
+    elif t == "reset":
+        state.update(current=None, waiting=[], printed=[], audio_ready=[], announced=[], resets=state["resets"] + 1,
+                     local_waiting=[], local_current=None, local_next=0)
+    elif t == "issued":
+        n = rec.get("number")
+        state["local_waiting"].append(n)
+        state["local_next"] = max(state["local_next"], n + 1)
+    elif t == "called":
+        n = rec.get("number")
+        state["local_waiting"] = [x for x in state["local_waiting"] if x != n]
+        state["local_current"] = n
+        state["local_called_ts"] = rec.get("ts")
+    elif t == "adopted":
+        adopted = set(rec.get("numbers") or [])
+        state["local_waiting"] = [x for x in state["local_waiting"] if x not in adopted]
+    # 只留還有意義的號碼，checkpoint 不會越長越大
+    live = set(state["waiting"]) | set(state["local_waiting"])
+    live |= {n for n in (state["current"], state["local_current"]) if n is not None}
+    for key in ("audio_ready", "announced"):
+        state[key] = [n for n in state[key] if n in live]
+    state["seq"] = rec.get("seq", state["seq"])
+
+
+class Journal:
+    def __init__(self, path: str, checkpoint_path: str, flush_interval: float = 0.2,
+                 checkpoint_every: int = 500, on_fsync=None):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.flush_interval = flush_interval
+        self.checkpoint_every = checkpoint_every
+        self.on_fsync = on_fsync          # 回呼 (筆數, 秒數)，給指標用
+        self.cond = threading.Condition()
+        self.pending = []
+        self.state = empty_state()
+        self.seq = 0
+        self.since_checkpoint = 0
+        self.flushed_seq = 0
+        self.recovered = False
+        self.thread = None
+
+    # ---- 啟動 ----
+    def recover(self) -> dict:
+        """讀 checkpoint + 重播其後的紀錄；回傳狀態副本，並啟動背景寫入（只做一次）"""
+        if self.recovered:
+            return self.snapshot() | {"replayed": 0}
+        state = empty_state()
+        try:
+            with open(self.checkpoint_path) as f:
+                state.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        replayed = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break             # 斷電留下的半行
+                    if rec.get("seq", 0) > state["seq"]:
+                        apply(state, rec)
+                        replayed += 1
+        except OSError:
+            pass
+        with self.cond:
+            self.state = state
+            self.seq = self.flushed_seq = state["seq"]
+            self.since_checkpoint = replayed
+            self.recovered = True
+        self.start()
+        return json.loads(json.dumps(state)) | {"replayed": replayed}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="journal", daemon=True)
+            self.thread.start()
+
+    # ---- 寫入 ----
+    def append(self, t: str, **fields) -> int:
+        if not self.recovered:
+            self.recover()      # 先接上舊的 seq，新紀錄才不會被重播略過
+        with self.cond:
+            self.seq += 1
+            rec = {"seq": self.seq, "t": t, "ts": round(time.time(), 3), **fields}
+            self.pending.append(rec)
+            apply(self.state, rec)
+            self.cond.notify()
+            return self.seq
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等到目前為止的紀錄都已 fsync"""
+        with self.cond:
+            target = self.seq
+            self.cond.notify()
+            return self.cond.wait_for(lambda: self.flushed_seq >= target, timeout)
+
+    def snapshot(self) -> dict:
+        with self.cond:
+            return json.loads(json.dumps(self.state))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending, None)
+            # 多等一下，把這段時間內的紀錄湊成一批
+            time.sleep(self.flush_interval)
+            with self.cond:
+                batch, self.pending = self.pending, []
+            if not batch:
+                continue
+            t0 = time.perf_counter()
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError:
+                with self.cond:
+                    self.pending = batch + self.pending   # 下次再試
+                time.sleep(1)
+                continue
+            if self.on_fsync:
+                self.on_fsync(len(batch), time.perf_counter() - t0)
+            with self.cond:
+                self.flushed_seq = batch[-1]["seq"]
+                self.since_checkpoint += len(batch)
+                need_checkpoint = self.since_checkpoint >= self.checkpoint_every
+                self.cond.notify_all()
+            if need_checkpoint:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """把目前狀態寫成 checkpoint 再清空日誌；清空前斷電也沒關係，重播會略過舊 seq"""
+        with self.cond:
+            # 還沒寫進日誌的紀錄不能算進 checkpoint，否則清空日誌後它們的 seq 會被跳過
+            if self.pending:
+                return
+            state = json.loads(json.dumps(self.state))
+            self.since_checkpoint = 0
+            atomic_write(self.checkpoint_path, json.dumps(state, ensure_ascii=False))
+            atomic_write(self.path, "")
@@ -0,0 +1,54 @@
+"""
+延遲載入重量級模組
+
+    requests = lazy_import("requests")
+    Image = lazy_import("PIL.Image")
+
+回傳的代理物件第一次被存取屬性時才真正 import，之後直接轉給真模組。
+Pi 冷開機時 requests / PIL / gTTS 光 import 就要好幾百毫秒，延到第一次用到
+（或背景 warm_up）就不會卡在服務啟動、第一個頁面回應之前。
+載入有鎖保護，多個執行緒同時第一次存取也只會 import 一次。
+"""
+import importlib, threading, time
+
+
+class LazyModule:
+    def __init__(self, name: str):
+        self.__dict__.update(_name=name, _module=None, _lock=threading.Lock(), _load_ms=None)
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    t0 = time.perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    self._load_ms = (time.perf_counter() - t0) * 1000
+                module = self._module
+        return module
+
+    def __getattr__(self, attr):
+        # 只有自己沒有的屬性才會走到這裡，也就是真模組的內容
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+def is_loaded(module) -> bool:
+    return not isinstance(module, LazyModule) or module._module is not None
+
+
+def warm_up(*modules) -> dict:
+    """把還沒載入的模組載入；回傳 {模組名: 載入毫秒}（已載入的不列）"""
+    out = {}
+    for m in modules:
+        if isinstance(m, LazyModule) and m._module is None:
+            m._load()
+            out[m._name] = round(m._load_ms, 1)
+    return out
@@ -0,0 +1,79 @@
+"""
+結構化、非同步、自動輪替的日誌
+
+所有子系統 (monitor / printer / tts / ads / display / app) 都掛在 "queuepad" 之下；
+呼叫端只把 LogRecord 丟進 queue，實際寫 stdout / 檔案由背景 QueueListener 負責，
+熱路徑不會卡在 SD 卡 I/O 上。
+
+環境變數：
+    LOG_LEVEL        預設 INFO
+    LOG_FORMAT       json / text（stdout 格式，預設 text；檔案一律 JSON）
+    LOG_FILE         日誌檔路徑，預設 logs/queuepad.log；設成空字串則不寫檔（子行程一律不寫檔）
+    LOG_MAX_BYTES    單檔上限，預設 1 MB
+    LOG_BACKUPS      保留份數，預設 3
+"""
+import atexit, json, logging, logging.handlers, multiprocessing, os, queue, sys, time
+
+ROOT_LOGGER = "queuepad"
+_DEFAULT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "queuepad.log")
+
+# LogRecord 內建欄位；其餘 extra={...} 的欄位會原樣輸出到 JSON
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for k, v in vars(record).items():
+            if k not in _RESERVED and not k.startswith("_"):
+                out[k] = v
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """設定一次即可；重複呼叫不會重複掛 handler"""
+    global _listener
+    if _listener is not None:
+        return
+    level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+
+    console = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_FORMAT", "text") == "json":
+        console.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    handlers = [console]
+
+    log_file = os.getenv("LOG_FILE", _DEFAULT_FILE)
+    # 子行程（票面渲染池）只寫 stdout，避免多個行程同時輪替同一個檔案
+    if log_file and multiprocessing.parent_process() is None:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        fh = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=int(os.getenv("LOG_MAX_BYTES", str(1024 * 1024))),
+            backupCount=int(os.getenv("LOG_BACKUPS", "3")), encoding="utf-8")
+        fh.setFormatter(JsonFormatter())
+        handlers.append(fh)
+
+    q = queue.SimpleQueue()
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
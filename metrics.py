@@ -0,0 +1,128 @@
+"""
+極簡 Prometheus 指標（不另外裝 prometheus_client）
+
+只實作 Counter / Gauge / Histogram 與文字格式輸出，給 app.py 的 /metrics 使用。
+"""
+import threading, time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_REGISTRY = []
+_LOCK = threading.Lock()
+
+
+def _fmt(v):
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+def _label_str(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                    for k, v in pairs)
+    return "{" + body + "}"
+
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        with _LOCK:
+            _REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    @abstractmethod
+    def _lines(self):
+        """目前的樣本行（不含 HELP / TYPE）；呼叫時已持有 _LOCK"""
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with _LOCK:
+            out.extend(self._lines())
+        return "\n".join(out)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        k = self._key(labels)
+        with _LOCK:
+            self._values[k] = self._values.get(k, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _lines(self):
+        if not self._values and not self.labelnames:
+            return [f"{self.name} 0"]
+        return [f"{self.name}{_label_str(self.labelnames, k)} {_fmt(v)}" for k, v in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with _LOCK:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        k = self._key(labels)
+        with _LOCK:
+            counts, total = self._values.get(k, ([0] * len(self.buckets), 0.0))
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    counts[i] += 1
+                    break
+            self._values[k] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _lines(self):
+        lines = []
+        for k, (counts, total) in sorted(self._values.items()):
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames, k, ('le', _fmt(b)))} {acc}")
+            lines.append(f"{self.name}_sum{_label_str(self.labelnames, k)} {_fmt(total)}")
+            lines.append(f"{self.name}_count{_label_str(self.labelnames, k)} {acc}")
+        return lines
+
+
+def render_all() -> str:
+    with _LOCK:
+        metrics = list(_REGISTRY)
+    return "\n".join(m.render() for m in metrics) + "\n"
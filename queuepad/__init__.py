@@ -0,0 +1,36 @@
+"""
+QueuePad 可替換的後端
+
+    printer   送 ESC/POS 資料：network（預設）/ fake / file
+    tts       生成叫號語音：gtts（預設）/ concat（離線拼接）/ cache（只用現有音檔）
+    upstream  取得叫號狀態：poll（預設）/ webhook / sim
+
+app.py 依環境變數 QUEUEPAD_PRINTER / QUEUEPAD_TTS / QUEUEPAD_UPSTREAM 選用。
+新的實作只要繼承對應的介面並登記在 REGISTRY，就能單獨壓測、和現有實作比較。
+ESC/POS 指令編碼本身在 queuepad.escpos（純函式）。
+"""
+from .printer import PrinterBackend, NetworkPrinter, FakePrinter, FilePrinter
+from .tts import TTSBackend, TTSUnavailable, GTTSBackend, ConcatTTS, CacheOnlyTTS
+from .upstream import UpstreamBackend, UpstreamError, PollUpstream, WebhookUpstream, SimUpstream
+
+__all__ = [
+    "PrinterBackend", "NetworkPrinter", "FakePrinter", "FilePrinter",
+    "TTSBackend", "TTSUnavailable", "GTTSBackend", "ConcatTTS", "CacheOnlyTTS",
+    "UpstreamBackend", "UpstreamError", "PollUpstream", "WebhookUpstream", "SimUpstream",
+    "REGISTRY", "create",
+]
+
+REGISTRY = {
+    "printer": {c.name: c for c in (NetworkPrinter, FakePrinter, FilePrinter)},
+    "tts": {c.name: c for c in (GTTSBackend, ConcatTTS, CacheOnlyTTS)},
+    "upstream": {c.name: c for c in (PollUpstream, WebhookUpstream, SimUpstream)},
+}
+
+
+def create(kind: str, name: str, **kwargs):
+    """REGISTRY[kind][name](**kwargs)；名稱不存在時丟 ValueError 並列出可用的後端"""
+    try:
+        cls = REGISTRY[kind][name]
+    except KeyError:
+        raise ValueError(f"未知的 {kind} 後端: {name}（可用: {', '.join(REGISTRY.get(kind, {}))}）") from None
+    return cls(**kwargs)
@@ -0,0 +1,110 @@
+"""
+ESC/POS 指令編碼（純函式，不碰網路與檔案）
+
+raster 都是 ticket_render.pack_bits_raster 打包好的 (raster, width_bytes, height)。
+"""
+
+MIN_BLANK_RUN = 16        # 空白列至少連續這麼多列才切段，避免指令太碎
+
+INIT         = b'\x1B\x40'                  # ESC @ 初始化
+LINE_SPACING = b'\x1B\x32'                  # ESC 2 標準行距
+FEED_CUT     = b'\n\n\n' + b'\x1D\x56\x00'  # 走紙 + 切紙
+STATUS_QUERY = b"\x10\x04\x01\x10\x04\x02\x10\x04\x04"   # DLE EOT 1/2/4，各回 1 byte
+MODEL_QUERY  = b'\x1D\x49\x01'              # GS I 1：印表機型號 ID
+
+
+# ---------------- raster ----------------
+def gs_v0(raster: bytes, width_bytes: int, height: int) -> bytes:
+    return (b'\x1D\x76\x30\x00' + bytes([width_bytes & 0xFF, (width_bytes >> 8) & 0xFF,
+                                        height & 0xFF, (height >> 8) & 0xFF]) + raster)
+
+def encode_raster(raster: bytes, width_bytes: int, height: int, mode: str = "plain") -> bytes:
+    """把 raster 編成 ESC/POS 指令；bands 模式跳過空白列"""
+    if mode != "bands":
+        return gs_v0(raster, width_bytes, height)
+
+    blank = bytes(width_bytes)
+    rows = [raster[y * width_bytes:(y + 1) * width_bytes] for y in range(height)]
+    out = bytearray()
+    y = 0
+    while y < height:
+        # 連續空白列
+        y2 = y
+        while y2 < height and rows[y2] == blank:
+            y2 += 1
+        if y2 - y >= MIN_BLANK_RUN or (y2 == height and y2 > y):
+            n = y2 - y
+            while n > 0:
+                step = min(n, 255)
+                out += b'\x1B\x4A' + bytes([step])      # ESC J n：走紙 n 點
+                n -= step
+            y = y2
+            continue
+        # 有內容的區段：一直到下一段夠長的空白為止
+        y2 = y
+        while y2 < height:
+            if rows[y2] == blank:
+                y3 = y2
+                while y3 < height and rows[y3] == blank:
+                    y3 += 1
+                if y3 - y2 >= MIN_BLANK_RUN or y3 == height:
+                    break
+                y2 = y3
+            else:
+                y2 += 1
+        out += gs_v0(raster[y * width_bytes:y2 * width_bytes], width_bytes, y2 - y)
+        y = y2
+    return bytes(out)
+
+def job_bytes(raster: bytes, width_bytes: int, height: int, mode: str = "plain",
+              nv_plan: dict = None) -> bytes:
+    """打包好的 raster → 完整一張票的 ESC/POS 資料（初始化 + raster + 走紙切紙）
+    有 nv_plan 時，只有背景的區段改成叫出印表機內存的 NV 圖"""
+    if nv_plan and nv_plan["width_bytes"] == width_bytes and nv_plan["height"] == height:
+        body = bytearray()
+        for y0, y1, key in nv_plan["segments"]:
+            if key:
+                body += nv_print(key)
+            else:
+                body += encode_raster(raster[y0 * width_bytes:y1 * width_bytes], width_bytes, y1 - y0, mode)
+        return INIT + LINE_SPACING + bytes(body) + FEED_CUT
+    return INIT + LINE_SPACING + encode_raster(raster, width_bytes, height, mode) + FEED_CUT
+
+
+# ---------------- NV 圖 (GS ( L) ----------------
+def gs_l(params: bytes) -> bytes:
+    return b'\x1D\x28\x4C' + bytes([len(params) & 0xFF, (len(params) >> 8) & 0xFF]) + params
+
+def nv_define(key: bytes, raster: bytes, width_bytes: int, height: int) -> bytes:
+    # GS ( L fn 67：定義 NV raster 圖（單色）
+    x = width_bytes * 8
+    return gs_l(bytes([48, 67, 48]) + key + bytes([1, x & 0xFF, x >> 8, height & 0xFF, height >> 8, 49]) + raster)
+
+def nv_delete(key: bytes) -> bytes:
+    return gs_l(bytes([48, 66]) + key)                # GS ( L fn 66：刪除指定 key
+
+def nv_print(key: bytes) -> bytes:
+    return gs_l(bytes([48, 69]) + key + bytes([1, 1]))  # GS ( L fn 69：列印指定 key（1 倍）
+
+
+# ---------------- 即時狀態 ----------------
+def parse_status(reply: bytes):
+    """DLE EOT 1/2/4 的 3 byte 回應 → 狀態 dict；不足 3 byte 時回傳 None（狀態未知）"""
+    if len(reply) < 3:
+        return None
+    printer, offline, paper = reply[0], reply[1], reply[2]
+    status = {
+        "online": not (printer & 0x08),
+        "cover_open": bool(offline & 0x04),
+        "paper_out": bool(offline & 0x20) or bool(paper & 0x60),
+        "paper_near_end": bool(paper & 0x0C),
+        "error": bool(offline & 0x40),
+    }
+    for key in ("paper_out", "cover_open", "error"):
+        if status[key]:
+            status["problem"] = key
+            break
+    else:
+        if not status["online"]:
+            status["problem"] = "offline"
+    return status
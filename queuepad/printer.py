@@ -0,0 +1,145 @@
+"""
+出單機後端：把 ESC/POS 資料送到哪裡
+
+    network  TCP RAW 埠（XPrinter 9100），預設
+    fake     不碰網路，只計數；狀態查詢一律回「正常」，壓測編碼/排程用
+    file     每條連線寫成一個 .bin 檔，可拿來比對輸出或餵給 tools/fake_printer.py 解析
+
+介面以「連線」為單位：批次列印要在同一條連線連送多張，狀態查詢要讀回應。
+    with backend.open(host, port) as conn:
+        conn.sendall(data); conn.recv(n)
+連線失敗或送出失敗一律丟 OSError；查詢逾時丟 socket.timeout（也是 OSError 的子類別）。
+"""
+import os, socket, threading, time
+from abc import ABC, abstractmethod
+
+
+class PrinterBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    def open(self, host: str, port: int, timeout: float = 10):
+        """開一條連線（context manager，有 sendall/recv）；失敗丟 OSError"""
+
+    def send(self, host: str, port: int, payload: bytes, timeout: float = 10):
+        with self.open(host, port, timeout) as conn:
+            conn.sendall(payload)
+
+    def query(self, host: str, port: int, request: bytes, nbytes: int, timeout: float = 2.0) -> bytes:
+        """送出查詢指令並讀回最多 nbytes；印表機提早關線時回傳已讀到的部分"""
+        with self._query_connection(host, port, timeout) as conn:
+            conn.sendall(request)
+            reply = b""
+            while len(reply) < nbytes:
+                chunk = conn.recv(nbytes - len(reply))
+                if not chunk:
+                    break
+                reply += chunk
+            return reply
+
+    def _query_connection(self, host, port, timeout):
+        return self.open(host, port, timeout)
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class NetworkPrinter(PrinterBackend):
+    name = "network"
+
+    def open(self, host, port, timeout=10):
+        return socket.create_connection((host, port), timeout=timeout)
+
+
+class _MemoryConnection:
+    """假連線：資料交給 sink，DLE EOT 查詢回「正常」(0x12)；GS I 型號查詢不回應（探測結果為 plain）"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.reply = bytearray()
+
+    def sendall(self, data):
+        self.sink(data)
+        data = bytes(data)
+        self.reply += b"\x12" * data.count(b"\x10\x04")
+
+    def recv(self, n):
+        out, self.reply = bytes(self.reply[:n]), self.reply[n:]
+        return out
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakePrinter(PrinterBackend):
+    name = "fake"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.bytes = 0
+
+    def _sink(self, data):
+        with self.lock:
+            self.bytes += len(data)
+
+    def open(self, host, port, timeout=10):
+        with self.lock:
+            self.connections += 1
+        return _MemoryConnection(self._sink)
+
+    def stats(self):
+        with self.lock:
+            return {"backend": self.name, "connections": self.connections, "bytes": self.bytes}
+
+
+class _FileConnection(_MemoryConnection):
+    def __init__(self, path, count):
+        self.f = open(path, "wb")
+        super().__init__(lambda data: (self.f.write(data), count(data)))
+
+    def close(self):
+        self.f.close()
+
+
+class FilePrinter(FakePrinter):
+    name = "file"
+
+    def __init__(self, folder: str, keep: int = 200):
+        super().__init__()
+        self.folder = folder
+        self.keep = keep          # 只留最近幾個檔，避免塞滿 SD 卡
+        self.seq = 0
+
+    def open(self, host, port, timeout=10):
+        os.makedirs(self.folder, exist_ok=True)
+        with self.lock:
+            self.connections += 1
+            self.seq += 1
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.seq:04d}-{host}_{port}.bin"
+        self._prune()
+        return _FileConnection(os.path.join(self.folder, name), self._sink)
+
+    def _query_connection(self, host, port, timeout):
+        # 狀態/型號查詢不落檔，資料夾裡只有真正的列印資料
+        return FakePrinter.open(self, host, port, timeout)
+
+    def _prune(self):
+        try:
+            files = sorted(f for f in os.listdir(self.folder) if f.endswith(".bin"))
+        except OSError:
+            return
+        for f in files[:max(0, len(files) - self.keep + 1)]:
+            try:
+                os.remove(os.path.join(self.folder, f))
+            except OSError:
+                pass
+
+    def stats(self):
+        return super().stats() | {"folder": self.folder}
@@ -0,0 +1,109 @@
+"""
+叫號語音後端：把「請 一百二十三 號取餐」變成音檔
+
+    gtts    線上 gTTS，預設
+    concat  離線：把預錄的單字片段（clips/請.mp3、clips/一.mp3 ...）串成一個 mp3，
+            不用網路、幾毫秒就好；片段可以用 make_clips() 先用 gTTS 生成一次
+    cache   不生成，只用已經存在的音檔（沒有就丟 TTSUnavailable）
+
+可以用逗號串成後援順序，例如 QUEUEPAD_TTS=concat,gtts：片段齊全時走離線拼接，
+缺字才打 gTTS。
+"""
+import os
+from abc import ABC, abstractmethod
+
+from lazy import lazy_import
+
+gtts = lazy_import("gtts")
+
+
+class TTSUnavailable(Exception):
+    """這個後端生不出這段語音（缺片段、cache-only）；呼叫端可以改用下一個後端"""
+
+
+class TTSBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    def synthesize(self, text: str, path: str):
+        """把 text 寫成 path（mp3）；失敗丟例外"""
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class GTTSBackend(TTSBackend):
+    name = "gtts"
+
+    def __init__(self, lang: str = "zh-tw"):
+        self.lang = lang
+
+    def synthesize(self, text, path):
+        gtts.gTTS(text=text, lang=self.lang).save(path)
+
+
+# ---------------- 離線拼接 ----------------
+def _strip_id3(data: bytes) -> bytes:
+    """去掉 ID3v2 標頭與 ID3v1 結尾，只留 MPEG frame，串接後播放器才不會在中間停住"""
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        data = data[10 + size:]
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    return data
+
+
+class ConcatTTS(TTSBackend):
+    name = "concat"
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.cache = {}           # 字 → (mtime, frames)
+
+    def _clip(self, ch: str) -> bytes:
+        path = os.path.join(self.folder, f"{ch}.mp3")
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            raise TTSUnavailable(f"缺少語音片段 {ch}.mp3") from None
+        hit = self.cache.get(ch)
+        if hit is None or hit[0] != mtime:
+            with open(path, "rb") as f:
+                hit = (mtime, _strip_id3(f.read()))
+            self.cache[ch] = hit
+        return hit[1]
+
+    def synthesize(self, text, path):
+        data = b"".join(self._clip(ch) for ch in text if not ch.isspace())
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def missing(self, text: str):
+        return sorted({ch for ch in text if not ch.isspace()
+                       and not os.path.exists(os.path.join(self.folder, f"{ch}.mp3"))})
+
+    def stats(self):
+        try:
+            clips = len([f for f in os.listdir(self.folder) if f.endswith(".mp3")])
+        except OSError:
+            clips = 0
+        return {"backend": self.name, "folder": self.folder, "clips": clips}
+
+
+def make_clips(folder: str, chars: str, lang: str = "zh-tw"):
+    """用 gTTS 把每個字各錄一個片段（只需要在有網路時做一次）"""
+    os.makedirs(folder, exist_ok=True)
+    made = []
+    for ch in sorted(set(chars) - set(" ")):
+        path = os.path.join(folder, f"{ch}.mp3")
+        if not os.path.exists(path):
+            gtts.gTTS(text=ch, lang=lang).save(path)
+            made.append(ch)
+    return made
+
+
+class CacheOnlyTTS(TTSBackend):
+    name = "cache"
+
+    def synthesize(self, text, path):
+        raise TTSUnavailable("cache-only：不生成新的音檔")
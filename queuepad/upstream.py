@@ -0,0 +1,143 @@
+"""
+上游叫號狀態後端：取得 (current, waiting)
+
+    poll     每次向上游 /status 發 GET（預設）
+    webhook  上游主動 POST 到 /api/upstream/webhook，這裡只回最後收到的狀態；
+             太久沒收到就當成斷線，交給離線模式處理
+    sim      在行程內重播 tools/upstream_sim.py 格式的 JSONL 軌跡，不開 HTTP，
+             壓測監控核心時不必另外起模擬器
+
+fetch() 失敗一律丟例外（監控核心會記錄並在連續失敗後進入離線模式）。
+"""
+import json, threading, time
+from abc import ABC, abstractmethod
+
+from lazy import lazy_import
+
+requests = lazy_import("requests")
+
+
+class UpstreamError(Exception):
+    """上游沒有可用的狀態（回 5xx、webhook 太久沒來、模擬的故障）"""
+
+
+def normalize(data: dict):
+    """上游 JSON → (current, waiting)；current 為空時以 waiting 第一個代替"""
+    waiting = data.get("waiting", []) or []
+    current = data.get("current")
+    if current is None and waiting:
+        current = waiting[0]
+    return current, waiting
+
+
+def _is_number(n) -> bool:
+    # JSON 的 true/false 在 Python 也是 int，要排除
+    return isinstance(n, int) and not isinstance(n, bool)
+
+
+class UpstreamBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    def fetch(self, timeout: float = 3):
+        """取一份正規化後的叫號資料；失敗丟例外"""
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class PollUpstream(UpstreamBackend):
+    name = "poll"
+
+    def __init__(self, url):
+        self.url = url            # 字串或回傳網址的函式（設定頁可隨時改）
+
+    def fetch(self, timeout=3):
+        url = self.url() if callable(self.url) else self.url
+        r = requests.get(url, timeout=timeout)
+        r.raise_for_status()      # 上游回 5xx 時不能當成「清單是空的」
+        return normalize(r.json())
+
+
+class WebhookUpstream(UpstreamBackend):
+    name = "webhook"
+
+    def __init__(self, max_age: float = 30):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.state = None
+        self.received = None
+        self.pushes = 0
+
+    def push(self, data: dict):
+        """收下一份推送；格式不對丟 ValueError（狀態不變）"""
+        if not isinstance(data, dict):
+            raise ValueError("body 必須是 JSON 物件")
+        waiting = data.get("waiting") or []
+        if not isinstance(waiting, list) or not all(_is_number(n) for n in waiting):
+            raise ValueError("waiting 必須是整數陣列")
+        if data.get("current") is not None and not _is_number(data["current"]):
+            raise ValueError("current 必須是整數或 null")
+        current, waiting = normalize(data)
+        with self.lock:
+            self.state = (current, list(waiting))
+            self.received = time.time()
+            self.pushes += 1
+
+    def fetch(self, timeout=3):
+        with self.lock:
+            state, received = self.state, self.received
+        if state is None:
+            raise UpstreamError("還沒收到上游推送")
+        if time.time() - received > self.max_age:
+            raise UpstreamError(f"上游 {time.time() - received:.0f} 秒沒有推送")
+        return state[0], list(state[1])
+
+    def stats(self):
+        with self.lock:
+            return {"backend": self.name, "pushes": self.pushes, "last_push": self.received}
+
+
+class SimUpstream(UpstreamBackend):
+    name = "sim"
+
+    def __init__(self, trace_path: str, speed: float = 1.0, loop: bool = True):
+        frames = []
+        with open(trace_path) as f:
+            for line in f:
+                if line.strip():
+                    frames.append(json.loads(line))
+        if not frames:
+            raise ValueError(f"軌跡檔是空的: {trace_path}")
+        self.frames = sorted(frames, key=lambda fr: fr.get("t", 0))
+        self.trace = trace_path
+        self.speed = speed
+        self.loop = loop
+        self.start = time.time()
+
+    def frame(self):
+        elapsed = (time.time() - self.start) * self.speed
+        end = self.frames[-1].get("t", 0)
+        if self.loop and end > 0:
+            elapsed %= end
+        chosen = self.frames[0]
+        for fr in self.frames:
+            if fr.get("t", 0) > elapsed:
+                break
+            chosen = fr
+        return chosen
+
+    def fetch(self, timeout=3):
+        fr = self.frame()
+        latency = fr.get("latency_ms", 0) / 1000 / max(self.speed, 1.0)
+        if latency:
+            time.sleep(min(latency, timeout))
+            if latency > timeout:
+                raise UpstreamError(f"模擬延遲 {latency:.1f}s 超過 {timeout}s")
+        if fr.get("status", 200) != 200:
+            raise UpstreamError(f"模擬上游回 {fr['status']}")
+        return normalize(fr)
+
+    def stats(self):
+        return {"backend": self.name, "trace": self.trace, "frames": len(self.frames),
+                "speed": self.speed}
@@ -0,0 +1,139 @@
+// QueuePad 顯示端 Service Worker
+//
+// 廣告影片與叫號語音存在 Cache Storage，重新整理或 Chromium 重開都不用再下載：
+//   /static/ads/<檔名>?v=<內容雜湊>  依 /api/ads/manifest 同步，只抓雜湊變了的檔，
+//                                     清單裡沒有的舊版本會刪掉
+//   /api/speak/<號碼>?v=<版本>        第一次播放時存起來，只留最近 AUDIO_KEEP 個
+//   /api/ads/manifest、/              先走網路，斷線時用最後一份
+// 影片的 Range 請求由快取切片回 206，<video> 可以正常 seek。
+
+const ADS_CACHE = "queuepad-ads";
+const AUDIO_CACHE = "queuepad-audio";
+const SHELL_CACHE = "queuepad-shell";
+const AUDIO_KEEP = 200;
+const MANIFEST_URL = "/api/ads/manifest";
+
+self.addEventListener("install", () => self.skipWaiting());
+
+// 接手後頁面會收到 controllerchange 再取一次清單，同步由那次請求觸發；
+// 不在 activate 裡下載，否則下載期間所有請求都要等啟用完成
+self.addEventListener("activate", (event) => event.waitUntil(self.clients.claim()));
+
+self.addEventListener("fetch", (event) => {
+  const req = event.request;
+  const url = new URL(req.url);
+  if (req.method !== "GET" || url.origin !== self.location.origin) return;
+
+  if (url.pathname.startsWith("/static/ads/") && url.searchParams.has("v")) {
+    event.respondWith(cachedMedia(req, ADS_CACHE, false));
+  } else if (url.pathname.startsWith("/api/speak/") && url.searchParams.has("v")) {
+    event.respondWith(cachedMedia(req, AUDIO_CACHE, true));
+  } else if (url.pathname === MANIFEST_URL) {
+    event.respondWith(manifest(event));
+  } else if (url.pathname === "/") {
+    event.respondWith(networkFirst(req, SHELL_CACHE));
+  }
+});
+
+// ========== 廣告同步 ==========
+let syncing = Promise.resolve();
+
+async function rememberManifest(res) {
+  const data = await res.clone().json();
+  const cache = await caches.open(SHELL_CACHE);
+  await cache.put(MANIFEST_URL, res);
+  // 同一時間只跑一次同步，避免重複下載同一支影片
+  syncing = syncing.then(() => syncAds(data)).catch((err) => console.warn("[sw] 廣告同步失敗", err));
+  return syncing;
+}
+
+async function syncAds(data) {
+  const cache = await caches.open(ADS_CACHE);
+  const wanted = new Set((data.ads || []).map((a) => new URL(a.url, self.location.origin).href));
+  for (const req of await cache.keys()) {
+    if (!wanted.has(req.url)) await cache.delete(req);
+  }
+  for (const url of wanted) {
+    if (await cache.match(url)) continue;
+    try {
+      const res = await fetch(url, { cache: "no-store" });
+      if (res.status === 200) await cache.put(url, res);
+    } catch (err) {
+      console.warn("[sw] 下載廣告失敗", url, err);
+    }
+  }
+}
+
+async function manifest(event) {
+  try {
+    const res = await fetch(event.request, { cache: "no-store" });
+    if (res.ok) {
+      event.waitUntil(rememberManifest(res.clone()));
+      return res;
+    }
+    return (await caches.match(MANIFEST_URL)) || res;
+  } catch (err) {
+    const hit = await caches.match(MANIFEST_URL);
+    if (hit) return hit;
+    throw err;
+  }
+}
+
+// ========== 快取優先的影音 ==========
+async function cachedMedia(req, name, store) {
+  const cache = await caches.open(name);
+  const hit = await cache.match(req.url);
+  if (hit) return ranged(req, hit);
+  const res = await fetch(req);
+  // 廣告交給 syncAds 下載整檔；語音在第一次完整回應時存起來
+  if (store && res.status === 200) {
+    await cache.put(req.url, res.clone());
+    trim(cache, AUDIO_KEEP);
+  }
+  return res;
+}
+
+async function trim(cache, keep) {
+  const keys = await cache.keys();      // 依加入順序
+  for (const req of keys.slice(0, Math.max(0, keys.length - keep))) await cache.delete(req);
+}
+
+async function ranged(req, res) {
+  const range = req.headers.get("range");
+  const m = range && /^bytes=(\d*)-(\d*)$/.exec(range.trim());
+  if (!m || (!m[1] && !m[2])) return res;
+  const blob = await res.blob();
+  let start, end;
+  if (m[1]) {
+    start = Number(m[1]);
+    end = m[2] ? Math.min(Number(m[2]), blob.size - 1) : blob.size - 1;
+  } else {
+    start = Math.max(0, blob.size - Number(m[2]));    // bytes=-N：最後 N 個位元組
+    end = blob.size - 1;
+  }
+  if (start >= blob.size || start > end) {
+    return new Response(null, { status: 416, headers: { "Content-Range": `bytes */${blob.size}` } });
+  }
+  return new Response(blob.slice(start, end + 1), {
+    status: 206,
+    headers: {
+      "Content-Type": res.headers.get("Content-Type") || "application/octet-stream",
+      "Content-Range": `bytes ${start}-${end}/${blob.size}`,
+      "Content-Length": String(end - start + 1),
+      "Accept-Ranges": "bytes",
+    },
+  });
+}
+
+async function networkFirst(req, name) {
+  const cache = await caches.open(name);
+  try {
+    const res = await fetch(req);
+    if (res.ok) await cache.put(req, res.clone());
+    return res;
+  } catch (err) {
+    const hit = (await cache.match(req)) || (await cache.match(req, { ignoreSearch: true }));
+    if (hit) return hit;
+    throw err;
+  }
+}
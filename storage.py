@@ -0,0 +1,197 @@
+"""
+SD 卡空間管理
+
+每個資料夾一個配額 (Quota)：
+    lru     超過配額時從最久沒用的檔案開始刪（只刪符合 pattern、且不在保護名單的檔）
+    refuse  從不自動刪，超過配額的新檔直接拒收（廣告影片用）
+另外整張卡保留 min_free 的空間；上傳會吃到這塊時一律拒收，確保出單永遠寫得進去。
+
+所有寫檔都走 atomic_write / atomic_open：先寫暫存檔、fsync、再 os.replace，
+斷電時只會留下舊檔或新檔，不會有寫到一半的檔案。
+"""
+import fnmatch, os, shutil, threading, time
+from contextlib import contextmanager
+
+
+class StorageFull(Exception):
+    """寫入會超過配額或吃掉保留空間"""
+
+
+# ---------------- 原子寫入 ----------------
+def _fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_open(path, mode="wb", **kwargs):
+    """with atomic_open(p, "w") as f: ...；區塊正常結束才換檔，例外時丟掉暫存檔"""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        _fsync_dir(path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def atomic_write(path, data):
+    with atomic_open(path, "wb" if isinstance(data, bytes) else "w",
+                     **({} if isinstance(data, bytes) else {"encoding": "utf-8"})) as f:
+        f.write(data)
+
+
+# ---------------- 配額 ----------------
+class Quota:
+    def __init__(self, name, folder, max_bytes, policy="lru", pattern="*", protect=None):
+        self.name = name
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.pattern = pattern
+        self.protect = protect or (lambda: set())    # 回傳目前不能刪的檔名
+
+    def _files(self):
+        out = []
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            return out
+        for e in entries:
+            if e.is_file() and not e.name.endswith(".tmp"):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                out.append((e.name, st.st_size, max(st.st_atime, st.st_mtime)))
+        return out
+
+    def usage(self):
+        files = self._files()
+        return sum(size for _, size, _ in files), len(files)
+
+    def fits(self, nbytes):
+        return self.max_bytes <= 0 or self.usage()[0] + nbytes <= self.max_bytes
+
+    def enforce(self, incoming=0):
+        """lru：刪到 用量 + incoming <= 配額；回傳刪掉的檔名"""
+        if self.policy != "lru" or self.max_bytes <= 0:
+            return []
+        files = self._files()
+        used = sum(size for _, size, _ in files)
+        if used + incoming <= self.max_bytes:
+            return []
+        protected = self.protect()
+        removed = []
+        for name, size, _ in sorted(files, key=lambda f: f[2]):
+            if used + incoming <= self.max_bytes:
+                break
+            if name in protected or not fnmatch.fnmatch(name, self.pattern):
+                continue
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            used -= size
+            removed.append(name)
+        return removed
+
+
+class StorageManager:
+    def __init__(self, min_free_bytes=0, log=None):
+        self.quotas = {}
+        self.min_free = min_free_bytes
+        self.log = log
+        self.lock = threading.Lock()
+        self.evicted = 0
+        self.refused = 0
+
+    def add(self, quota: Quota):
+        self.quotas[quota.name] = quota
+        return quota
+
+    def disk(self, folder):
+        du = shutil.disk_usage(folder)
+        return {"total": du.total, "used": du.used, "free": du.free, "min_free": self.min_free}
+
+    def enforce_all(self):
+        removed = {}
+        with self.lock:
+            for q in self.quotas.values():
+                r = q.enforce()
+                if r:
+                    removed[q.name] = r
+                    self.evicted += len(r)
+        if removed and self.log:
+            self.log.info("[空間管理] 超過配額，已清除 %s", removed, extra={"removed": removed})
+        return removed
+
+    def reserve(self, name, nbytes):
+        """寫入 nbytes 到 name 資料夾前呼叫；放不下時（lru 先清過仍不夠）丟 StorageFull"""
+        q = self.quotas[name]
+        with self.lock:
+            if q.policy == "lru":
+                removed = q.enforce(nbytes)
+                self.evicted += len(removed)
+            if not q.fits(nbytes):
+                self.refused += 1
+                raise StorageFull(f"{name} 超過配額 {q.max_bytes // (1024 * 1024)} MB")
+        self.check_free(q.folder, nbytes)
+
+    @contextmanager
+    def upload(self, name, path, expected=None):
+        """限額上傳：with STORAGE.upload("ads", p, request.content_length) as f: 寫入
+        邊寫邊計數，超過配額/保留空間就中止並丟 StorageFull，不留下任何檔案"""
+        self.reserve(name, expected or 0)
+        q = self.quotas[name]
+        limit = None
+        if q.max_bytes > 0:
+            limit = max(0, q.max_bytes - q.usage()[0])
+        free = shutil.disk_usage(q.folder).free - self.min_free
+        limit = free if limit is None else min(limit, free)
+        try:
+            with atomic_open(path, "wb") as f:
+                yield _LimitedWriter(f, limit, name)
+        except StorageFull:
+            self.refused += 1
+            raise
+
+    def check_free(self, folder, nbytes):
+        """只檢查整張卡的保留空間（還不知道要放哪個資料夾時用）"""
+        if shutil.disk_usage(folder).free - nbytes < self.min_free:
+            self.refused += 1
+            raise StorageFull(f"SD 卡剩餘空間不足（保留 {self.min_free // (1024 * 1024)} MB 給出單）")
+
+    def report(self):
+        dirs = {}
+        for q in self.quotas.values():
+            used, count = q.usage()
+            dirs[q.name] = {"path": q.folder, "bytes": used, "files": count,
+                            "quota": q.max_bytes, "policy": q.policy,
+                            "percent": round(used / q.max_bytes * 100, 1) if q.max_bytes > 0 else None}
+        first = next(iter(self.quotas.values()), None)
+        return {"dirs": dirs, "disk": self.disk(first.folder) if first else None,
+                "evicted": self.evicted, "refused": self.refused, "ts": time.time()}
+
+
+class _LimitedWriter:
+    def __init__(self, f, limit, name):
+        self.f, self.limit, self.name, self.written = f, limit, name, 0
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > self.limit:
+            raise StorageFull(f"{self.name} 空間不足，已寫入 {self.written} bytes 時中止")
+        return self.f.write(data)
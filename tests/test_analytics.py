@@ -0,0 +1,98 @@
+"""
+analytics.py：事件批次寫入 SQLite 後的每小時彙總與報表；WaitEstimator 的預估等候
+"""
+import os, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from analytics import WAIT_BUCKETS, AnalyticsStore, WaitEstimator, quantile
+
+T0 = int(time.time()) // 3600 * 3600 - 3 * 3600   # 三小時前的整點；太舊的 tickets 會被清掉
+
+
+def store(tmp_path):
+    s = AnalyticsStore(str(tmp_path / "analytics.db"))
+    s.start()
+    return s
+
+
+def test_report_rolls_up_waits_and_service_time(tmp_path):
+    s = store(tmp_path)
+    for n in (1, 2, 3):
+        s.record_issued(n, ts=T0 + n)
+    s.record_called(1, ts=T0 + 61)      # 等 60 秒
+    s.record_called(2, ts=T0 + 122)     # 等 120 秒，間隔 61
+    s.record_called(3, ts=T0 + 3600 + 183)   # 下一個小時，間隔 3661 當休息不算
+    assert s.flush() == 6
+
+    r = s.report(T0, T0 + 7200)
+    assert (r["issued"], r["called"], r["active_hours"]) == (3, 3, 2)
+    assert r["wait"]["samples"] == 3 and r["wait"]["max"] == 3780.0
+    assert r["wait"]["avg"] == round((60 + 120 + 3780) / 3, 1)
+    assert r["service_time"] == 61.0
+    assert [h["issued"] for h in r["hourly"]] == [3, 0]
+    assert [h["called"] for h in r["hourly"]] == [2, 1]
+    assert r["peak_hours"][0] == {"hour": T0, "issued": 3}
+
+
+def test_duplicate_events_count_once_and_merge_across_flushes(tmp_path):
+    s = store(tmp_path)
+    s.record_issued(1, ts=T0)
+    s.record_called(1, ts=T0 + 30)
+    s.flush()
+    s.record_issued(1, ts=T0 + 40)      # 重播上游狀態
+    s.record_called(1, ts=T0 + 50)
+    s.record_issued(2, ts=T0 + 60)
+    s.flush()
+    r = s.report(T0, T0 + 3600)
+    assert (r["issued"], r["called"], r["wait"]["samples"]) == (2, 1, 1)
+    assert r["wait"]["max"] == 30.0
+
+
+def test_reset_starts_a_new_epoch(tmp_path):
+    s = store(tmp_path)
+    s.record_issued(1, ts=T0)
+    s.reset(ts=T0 + 10)
+    s.record_issued(1, ts=T0 + 20)
+    s.record_called(1, ts=T0 + 50)
+    s.flush()
+    assert s.ticket(1)["issued"] == T0 + 20
+    assert s.ticket(1, epoch=0)["called"] is None
+    assert s.report(T0, T0 + 3600)["issued"] == 2
+
+
+def test_quantile_interpolates_within_bucket():
+    hist = [0] * (len(WAIT_BUCKETS) + 1)
+    hist[1] = 4                         # 4 筆落在 15–30 秒
+    assert quantile(hist, 0.5) == 22.5
+    assert quantile(hist, 1.0, vmax=20) == 20
+    hist[-1] = 4                        # 超過最大桶：回傳 vmax
+    assert quantile(hist, 0.95, vmax=9000) == 9000
+    assert quantile([0] * len(hist), 0.5) is None
+
+
+def test_wait_estimator_needs_min_calls():
+    est = WaitEstimator(min_calls=3)
+    est.seed([T0, T0 + 60])
+    assert est.seconds_per_call(now=T0 + 60) is None
+    assert est.minutes(5, now=T0 + 60) is None
+
+
+def test_wait_estimator_minutes_round_up():
+    est = WaitEstimator()
+    for ts in (T0, T0 + 50, T0 + 100, T0 + 150):
+        est.observe(ts)
+    est.observe(T0 + 120)               # 時間倒退的不算
+    assert est.seconds_per_call(now=T0 + 150) == 50
+    assert est.minutes(0, now=T0 + 150) == 0
+    assert est.minutes(1, now=T0 + 150) == 1
+    assert est.minutes(3, now=T0 + 150) == 3   # 150 秒 → 進位成 3 分
+
+
+def test_wait_estimator_drops_calls_outside_window():
+    est = WaitEstimator(window=300, min_calls=2)
+    est.seed([T0, T0 + 200, T0 + 400, T0 + 430])
+    # T0+450 時只剩 200 之後的三筆：(430 - 200) / 2
+    assert est.seconds_per_call(now=T0 + 450) == 115
+    assert est.seconds_per_call(now=T0 + 1000) is None
@@ -0,0 +1,103 @@
+"""
+queuepad/escpos.py 的純函式：raster 編碼（plain / bands）、NV 圖、狀態解析
+"""
+import os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from queuepad import escpos
+from queuepad.escpos import MIN_BLANK_RUN, encode_raster, gs_v0, job_bytes, nv_define, nv_print, parse_status
+
+WB = 2
+
+
+def raster(rows):
+    """每列 True=有內容（整列黑）/ False=空白"""
+    return b"".join(b"\xFF" * WB if r else bytes(WB) for r in rows), len(rows)
+
+
+def test_plain_is_one_gs_v0():
+    data, h = raster([True, False, True])
+    assert encode_raster(data, WB, h) == gs_v0(data, WB, h)
+    assert gs_v0(data, WB, h)[:8] == b"\x1D\x76\x30\x00\x02\x00\x03\x00"
+
+
+def test_bands_feeds_long_blank_runs():
+    data, h = raster([True] * 3 + [False] * 300 + [True] * 2)
+    out = encode_raster(data, WB, h, "bands")
+    # 300 點空白拆成 ESC J 255 + ESC J 45
+    assert out == (gs_v0(data[:3 * WB], WB, 3) + b"\x1B\x4A\xFF" + b"\x1B\x4A\x2D"
+                   + gs_v0(data[-2 * WB:], WB, 2))
+
+
+def test_bands_keeps_short_blank_runs_inside_band():
+    rows = [True] + [False] * (MIN_BLANK_RUN - 1) + [True]
+    data, h = raster(rows)
+    assert encode_raster(data, WB, h, "bands") == gs_v0(data, WB, h)
+
+
+def test_bands_trailing_blank_is_fed():
+    data, h = raster([True, True] + [False] * 3)
+    assert encode_raster(data, WB, h, "bands") == gs_v0(data[:2 * WB], WB, 2) + b"\x1B\x4A\x03"
+
+
+def test_job_bytes_wraps_init_and_cut():
+    data, h = raster([True])
+    out = job_bytes(data, WB, h)
+    assert out.startswith(escpos.INIT + escpos.LINE_SPACING)
+    assert out.endswith(escpos.FEED_CUT)
+
+
+def nv_plan(h, segments):
+    return {"hash": "x", "segments": segments, "raster": b"", "width_bytes": WB, "height": h}
+
+
+def test_job_bytes_prints_static_segments_from_nv():
+    data, h = raster([True] * 4 + [True] * 2 + [True] * 4)
+    plan = nv_plan(h, [(0, 4, b"B0"), (4, 6, None), (6, 10, b"B1")])
+    body = nv_print(b"B0") + gs_v0(data[4 * WB:6 * WB], WB, 2) + nv_print(b"B1")
+    assert job_bytes(data, WB, h, "plain", plan) == escpos.INIT + escpos.LINE_SPACING + body + escpos.FEED_CUT
+
+
+def test_job_bytes_ignores_nv_plan_of_other_size():
+    data, h = raster([True] * 4)
+    plan = nv_plan(h + 1, [(0, h + 1, b"B0")])
+    assert job_bytes(data, WB, h, "plain", plan) == job_bytes(data, WB, h)
+
+
+def test_nv_print_and_define_headers():
+    assert nv_print(b"B0") == b"\x1D\x28\x4C\x06\x00\x30\x45B0\x01\x01"
+    data, h = raster([True] * 3)
+    out = nv_define(b"B0", data, WB, h)
+    # GS ( L pL pH：參數長度 = 3 (m fn a) + 2 (key) + 6 (b xL xH yL yH c) + raster
+    size = 3 + 2 + 6 + len(data)
+    assert out[:5] == b"\x1D\x28\x4C" + bytes([size & 0xFF, size >> 8])
+    assert out[5:10] == b"\x30\x43\x30B0"
+    assert out[10:16] == bytes([1, WB * 8, 0, h, 0, 49])
+    assert out[16:] == data
+
+
+def test_parse_status_ready():
+    assert parse_status(b"\x16\x12\x12") == {"online": True, "cover_open": False, "paper_out": False,
+                                               "paper_near_end": False, "error": False}
+
+
+def test_parse_status_short_reply_is_unknown():
+    assert parse_status(b"") is None
+    assert parse_status(b"\x16\x12") is None
+
+
+def test_parse_status_problem_priority():
+    # 缺紙 + 上蓋開 + 錯誤：先報缺紙
+    st = parse_status(bytes([0x1E, 0x64, 0x00]))
+    assert st["paper_out"] and st["cover_open"] and st["error"] and not st["online"]
+    assert st["problem"] == "paper_out"
+    assert parse_status(bytes([0x16, 0x16, 0x12]))["problem"] == "cover_open"
+    assert parse_status(bytes([0x1E, 0x12, 0x12]))["problem"] == "offline"
+
+
+def test_parse_status_paper_sensor_bits():
+    assert parse_status(bytes([0x16, 0x12, 0x6C]))["paper_out"]
+    st = parse_status(bytes([0x16, 0x12, 0x1E]))
+    assert st["paper_near_end"] and not st["paper_out"] and "problem" not in st
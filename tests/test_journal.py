@@ -0,0 +1,68 @@
+"""
+journal.py：append → fsync → 重播、checkpoint 後清空日誌、斷電留下的半行
+"""
+import json, os, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from journal import Journal, apply, empty_state
+
+
+def open_journal(tmp_path, **kw):
+    return Journal(str(tmp_path / "journal.log"), str(tmp_path / "checkpoint.json"),
+                   flush_interval=0.01, **kw)
+
+
+def test_recover_replays_flushed_records(tmp_path):
+    j = open_journal(tmp_path)
+    j.recover()
+    j.append("snapshot", current=5, waiting=[6, 7])
+    j.append("printed", numbers=[6])
+    j.append("audio_ready", number=6)
+    j.append("announced", number=5)
+    assert j.flush()
+
+    st = open_journal(tmp_path).recover()
+    assert (st["current"], st["waiting"], st["printed"]) == (5, [6, 7], [6])
+    assert (st["audio_ready"], st["announced"]) == ([6], [5])
+    assert st["replayed"] == 4 and st["seq"] == 4
+
+
+def test_checkpoint_truncates_log_and_keeps_seq(tmp_path):
+    j = open_journal(tmp_path)
+    j.recover()
+    for n in range(1, 4):
+        j.append("issued", number=900 + n)
+    assert j.flush()
+    j.checkpoint()
+    assert os.path.getsize(tmp_path / "journal.log") == 0
+    with open(tmp_path / "checkpoint.json") as f:
+        assert json.load(f)["seq"] == 3
+
+    j.append("called", number=901)
+    assert j.flush()
+    st = open_journal(tmp_path).recover()
+    assert st["replayed"] == 1 and st["seq"] == 4
+    assert (st["local_waiting"], st["local_current"], st["local_next"]) == ([902, 903], 901, 904)
+
+
+def test_recover_skips_old_seq_and_torn_last_line(tmp_path):
+    with open(tmp_path / "checkpoint.json", "w") as f:
+        json.dump(empty_state() | {"seq": 2, "waiting": [3]}, f)
+    with open(tmp_path / "journal.log", "w") as f:
+        f.write(json.dumps({"seq": 2, "t": "reset"}) + "\n")        # checkpoint 前的舊紀錄
+        f.write(json.dumps({"seq": 3, "t": "printed", "numbers": [3]}) + "\n")
+        f.write('{"seq": 4, "t": "snapsh')                          # 斷電留下的半行
+    st = open_journal(tmp_path).recover()
+    assert st["replayed"] == 1 and st["seq"] == 3
+    assert (st["waiting"], st["printed"], st["resets"]) == ([3], [3], 0)
+
+
+def test_apply_drops_announcements_for_numbers_no_longer_live():
+    st = empty_state()
+    apply(st, {"seq": 1, "t": "snapshot", "current": 5, "waiting": [6]})
+    apply(st, {"seq": 2, "t": "announced", "number": 5})
+    apply(st, {"seq": 3, "t": "audio_ready", "number": 6})
+    apply(st, {"seq": 4, "t": "snapshot", "current": 7, "waiting": []})
+    assert st["announced"] == [] and st["audio_ready"] == []
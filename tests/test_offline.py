@@ -0,0 +1,97 @@
+"""
+離線模式：上游（tools/upstream_sim.py 的 outage 軌跡）斷線時 /api/status 回最後已知狀態，
+可以本機發號/叫號；上游恢復、清單裡出現本機號碼後記為 adopted。
+
+app 的路徑都跟著 app.py 所在資料夾，所以複製一份到暫存資料夾再匯入，不碰到 repo 裡的 static/。
+"""
+import json, os, shutil, sys, time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PW = "?pw=yellowgirl"
+
+
+def wait_until(pred, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if pred():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture(scope="module")
+def env(tmp_path_factory):
+    work = tmp_path_factory.mktemp("queuepad")
+    for name in os.listdir(ROOT):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(ROOT, name), work)
+    for name in ("queuepad", "templates", "tools"):
+        shutil.copytree(os.path.join(ROOT, name), work / name, ignore=shutil.ignore_patterns("__pycache__"))
+    (work / "static" / "print").mkdir(parents=True)
+    sys.path[:0] = [str(work), str(work / "tools")]
+
+    from upstream_sim import TraceServer, generate
+    # 100 秒的軌跡，40–60 秒一律回 503
+    sim = TraceServer(generate("outage", duration=100, seed=1), port=0).start()
+    (work / "static" / "print" / "server_url.txt").write_text("http://%s:%s/status" % sim.address)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("QUEUEPAD_PRINTER", "fake")
+        mp.setenv("QUEUEPAD_TTS", "cache")
+        mp.setenv("QUEUEPAD_UPSTREAM", "poll")
+        mp.setenv("QUEUEPAD_ROLE", "standalone")
+        import app
+        app.POLL_INTERVAL = 0.1
+        app.OFFLINE_AFTER = 1
+        app.create_app(start_services=False, warmup=False)
+        app.MONITOR.start()       # 只跑監控核心；列印佇列不啟動，本機發號的票留在佇列裡
+        try:
+            yield app, sim, work
+        finally:
+            app.MONITOR.stop()
+            sim.stop()
+            for name, mod in list(sys.modules.items()):
+                if str(getattr(mod, "__file__", "") or "").startswith(str(work)):
+                    del sys.modules[name]
+            sys.path.remove(str(work))
+            sys.path.remove(str(work / "tools"))
+
+
+def test_outage_local_issue_and_adoption(env):
+    app, sim, work = env
+    client = app.app.test_client()
+    assert wait_until(lambda: app.MONITOR.snapshot is not None), "監控核心沒有輪詢到上游"
+    assert client.get("/api/status").get_json()["stale"] is False
+
+    # 跳到軌跡的斷線區段
+    sim.start_time = time.time() - 45
+    assert wait_until(lambda: client.get("/api/status").get_json().get("stale") is True)
+    r = client.get("/api/status")
+    assert r.status_code == 200
+    last = r.get_json()
+    assert last["current"] == app.MONITOR.snapshot["current"]
+
+    issued = [client.post("/api/local/issue" + PW).get_json() for _ in range(2)]
+    assert [d["ok"] for d in issued] == [True, True]
+    first, second = issued[0]["number"], issued[1]["number"]
+    assert first >= app.LOCAL_ISSUE_START and second == first + 1
+
+    called = client.post("/api/local/call" + PW).get_json()
+    assert called == {"ok": True, "number": first}
+    st = client.get("/api/status").get_json()
+    assert st["stale"] is True and st["current"] == first
+    assert st["local"] == [second] and second in st["waiting"]
+
+    # 恢復：店員已在上游補登本機的號碼
+    waiting = sorted(set(app.MONITOR.snapshot["waiting"]) | {second})
+    sim.frames = [{"t": 0, "current": last["current"], "waiting": waiting}]
+    assert wait_until(lambda: second not in app.JOURNAL.snapshot()["local_waiting"]), "恢復後沒有接手本機號碼"
+    st = client.get("/api/status").get_json()
+    assert st["stale"] is False and st["local"] == []
+
+    app.JOURNAL.flush()
+    with open(app.JOURNAL_FILE) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    assert [r["numbers"] for r in records if r["t"] == "adopted"] == [[second]]
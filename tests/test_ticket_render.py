@@ -0,0 +1,36 @@
+"""
+pack_bits_raster：mode '1' → GS v 0 的打包 raster（黑點=1，每列補齊到整數 byte）
+"""
+import os, sys
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ticket_render import pack_bits_raster
+
+
+def test_white_rows_pack_to_zero_including_padding():
+    # 寬度不是 8 的倍數：反相後補齊位元不能變成黑點
+    data, wb, h = pack_bits_raster(Image.new("1", (13, 3), 1))
+    assert (wb, h) == (2, 3)
+    assert data == bytes(6)
+
+
+def test_black_rows_keep_padding_clear():
+    data, wb, h = pack_bits_raster(Image.new("1", (13, 2), 0))
+    assert data == b"\xFF\xF8" * 2
+
+
+def test_pixels_msb_first():
+    img = Image.new("1", (16, 1), 1)
+    img.putpixel((0, 0), 0)
+    img.putpixel((9, 0), 0)
+    assert pack_bits_raster(img) == (b"\x80\x40", 2, 1)
+
+
+def test_byte_aligned_width_has_no_mask():
+    data, wb, h = pack_bits_raster(Image.new("1", (384, 1), 0))
+    assert (wb, h) == (48, 1)
+    assert data == b"\xFF" * 48
@@ -0,0 +1,217 @@
+"""
+票面合成與 raster 打包
+
+不依賴 Flask 與 app.py 的全域狀態，所以可以在 render 子行程裡直接執行：
+子行程啟動時先 init_worker() 把背景與字體載好，之後每張票只做
+號碼 / 等候人數 / 預估等候 / QR 的合成、二值化與打包。
+"""
+import os, urllib.parse
+from io import BytesIO
+
+from lazy import lazy_import
+from logconf import get_logger
+
+# PIL / requests 第一次合成票面時才載入（子行程在 init_worker 就會載好）
+requests = lazy_import("requests")
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
+
+log = get_logger("printer")
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# 線上 QR 產生服務；測試/壓測時可指到本機 stub
+QR_API_URL = os.getenv("QR_API_URL", "https://api.qrserver.com/v1/create-qr-code/")
+
+# 票面版面（58mm：寬 384 dots，高 640）
+TICKET_W, TICKET_H = 384, 640
+NUMBER_Y, WAITING_Y, ETA_Y = 140, 290, 318
+QR_RATIO, QR_BOTTOM = 0.45, 100
+THRESHOLD = 128
+
+_INVERT_BITS = bytes(0xFF - i for i in range(256))
+
+
+# ---------------- 字體 ----------------
+def load_font(size: int):
+    # 專案自帶字體
+    proj_font = os.path.join(STATIC_FOLDER, "fonts", "NotoSansTC-SemiBold.ttf")
+    if os.path.exists(proj_font):
+        try:
+            return ImageFont.truetype(proj_font, size)
+        except Exception as e:
+            log.warning("[字體載入失敗] %s", e)
+
+    # 如果自帶字體失敗，才退回系統字體
+    candidates = [
+        "/usr/share/fonts/truetype/noto/NotoSansTC-Regular.otf",
+        "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+        "/System/Library/Fonts/Supplemental/Songti.ttc",
+        "/System/Library/Fonts/PingFang.ttc"
+    ]
+    for p in candidates:
+        if os.path.exists(p):
+            try:
+                return ImageFont.truetype(p, size)
+            except:
+                pass
+
+    # 最後 fallback
+    return ImageFont.load_default()
+
+_FONTS = {}
+
+def font(size: int):
+    """快取版 load_font；字體檔每個行程只解析一次"""
+    if size not in _FONTS:
+        _FONTS[size] = load_font(size)
+    return _FONTS[size]
+
+
+# ---------------- 背景 ----------------
+def cover_bg(path: str, W: int, H: int):
+    """讀取列印背景並 cover 裁切到 W x H；沒有背景時回傳 None"""
+    if not os.path.exists(path):
+        return None
+    bg = Image.open(path).convert("RGB")
+    sw, sh = bg.size
+    scale = max(W / sw, H / sh)
+    bg = bg.resize((int(sw * scale), int(sh * scale)), Image.LANCZOS)
+
+    # === 調整垂直偏移 ===
+    vertical_offset = 0   # 負數=往上移，正數=往下移
+    left = (bg.size[0] - W) // 2
+    top  = (bg.size[1] - H) // 2 + vertical_offset
+
+    # 避免超界
+    if top < 0:
+        top = 0
+    if top + H > bg.size[1]:
+        top = bg.size[1] - H
+
+    return bg.crop((left, top, left + W, top + H))
+
+_BG = {"key": None, "img": None}
+
+def template_bg(path: str, W: int = TICKET_W, H: int = TICKET_H):
+    """快取版 cover_bg；背景檔 mtime 變了才重算"""
+    key = (path, os.path.getmtime(path) if os.path.exists(path) else None, W, H)
+    if _BG["key"] != key:
+        _BG.update(key=key, img=cover_bg(path, W, H))
+    return _BG["img"]
+
+
+# ---------------- 合成 ----------------
+def eta_text(eta) -> str:
+    return f"預估等候約 {eta} 分鐘"
+
+def build_qr_img(number: int, waiting: int, url_tpl: str, eta=None):
+    # 使用線上服務產 QR（PNG）；{eta} 是預估分鐘數，還估不出來時留空
+    final_url = url_tpl.format(number=number, waiting=waiting, eta="" if eta is None else eta)
+    # 改善 QR code 品質：增加尺寸、邊距，使用更高解析度
+    qr_url = f"{QR_API_URL}?size=800x800&format=png&margin=2&ecc=M&data={urllib.parse.quote(final_url, safe='')}"
+    r = requests.get(qr_url, timeout=6)
+    r.raise_for_status()
+    return Image.open(BytesIO(r.content)).convert("RGBA")
+
+def draw_centered_text(draw, text, font, y, fill=(0,0,0), canvas_width=384):
+    """在指定 y 座標，文字水平置中繪製"""
+    bbox = draw.textbbox((0, 0), text, font=font)
+    text_w = bbox[2] - bbox[0]
+    x = (canvas_width - text_w) // 2
+    draw.text((x, y), text, font=font, fill=fill)
+
+def ticket_dynamic_rows(W: int = TICKET_W, H: int = TICKET_H, pad: int = 4):
+    """每張票都會變的列範圍（號碼、等候人數、預估等候、QR）；其餘列只有背景"""
+    rows = []
+    for text, size, y in (("0123456789", 90, NUMBER_Y), ("目前 0123456789 人等候中", 20, WAITING_Y),
+                          (eta_text("0123456789"), 20, ETA_Y)):
+        _, top, _, bottom = font(size).getbbox(text)
+        rows.append((max(0, y + top - pad), min(H, y + bottom + pad)))
+    qr_size = int(W * QR_RATIO)
+    qr_y = H - qr_size - QR_BOTTOM
+    rows.append((max(0, qr_y - pad), min(H, qr_y + qr_size + pad)))
+
+    merged = []
+    for y0, y1 in sorted(rows):
+        if merged and y0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], y1))
+        else:
+            merged.append((y0, y1))
+    return merged
+
+def render_canvas(number: int, waiting: int, bg_path: str, qr_template: str, eta=None) -> "Image.Image":
+    # 58mm 出單機：寬度 384 dots，高度 640
+    W, H = TICKET_W, TICKET_H
+    canvas = Image.new("RGB", (W, H), (255, 255, 255))
+
+    # 背景 (cover 到 384x640)
+    bg = template_bg(bg_path, W, H)
+    if bg is not None:
+        canvas.paste(bg, (0, 0))
+
+    draw = ImageDraw.Draw(canvas)
+
+    # 號碼置中
+    draw_centered_text(draw, str(number), font(90), NUMBER_Y, fill=(255, 255, 255), canvas_width=W)
+
+    # 等候人數置中
+    draw_centered_text(draw, f"目前 {waiting} 人等候中", font(20), WAITING_Y, fill=(0, 0, 0), canvas_width=W)
+
+    # 預估等候（叫號資料還不夠時不印）
+    if eta:
+        draw_centered_text(draw, eta_text(eta), font(20), ETA_Y, fill=(0, 0, 0), canvas_width=W)
+
+    # QR code 底部留白
+    qr = build_qr_img(number, waiting, qr_template, eta)
+    qr_size = int(W * QR_RATIO)  # 保持原本尺寸
+    qr = qr.resize((qr_size, qr_size), Image.LANCZOS)
+    qr_x = (W - qr_size) // 2
+    qr_y = H - qr_size - QR_BOTTOM  # 保持原本位置
+    canvas.paste(qr, (qr_x, qr_y), qr)
+    return canvas
+
+
+# ---------------- 二值化 / 打包 ----------------
+def binarize(img: "Image.Image", target_width: int = TICKET_W) -> "Image.Image":
+    """等比縮放到印表機寬度後以固定閾值轉成 mode '1'"""
+    w, h = img.size
+    if w != target_width:
+        nh = int(h * (target_width / w))
+        img = img.resize((target_width, nh), Image.LANCZOS)
+    return img.convert("L").point(lambda x: 0 if x < THRESHOLD else 255, '1')
+
+def pack_bits_raster(img_1b: "Image.Image"):
+    # 依 GS v 0 Raster 格式（每列打包成 bytes）
+    # mode '1' 的 tobytes 已是 MSB 在前、每列補齊到整數 byte；白=1，反相後黑點=1
+    w, h = img_1b.size
+    width_bytes = (w + 7) // 8
+    data = img_1b.convert("1").tobytes().translate(_INVERT_BITS)
+    if w % 8:
+        # 補齊的位元反相後變成黑點，清掉每列最後一個 byte 的補齊位元（空白列才會是全 0）
+        keep = (0xFF << (8 - w % 8)) & 0xFF
+        buf = bytearray(data)
+        buf[width_bytes - 1::width_bytes] = bytes(buf[width_bytes - 1::width_bytes]).translate(
+            bytes(i & keep for i in range(256)))
+        data = bytes(buf)
+    return data, width_bytes, h
+
+def ticket_raster(img: "Image.Image", target_width: int = TICKET_W):
+    """票面圖 → (raster, width_bytes, height)"""
+    return pack_bits_raster(binarize(img, target_width))
+
+
+# ---------------- render 子行程 ----------------
+def init_worker(bg_path: str):
+    """子行程初始化：先載入字體與背景，第一張票就不用等"""
+    font(90)
+    font(20)
+    template_bg(bg_path)
+
+def render_rasters(number: int, waiting: int, template: dict, widths, eta=None) -> dict:
+    """(號碼, 等候人數, 版面, 預估分鐘) → {印表機寬度: (raster, width_bytes, height)}
+
+    template = {"bg": 背景路徑, "qr": QR 網址模板}；背景換檔時 template_bg 依 mtime 自動重算
+    """
+    canvas = render_canvas(number, waiting, template["bg"], template["qr"], eta)
+    return {w: ticket_raster(canvas, w) for w in widths}
@@ -0,0 +1,150 @@
+"""
+啟動時間基準測試（import-time benchmark）
+
+量測「行程啟動 → 第一個 / 回應」的時間，並用 python -X importtime 列出
+app 匯入時最花時間的模組。app 會在暫存資料夾的副本裡執行，上游用
+upstream_sim 的 stub，不會動到本機的日誌、列印佇列與音檔。
+
+用法：
+    python tools/bench_startup.py                   # 預設 5 次
+    python tools/bench_startup.py -n 10 --no-warmup # 關掉背景預熱比較
+    python tools/bench_startup.py --role edge       # edge 顯示端（hub 用 stub）
+    python tools/bench_startup.py -o pi.json        # 結果寫成 JSON
+"""
+import argparse, json, os, platform, shutil, signal, socket, statistics, subprocess, sys, tempfile, time
+import urllib.error, urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from upstream_sim import TraceServer
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_sandbox(upstream_url):
+    """複製程式碼、queuepad 套件與模板到暫存資料夾；static 只放空資料夾與上游網址"""
+    tmp = tempfile.mkdtemp(prefix="queuepad-startup-")
+    for f in os.listdir(ROOT):
+        if f.endswith(".py"):
+            shutil.copy2(os.path.join(ROOT, f), tmp)
+    for d in ("templates", "queuepad"):
+        shutil.copytree(os.path.join(ROOT, d), os.path.join(tmp, d),
+                        ignore=shutil.ignore_patterns("__pycache__"))
+    for d in ("ads", "audio", "print"):
+        os.makedirs(os.path.join(tmp, "static", d))
+    with open(os.path.join(tmp, "static", "print", "server_url.txt"), "w") as f:
+        f.write(upstream_url)
+    return tmp
+
+
+def time_first_response(cwd, env, timeout=60.0):
+    """啟動 app.py，回傳 (到第一個 / 200 的毫秒數, 行程)"""
+    port = int(env["QUEUEPAD_PORT"])
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "app.py"], cwd=cwd, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    while time.perf_counter() - t0 < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app.py 提早結束（exit {proc.returncode}）")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as r:
+                if r.status == 200:
+                    return (time.perf_counter() - t0) * 1000, proc
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.005)
+    stop(proc)
+    raise TimeoutError(f"{timeout:.0f}s 內沒有回應")
+
+
+def stop(proc):
+    """連同 render 子行程整組結束，下一次量測才不會被殘留的行程拖慢"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+    # 子行程收到 SIGTERM 後可能還在收尾
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            os.killpg(proc.pid, 0)
+        except ProcessLookupError:
+            return
+        time.sleep(0.05)
+
+
+def import_profile(cwd, env, top=12):
+    """python -X importtime -c 'import app'：回傳 (總毫秒, [(模組, 累計毫秒)]) 只列第一層"""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                         cwd=cwd, env=env, capture_output=True, text=True, timeout=120)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue      # 表頭
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(cumulative) / 1000, depth))
+    total = next((ms for name, ms, _ in rows if name == "app"), None)
+    first = sorted(((n, ms) for n, ms, d in rows if d == 1), key=lambda r: -r[1])
+    return total, first[:top]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="QueuePad 啟動時間基準測試")
+    ap.add_argument("-n", "--runs", type=int, default=5)
+    ap.add_argument("--no-warmup", action="store_true", help="QUEUEPAD_WARMUP=off")
+    ap.add_argument("--role", choices=("standalone", "edge"), default="standalone")
+    ap.add_argument("-o", "--out", help="結果寫成 JSON")
+    args = ap.parse_args()
+
+    upstream = TraceServer([{"t": 0, "current": None, "waiting": []}], port=0).start()
+    stub_url = f"http://127.0.0.1:{upstream.address[1]}"
+    sandbox = make_sandbox(f"{stub_url}/status")
+    env = dict(os.environ, LOG_FILE="", QUEUEPAD_ROLE=args.role,
+               QUEUEPAD_WARMUP="off" if args.no_warmup else "on")
+    if args.role == "edge":
+        env["HUB_URL"] = stub_url       # stub 不提供事件串流，edge 會一直重連，不影響首頁
+    try:
+        import_ms, modules = import_profile(sandbox, env)
+        print(f"[import] app 匯入 {import_ms:.1f} ms，最慢的第一層模組：")
+        for name, ms in modules:
+            print(f"    {ms:8.1f} ms  {name}")
+
+        results = []
+        for i in range(args.runs):
+            env["QUEUEPAD_PORT"] = str(_free_port())
+            ms, proc = time_first_response(sandbox, env)
+            stop(proc)
+            results.append(ms)
+            print(f"[啟動] 第 {i + 1} 次：{ms:.0f} ms 到第一個 / 回應")
+        print(f"[啟動] p50 {statistics.median(results):.0f} ms  min {min(results):.0f} ms  "
+              f"max {max(results):.0f} ms（{args.runs} 次，warmup={'off' if args.no_warmup else 'on'}，"
+              f"role={args.role}）")
+    finally:
+        upstream.stop()
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"machine": platform.machine(), "python": platform.python_version(),
+                       "role": args.role, "warmup": not args.no_warmup,
+                       "import_ms": import_ms, "import_modules": modules,
+                       "first_response_ms": results,
+                       "p50_ms": statistics.median(results)}, f, ensure_ascii=False, indent=2)
+        print(f"[啟動] 結果寫入 {args.out}")
+
+
+if __name__ == "__main__":
+    main()
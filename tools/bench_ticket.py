@@ -0,0 +1,227 @@
+"""
+票面流程微基準測試
+
+分段量測正式出單路徑的每個階段：字體載入、背景 cover 裁切、QR、
+RENDERER 合成 + 打包 raster（子行程池，含 IPC）、ESC/POS 編碼（plain / bands / NV）、
+socket 送出、PRINTER_POOL.print_batch 整段。印表機用 tools/fake_printer.py、
+QR 服務用本機 stub，不需要硬體與網路。
+
+用法：
+    python tools/bench_ticket.py                       # 預設 50 次
+    python tools/bench_ticket.py -n 200 -o pi.json     # 結果寫成 JSON
+    python tools/bench_ticket.py --compare x86.json    # 和舊結果比較
+"""
+import argparse, json, os, platform, random, resource, socket
+import subprocess, sys, threading, time, tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_printer import FakePrinter
+
+
+# ---------------- Stub 伺服器 ----------------
+class _QRHandler(BaseHTTPRequestHandler):
+    """假 QR 服務：永遠回同一張 800x800 PNG"""
+    png = b""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.png)))
+        self.end_headers()
+        self.wfile.write(self.png)
+
+    def log_message(self, *args):
+        pass
+
+
+def _fake_qr_png(size=800, modules=37):
+    # 隨機黑白方塊，大小與壓縮率接近真的 QR
+    from PIL import Image, ImageDraw
+    rnd = random.Random(42)
+    img = Image.new("RGB", (size, size), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    cell = size // modules
+    for y in range(modules):
+        for x in range(modules):
+            if rnd.random() < 0.5:
+                draw.rectangle((x * cell, y * cell, (x + 1) * cell - 1, (y + 1) * cell - 1), fill=(0, 0, 0))
+    buf = BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def start_qr_stub():
+    _QRHandler.png = _fake_qr_png()
+    qr = ThreadingHTTPServer(("127.0.0.1", 0), _QRHandler)
+    threading.Thread(target=qr.serve_forever, daemon=True).start()
+    return qr
+
+
+def use_printers(app, addresses):
+    """PRINTER_POOL 改用這些 (host, port)，不動 printers.txt；設定檔沒變就一直用這組"""
+    pool = app.PRINTER_POOL
+    with pool.lock:
+        pool.printers = {f"{host}:{port}": app.PrinterState(host, port, app.PRINTER_MAX_DOTS,
+                                                            app.PRINTER_RASTER_MODE)
+                         for host, port in addresses}
+        pool.config_key = pool._config_key()
+
+
+# ---------------- 統計 ----------------
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = (len(sorted_vals) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_vals) - 1)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+
+def run_stage(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+
+    # 記憶體峰值另外跑一次（tracemalloc 會拖慢計時）
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples.sort()
+    return {
+        "n": iterations,
+        "mean_ms": round(sum(samples) / len(samples), 3),
+        "min_ms": round(samples[0], 3),
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+        "max_ms": round(samples[-1], 3),
+        "peak_mem_kb": round(peak / 1024, 1),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+# ---------------- 主程式 ----------------
+def main():
+    ap = argparse.ArgumentParser(description="票面流程微基準測試")
+    ap.add_argument("-n", "--iterations", type=int, default=50)
+    ap.add_argument("--warmup", type=int, default=3)
+    ap.add_argument("--number", type=int, default=999)
+    ap.add_argument("--waiting", type=int, default=12)
+    ap.add_argument("-o", "--out", help="結果 JSON 輸出路徑")
+    ap.add_argument("--compare", help="和先前的 JSON 結果比較 p50/p95")
+    args = ap.parse_args()
+
+    qr = start_qr_stub()
+    printer = FakePrinter("127.0.0.1", 0, None, verbose=False).start()
+    # QR 服務網址在 import 時讀取，子行程也繼承這個環境變數
+    os.environ["QR_API_URL"] = f"http://127.0.0.1:{qr.server_address[1]}/"
+
+    import app, ticket_render
+    from queuepad.escpos import job_bytes
+    app.create_app(start_services=False, warmup=False)   # 只建後端與資料夾，不啟動背景服務
+    from PIL import __version__ as pil_version
+    use_printers(app, [printer.address])
+    # 只量送出本身，不含送完後等 PRINT_CONFIRM_DELAY 再查狀態的固定等待
+    app.PRINT_CONFIRM_DELAY = 0
+    app.RENDERER.start()
+
+    W, H = app.TICKET_W, app.TICKET_H
+    n, waiting = args.number, args.waiting
+    ticket = app.render_ticket(n, waiting)
+    raster, wb, h = ticket[app.PRINTER_MAX_DOTS]
+    nv = app._nv_bg_plan()
+    payloads = {
+        "plain": job_bytes(raster, wb, h, "plain"),
+        "bands": job_bytes(raster, wb, h, "bands"),
+    }
+    if nv and any(key for _, _, key in nv["segments"]):
+        payloads["bands_nv"] = job_bytes(raster, wb, h, "bands", nv)
+    host, port = printer.address
+
+    def socket_send():
+        with socket.create_connection((host, port), timeout=10) as s:
+            s.sendall(payloads["bands"])
+
+    def print_batch():
+        if not all(left == 0 and held is None for left, held in app.PRINTER_POOL.print_batch([(ticket, 1)])):
+            raise RuntimeError("假印表機沒有收下")
+
+    stages = [
+        ("load_font", lambda: app._load_font(90)),
+        ("bg_cover_crop", lambda: app._cover_bg(W, H)),
+        ("build_qr_img", lambda: app.build_qr_img(n, waiting)),
+        ("render_ticket", lambda: app.render_ticket(n, waiting)),
+        ("render_in_process", lambda: ticket_render.render_rasters(
+            n, waiting, {"bg": app.PRINT_BG_FILE, "qr": app.get_qr_url_template()}, (app.PRINTER_MAX_DOTS,))),
+    ]
+    stages += [(f"encode_{mode}", lambda mode=mode: job_bytes(raster, wb, h, *(
+        ("bands", nv) if mode == "bands_nv" else (mode,)))) for mode in payloads]
+    stages += [
+        ("socket_send", socket_send),
+        ("print_batch", print_batch),
+    ]
+
+    results = {}
+    for name, fn in stages:
+        results[name] = run_stage(fn, args.iterations, args.warmup)
+        r = results[name]
+        print(f"{name:<22} p50 {r['p50_ms']:>9.2f} ms  p95 {r['p95_ms']:>9.2f} ms  "
+              f"p99 {r['p99_ms']:>9.2f} ms  peak {r['peak_mem_kb']:>9.1f} KB")
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "pillow": pil_version,
+            "iterations": args.iterations,
+            "payload_bytes": {mode: len(data) for mode, data in payloads.items()},
+            "render_workers": app.RENDER_WORKERS,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        "stages": results,
+    }
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[結果] 已寫入 {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print(f"\n與 {base['meta'].get('commit', '?')} ({base['meta'].get('machine', '?')}) 比較：")
+        for name, r in results.items():
+            old = base.get("stages", {}).get(name)
+            if not old:
+                continue
+            for key in ("p50_ms", "p95_ms"):
+                delta = (r[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+                print(f"  {name:<22} {key} {old[key]:>9.2f} → {r[key]:>9.2f} ms ({delta:+.1f}%)")
+
+    printer.stop()
+    qr.shutdown()
+
+
+if __name__ == "__main__":
+    main()
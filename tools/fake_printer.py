@@ -0,0 +1,381 @@
+"""
+假 ESC/POS 印表機（RAW 9100）
+
+解析 ESC @、GS v 0、ESC J、GS ( L（NV 圖形）、GS V 等指令，把每張票的 raster 還原成 PNG 方便檢查，
+並可模擬慢速吃紙、緩衝區滿卡住、連線被 reset、連線中斷，用來在沒有
+XPrinter 的情況下測 PRINTER_POOL 出單 / _test_printer_connection。
+
+用法：
+    python tools/fake_printer.py                         # 聽 0.0.0.0:9100，PNG 存到 fake_prints/
+    python tools/fake_printer.py --port 9101 --rate 20   # 模擬 20 KB/s 的慢速印表機
+    python tools/fake_printer.py --stall-every 3 --stall-secs 5
+    python tools/fake_printer.py --reset-every 5 --drop-prob 0.1
+    python tools/fake_printer.py --paper-out-after 4 --paper-out-secs 20
+
+app.py 端設定 PRINTER_PORT 環境變數並把 printer_ip.txt 改成本機 IP 即可。
+"""
+import argparse, collections, os, random, socket, socketserver, struct, sys, threading, time
+
+ESC, GS, DLE, FS, LF = 0x1B, 0x1D, 0x10, 0x1C, 0x0A
+
+# ESC x 後面固定參數長度
+_ESC_ARGS = {
+    ord("@"): 0, ord("2"): 0, ord("3"): 1, ord("J"): 1, ord("d"): 1, ord("a"): 1,
+    ord("E"): 1, ord("!"): 1, ord("M"): 1, ord("-"): 1, ord("G"): 1, ord("R"): 1,
+    ord("t"): 1, ord("{"): 1, ord(" "): 1, ord("$"): 2, ord("p"): 3, ord("V"): 1,
+}
+# GS x 後面固定參數長度（v、V、( 另外處理）
+_GS_ARGS = {
+    ord("!"): 1, ord("B"): 1, ord("L"): 2, ord("W"): 2, ord("a"): 1, ord("r"): 1,
+    ord("I"): 1, ord("H"): 1, ord("f"): 1, ord("h"): 1, ord("w"): 1, ord("k"): 1,
+}
+
+LINE_DOTS = 30          # ESC 2 預設行距約 1/6 吋（203 dpi）
+_INVERT = bytes(0xFF - i for i in range(256))
+
+
+class Job:
+    """一張票（以 GS V 切紙分隔）"""
+    def __init__(self):
+        self.rows = []          # 每列 raster bytes
+        self.width_bytes = 0
+        self.text = bytearray()
+        self.bytes_in = 0
+        self.started = time.time()
+
+    def feed_dots(self, n):
+        self.rows.extend([b""] * n)
+
+    def is_empty(self):
+        return not self.rows and not self.text
+
+    def to_image(self):
+        from PIL import Image
+        wb = max(self.width_bytes, 1)
+        data = b"".join(r.ljust(wb, b"\x00")[:wb] for r in self.rows)
+        # mode '1' 的 1=白；印表機 bit 1=黑，所以要反相
+        return Image.frombytes("1", (wb * 8, max(len(self.rows), 1)),
+                               data.translate(_INVERT) if data else b"\xFF" * wb)
+
+
+class EscPosParser:
+    """增量解析 ESC/POS 位元流；指令不完整時保留到下一次 feed"""
+
+    def __init__(self, on_job=None, status=None, nv=None):
+        self.buf = bytearray()
+        # NV 圖形記憶體（key → (width_bytes, rows)）；由 FakePrinter 提供以跨連線保存
+        self.nv = nv if nv is not None else {}
+        self.job = Job()
+        self.on_job = on_job or (lambda job: None)
+        # 即時狀態查詢 (DLE EOT n) 的回應
+        self.status = status or (lambda n: 0x12)
+        self.commands = {}
+
+    def _count(self, name):
+        self.commands[name] = self.commands.get(name, 0) + 1
+
+    def feed(self, data: bytes) -> bytes:
+        """吃進資料，回傳要回給主機的 bytes（狀態回應）"""
+        self.buf += data
+        self.job.bytes_in += len(data)
+        replies = bytearray()
+        while self.buf:
+            used = self._step(replies)
+            if used == 0:
+                break           # 指令不完整，等更多資料
+            del self.buf[:used]
+        return bytes(replies)
+
+    def _step(self, replies) -> int:
+        b = self.buf
+        c = b[0]
+        if c == ESC:
+            if len(b) < 2:
+                return 0
+            n = _ESC_ARGS.get(b[1], 0)
+            if len(b) < 2 + n:
+                return 0
+            cmd = b[1]
+            if cmd == ord("@"):
+                self._count("ESC @")
+            elif cmd == ord("J"):
+                self.job.feed_dots(b[2])
+            elif cmd == ord("d"):
+                self.job.feed_dots(b[2] * LINE_DOTS)
+            return 2 + n
+
+        if c == GS:
+            if len(b) < 2:
+                return 0
+            cmd = b[1]
+            if cmd == ord("v"):
+                # GS v 0 m xL xH yL yH d1...dk
+                if len(b) < 8:
+                    return 0
+                xb = b[4] | (b[5] << 8)
+                h = b[6] | (b[7] << 8)
+                size = xb * h
+                if len(b) < 8 + size:
+                    return 0
+                data = bytes(b[8:8 + size])
+                self.job.width_bytes = max(self.job.width_bytes, xb)
+                self.job.rows.extend(data[i * xb:(i + 1) * xb] for i in range(h))
+                self._count("GS v 0")
+                return 8 + size
+            if cmd == ord("V"):
+                # GS V m 或 GS V m n（m = 65/66 時）
+                if len(b) < 3:
+                    return 0
+                n = 4 if b[2] in (65, 66) else 3
+                if len(b) < n:
+                    return 0
+                self._count("GS V")
+                self._cut()
+                return n
+            if cmd == ord("("):
+                # GS ( x pL pH ...
+                if len(b) < 5:
+                    return 0
+                size = b[3] | (b[4] << 8)
+                if len(b) < 5 + size:
+                    return 0
+                self._count("GS (" + chr(b[2]))
+                if b[2] == ord("L"):
+                    self._graphics(bytes(b[5:5 + size]))
+                return 5 + size
+            n = _GS_ARGS.get(cmd, 0)
+            if len(b) < 2 + n:
+                return 0
+            if cmd == ord("I"):
+                # GS I n：印表機 ID（1=型號, 2=類型, 3=韌體版本）
+                replies.append({1: 0x20, 2: 0x02, 3: 0x64}.get(b[2], 0x00))
+                self._count("GS I")
+            return 2 + n
+
+        if c == DLE:
+            if len(b) < 3:
+                return 0
+            if b[1] == 0x04:
+                # DLE EOT n：即時狀態
+                replies.append(self.status(b[2]) & 0xFF)
+                self._count("DLE EOT")
+            return 3
+
+        if c == FS:
+            if len(b) < 2:
+                return 0
+            return 2
+
+        if c == LF:
+            if self.job.text and not self.job.text.endswith(b"\n"):
+                self.job.text += b"\n"
+            self.job.feed_dots(LINE_DOTS)
+            return 1
+
+        if c >= 0x20:
+            self.job.text.append(c)
+        return 1
+
+    def _graphics(self, p):
+        """GS ( L：NV 圖形定義 (fn 67)、刪除 (fn 66)、列印 (fn 69)"""
+        if len(p) < 4:
+            return
+        fn = p[1]
+        if fn == 67 and len(p) >= 11:
+            key = p[3:5]
+            xb = ((p[6] | (p[7] << 8)) + 7) // 8
+            h = p[8] | (p[9] << 8)
+            data = p[11:11 + xb * h]
+            self.nv[key] = (xb, [data[i * xb:(i + 1) * xb] for i in range(h)])
+            self._count("NV define")
+        elif fn == 66:
+            self.nv.pop(p[2:4], None)
+        elif fn == 69:
+            xb, rows = self.nv.get(p[2:4], (0, []))
+            self.job.width_bytes = max(self.job.width_bytes, xb)
+            self.job.rows.extend(rows)
+            self._count("NV print")
+
+    def _cut(self):
+        job, self.job = self.job, Job()
+        self.on_job(job)
+
+    def flush(self):
+        """連線結束時，把沒切紙的殘留資料也當成一張"""
+        if not self.job.is_empty():
+            self._cut()
+
+
+# ---------------- 伺服器 ----------------
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FakePrinter:
+    """可在其他工具裡直接 import 使用的假印表機"""
+
+    def __init__(self, host="0.0.0.0", port=9100, out_dir=None, rate_kbps=0.0,
+                 stall_every=0, stall_secs=0.0, reset_every=0, drop_prob=0.0,
+                 seed=None, verbose=True, paper_out_after=0, paper_out_secs=0.0):
+        self.out_dir = out_dir
+        self.rate = rate_kbps * 1024
+        self.stall_every, self.stall_secs = stall_every, stall_secs
+        self.reset_every, self.drop_prob = reset_every, drop_prob
+        self.rand = random.Random(seed)
+        self.paper_out_after, self.paper_out_secs = paper_out_after, paper_out_secs
+        self.paper_out = False
+        self.nv = {}
+        self.cover_open = False
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.stats = {"connections": 0, "jobs": 0, "bytes": 0, "resets": 0,
+                      "drops": 0, "stalls": 0, "lost": 0, "started": time.time()}
+        self.jobs = collections.deque(maxlen=100)   # 最近的票，給其他工具檢查
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+        printer = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                printer._serve(self.request)
+
+        self.server = _Server((host, port), Handler)
+        self.address = self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg, flush=True)
+
+    def status_byte(self, n):
+        """DLE EOT n 的回應（固定位元 1、4 為 1）"""
+        b = 0x12
+        if n == 2:
+            b |= (0x20 if self.paper_out else 0) | (0x04 if self.cover_open else 0)
+        elif n == 4:
+            b |= 0x60 if self.paper_out else 0
+        return b
+
+    def set_paper_out(self, out=True):
+        self.paper_out = out
+        self._log(f"[假印表機] {'缺紙' if out else '已補紙'}")
+
+    def _on_job(self, job):
+        if self.paper_out or self.cover_open:
+            # 缺紙/開蓋時資料照收，但實際上沒印出來
+            with self.lock:
+                self.stats["lost"] += 1
+            self._log(f"[假印表機] 缺紙/開蓋，{job.bytes_in} bytes 的票沒有印出")
+            return
+        with self.lock:
+            self.stats["jobs"] += 1
+            idx = self.stats["jobs"]
+            self.jobs.append(job)
+        path = ""
+        if self.out_dir and job.width_bytes:
+            path = os.path.join(self.out_dir, f"job_{idx:04d}.png")
+            job.to_image().save(path)
+        text = job.text.decode("ascii", "replace").strip()
+        self._log(f"[假印表機] 第 {idx} 張 {job.width_bytes * 8}x{len(job.rows)} "
+                  f"{job.bytes_in} bytes {path or text!r}")
+        if self.paper_out_after and idx == self.paper_out_after:
+            self.set_paper_out(True)
+            if self.paper_out_secs:
+                threading.Timer(self.paper_out_secs, self.set_paper_out, (False,)).start()
+        if self.stall_every and idx % self.stall_every == 0:
+            with self.lock:
+                self.stats["stalls"] += 1
+            self._log(f"[假印表機] 模擬緩衝區滿，暫停 {self.stall_secs}s")
+            time.sleep(self.stall_secs)
+
+    def _serve(self, conn):
+        with self.lock:
+            self.stats["connections"] += 1
+            conn_no = self.stats["connections"]
+        if self.rate:
+            # 縮小接收緩衝區，讓主機端真的被擋住
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        parser = EscPosParser(on_job=self._on_job, status=self.status_byte, nv=self.nv)
+        reset = self.reset_every and conn_no % self.reset_every == 0
+        drop = self.drop_prob and self.rand.random() < self.drop_prob
+        cut_at = self.rand.randint(1024, 16384) if (reset or drop) else 0
+        received = 0
+        try:
+            while True:
+                chunk = conn.recv(1024 if self.rate else 65536)
+                if not chunk:
+                    break
+                received += len(chunk)
+                with self.lock:
+                    self.stats["bytes"] += len(chunk)
+                if cut_at and received >= cut_at:
+                    if reset:
+                        # SO_LINGER 0 → close 時送 RST
+                        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                        with self.lock:
+                            self.stats["resets"] += 1
+                        self._log(f"[假印表機] 連線 {conn_no} 在 {received} bytes 時 reset")
+                    else:
+                        with self.lock:
+                            self.stats["drops"] += 1
+                        self._log(f"[假印表機] 連線 {conn_no} 在 {received} bytes 時中斷")
+                    return
+                reply = parser.feed(chunk)
+                if reply:
+                    conn.sendall(reply)
+                if self.rate:
+                    time.sleep(len(chunk) / self.rate)
+            parser.flush()
+        except OSError as e:
+            self._log(f"[假印表機] 連線 {conn_no} 錯誤: {e}")
+
+    def summary(self):
+        with self.lock:
+            s = dict(self.stats)
+        elapsed = max(time.time() - s.pop("started"), 1e-9)
+        s["elapsed_s"] = round(elapsed, 2)
+        s["jobs_per_min"] = round(s["jobs"] / elapsed * 60, 1)
+        s["kb_per_s"] = round(s["bytes"] / 1024 / elapsed, 1)
+        return s
+
+
+def main():
+    ap = argparse.ArgumentParser(description="假 ESC/POS 印表機")
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--out-dir", default="fake_prints", help="還原出的 PNG 存放目錄（空字串=不存）")
+    ap.add_argument("--rate", type=float, default=0.0, help="吃資料速度上限 KB/s（0=不限）")
+    ap.add_argument("--stall-every", type=int, default=0, help="每 N 張票暫停一次")
+    ap.add_argument("--stall-secs", type=float, default=3.0)
+    ap.add_argument("--reset-every", type=int, default=0, help="每 N 條連線中途 reset 一次")
+    ap.add_argument("--drop-prob", type=float, default=0.0, help="每條連線中途斷線的機率")
+    ap.add_argument("--paper-out-after", type=int, default=0, help="印完第 N 張後缺紙")
+    ap.add_argument("--paper-out-secs", type=float, default=0.0, help="缺紙幾秒後自動補紙（0=不補）")
+    ap.add_argument("--seed", type=int)
+    args = ap.parse_args()
+
+    fp = FakePrinter(args.host, args.port, args.out_dir or None, args.rate,
+                     args.stall_every, args.stall_secs, args.reset_every, args.drop_prob,
+                     args.seed, paper_out_after=args.paper_out_after,
+                     paper_out_secs=args.paper_out_secs).start()
+    print(f"[假印表機] 監聽 {fp.address[0]}:{fp.address[1]}", flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    fp.stop()
+    print("[假印表機] 統計", fp.summary())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+列印路徑壓力測試
+
+對假印表機（tools/fake_printer.py）連續送出一批票，量測端到端吞吐量。
+走正式出單路徑 app.print_batch：RENDERER 子行程平行合成、ESC/POS 編碼（bands / NV）、
+每台印表機一條連線連續印完，每批最多 --batch 張（預設 BATCH_MAX）。
+預設在本行程內啟動假印表機與 QR stub；也可用 --host/--port 打外部的假印表機。
+
+用法：
+    python tools/print_load.py -n 20                 # 20 張票，各 1 份
+    python tools/print_load.py -n 10 --copies 2 --rate 40 --drop-prob 0.2
+    python tools/print_load.py -n 30 --printers 2    # 本機起 2 台假印表機，看分派
+"""
+import argparse, os, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_ticket import percentile, start_qr_stub, use_printers
+from fake_printer import FakePrinter
+
+
+def main():
+    ap = argparse.ArgumentParser(description="列印路徑壓力測試")
+    ap.add_argument("-n", "--tickets", type=int, default=20)
+    ap.add_argument("--copies", type=int, default=1)
+    ap.add_argument("--batch", type=int, default=0, help="每批張數（0=app.BATCH_MAX）")
+    ap.add_argument("--host", help="外部假印表機位址（不給就在本行程啟動）")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--printers", type=int, default=1, help="本機假印表機台數")
+    ap.add_argument("--rate", type=float, default=0.0, help="本機假印表機 KB/s 上限")
+    ap.add_argument("--drop-prob", type=float, default=0.0)
+    ap.add_argument("--reset-every", type=int, default=0)
+    ap.add_argument("--confirm-delay", type=float, default=0.0,
+                    help="送完後等幾秒再查狀態（正式環境為 PRINT_CONFIRM_DELAY）")
+    args = ap.parse_args()
+
+    qr = start_qr_stub()
+    fakes = []
+    if args.host:
+        addresses = [(args.host, args.port)]
+    else:
+        fakes = [FakePrinter("127.0.0.1", 0, None, args.rate, reset_every=args.reset_every,
+                             drop_prob=args.drop_prob, seed=i + 1, verbose=False).start()
+                 for i in range(args.printers)]
+        addresses = [fp.address for fp in fakes]
+    os.environ["QR_API_URL"] = f"http://127.0.0.1:{qr.server_address[1]}/"
+
+    import app
+    app.create_app(start_services=False, warmup=False)   # 只建後端與資料夾，不啟動背景服務
+    use_printers(app, addresses)
+    app.PRINT_CONFIRM_DELAY = args.confirm_delay
+    app.RENDERER.start()
+    batch = args.batch or app.BATCH_MAX
+
+    jobs = [{"number": 900 + i, "waiting": args.tickets - i, "count": args.copies}
+            for i in range(args.tickets)]
+    latencies, left, unconfirmed = [], 0, 0
+    t_start = time.perf_counter()
+    for i in range(0, len(jobs), batch):
+        t0 = time.perf_counter()
+        out = app.print_batch(jobs[i:i + batch])
+        latencies.append((time.perf_counter() - t0) * 1000)
+        left += sum(l for _, l, printer in out.values() if printer is None)
+        unconfirmed += sum(1 for _, _, printer in out.values() if printer)
+    elapsed = time.perf_counter() - t_start
+
+    latencies.sort()
+    sent = args.tickets * args.copies - left
+    print(f"[壓測] {args.tickets} 張票 x{args.copies} 份（每批 {batch} 張），耗時 {elapsed:.2f}s，"
+          f"沒印出 {left} 份，未確認 {unconfirmed} 張")
+    print(f"[壓測] 吞吐量 {sent / elapsed * 60:.1f} 份/分鐘，每批 p50 {percentile(latencies, 50):.1f} ms "
+          f"p95 {percentile(latencies, 95):.1f} ms")
+    for fp in fakes:
+        time.sleep(0.2)
+        print(f"[假印表機 {fp.address[1]}] 統計", fp.summary())
+        fp.stop()
+    qr.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+上游叫號伺服器模擬器
+
+重播錄下來或合成的 {current, waiting} 流量，取代 get_server_url() 的
+Cloud Run /status，用來壓測去重、列印排隊與語音生成。
+
+軌跡檔為 JSONL，每行一個快照：
+    {"t": 12.5, "current": 7, "waiting": [8, 9, 10], "latency_ms": 0, "status": 200}
+t 是距開始的秒數；latency_ms / status 可省略（模擬延遲尖峰與上游故障）。
+
+用法：
+    python tools/upstream_sim.py generate --scenario mixed --duration 900 -o rush.jsonl
+    python tools/upstream_sim.py serve rush.jsonl --speed 5 --port 8081
+    python tools/upstream_sim.py record --url https://.../status -o real.jsonl
+
+serve 起來後把 server_url.txt 設成 http://127.0.0.1:8081/status 即可。
+"""
+import argparse, json, random, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCENARIOS = ("steady", "rush", "reset", "out_of_order", "spike", "outage", "mixed")
+
+
+# ---------------- 軌跡 ----------------
+def load_trace(path):
+    frames = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                frames.append(json.loads(line))
+    frames.sort(key=lambda fr: fr.get("t", 0))
+    if not frames:
+        raise SystemExit(f"[模擬器] 軌跡檔是空的: {path}")
+    return frames
+
+
+def save_trace(frames, path):
+    with open(path, "w") as f:
+        for fr in frames:
+            f.write(json.dumps(fr, ensure_ascii=False) + "\n")
+
+
+def generate(scenario="mixed", duration=600.0, base_rate=1.5, rush_rate=8.0,
+             service_rate=2.0, seed=None):
+    """合成軌跡；rate 單位為每分鐘人數"""
+    rnd = random.Random(seed)
+    rush = scenario in ("rush", "mixed")
+    reset_at = duration / 2 if scenario in ("reset", "mixed") else None
+    shuffle = scenario in ("out_of_order", "mixed")
+    spikes = scenario in ("spike", "mixed")
+    # 上游斷線：中段約 1/5 的時間一律回 503（測離線模式與恢復後對帳）
+    outage = (duration * 0.4, duration * 0.6) if scenario == "outage" else None
+
+    frames, waiting = [], []
+    next_no, current, latency = 1, None, 0
+    t, step = 0.0, 1.0
+
+    def emit():
+        fr = {"t": round(t, 2), "current": current, "waiting": list(waiting), "latency_ms": latency}
+        if outage and outage[0] <= t < outage[1]:
+            fr["status"] = 503
+        frames.append(fr)
+
+    emit()
+    while t < duration:
+        t += step
+        changed = False
+        in_rush = rush and duration * 0.25 <= t < duration * 0.5
+        arrive = (rush_rate if in_rush else base_rate) / 60 * step
+
+        # 號碼歸零（營業換班、清單重置）
+        if reset_at is not None and t >= reset_at:
+            reset_at = None
+            next_no, current, waiting = 1, None, []
+            changed = True
+
+        if rnd.random() < arrive:
+            waiting.append(next_no)
+            next_no += 1
+            changed = True
+
+        if waiting and rnd.random() < service_rate / 60 * step:
+            idx = 0
+            # 亂序叫號：偶爾跳過排在前面的號碼
+            if shuffle and len(waiting) > 2 and rnd.random() < 0.2:
+                idx = rnd.randrange(1, len(waiting))
+            current = waiting.pop(idx)
+            changed = True
+
+        # 延遲尖峰：持續幾秒的慢回應（超過 monitor 的 3s timeout）
+        if spikes:
+            if latency == 0 and rnd.random() < 0.01:
+                latency = rnd.choice((1500, 2500, 4000))
+                changed = True
+            elif latency and rnd.random() < 0.2:
+                latency = 0
+                changed = True
+
+        if outage and (t - step < outage[0] <= t or t - step < outage[1] <= t):
+            changed = True
+
+        if changed:
+            emit()
+    return frames
+
+
+# ---------------- 伺服器 ----------------
+class TraceServer:
+    """照時間重播軌跡的 HTTP 伺服器，可在其他工具裡 import 使用"""
+
+    def __init__(self, frames, host="127.0.0.1", port=8081, speed=1.0, loop=False):
+        self.frames = frames
+        self.speed = speed
+        self.loop = loop
+        self.start_time = time.time()
+        self.requests = 0
+        self.lock = threading.Lock()
+        sim = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                sim._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+
+    def frame_at(self, now=None):
+        elapsed = ((now or time.time()) - self.start_time) * self.speed
+        end = self.frames[-1].get("t", 0)
+        if self.loop and end > 0:
+            elapsed %= end
+        chosen = self.frames[0]
+        for fr in self.frames:
+            if fr.get("t", 0) > elapsed:
+                break
+            chosen = fr
+        return chosen
+
+    def _handle(self, req):
+        with self.lock:
+            self.requests += 1
+        fr = self.frame_at()
+        latency = fr.get("latency_ms", 0)
+        if latency:
+            time.sleep(latency / 1000 / max(self.speed, 1.0))
+        status = fr.get("status", 200)
+        body = json.dumps({"current": fr.get("current"), "waiting": fr.get("waiting", [])}).encode()
+        if status != 200:
+            body = json.dumps({"error": "simulated upstream failure"}).encode()
+        req.send_response(status)
+        req.send_header("Content-Type", "application/json")
+        req.send_header("Content-Length", str(len(body)))
+        req.end_headers()
+        req.wfile.write(body)
+
+    def start(self):
+        self.start_time = time.time()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ---------------- 指令 ----------------
+def cmd_generate(args):
+    frames = generate(args.scenario, args.duration, args.base_rate, args.rush_rate,
+                      args.service_rate, args.seed)
+    save_trace(frames, args.out)
+    print(f"[模擬器] 產生 {len(frames)} 個快照 → {args.out}")
+
+
+def cmd_serve(args):
+    frames = load_trace(args.trace)
+    sim = TraceServer(frames, args.host, args.port, args.speed, args.loop).start()
+    end = frames[-1].get("t", 0) / args.speed
+    print(f"[模擬器] http://{sim.address[0]}:{sim.address[1]}/status "
+          f"{len(frames)} 個快照，約 {end:.0f}s 播完{'（循環）' if args.loop else ''}", flush=True)
+    last = None
+    try:
+        while True:
+            fr = sim.frame_at()
+            if fr is not last:
+                last = fr
+                print(f"[模擬器] t={fr.get('t')} current={fr.get('current')} "
+                      f"waiting={len(fr.get('waiting', []))} latency={fr.get('latency_ms', 0)}ms "
+                      f"status={fr.get('status', 200)}", flush=True)
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+    print(f"[模擬器] 共回應 {sim.requests} 次請求")
+
+
+def cmd_record(args):
+    import requests
+    frames, last = [], None
+    start = time.time()
+    print(f"[錄製] {args.url} → {args.out}（Ctrl-C 結束）", flush=True)
+    try:
+        while not args.duration or time.time() - start < args.duration:
+            t0 = time.time()
+            try:
+                r = requests.get(args.url, timeout=args.timeout)
+                latency = int((time.time() - t0) * 1000)
+                data = r.json() if r.ok else {}
+                fr = {"t": round(t0 - start, 2), "current": data.get("current"),
+                      "waiting": data.get("waiting", []) or [], "latency_ms": latency}
+                if not r.ok:
+                    fr["status"] = r.status_code
+            except Exception as e:
+                fr = {"t": round(t0 - start, 2), "current": None, "waiting": [],
+                      "latency_ms": int((time.time() - t0) * 1000), "status": 503}
+                print("[錄製錯誤]", e, flush=True)
+            # 只在狀態改變或延遲明顯變化時落檔
+            key = (fr["current"], tuple(fr["waiting"]), fr.get("status", 200), fr["latency_ms"] // 500)
+            if key != last:
+                last = key
+                frames.append(fr)
+                with open(args.out, "a") as f:
+                    f.write(json.dumps(fr, ensure_ascii=False) + "\n")
+            time.sleep(max(0.0, args.interval - (time.time() - t0)))
+    except KeyboardInterrupt:
+        pass
+    print(f"[錄製] 共 {len(frames)} 個快照")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="上游叫號伺服器模擬器")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    g = sub.add_parser("generate", help="產生合成軌跡")
+    g.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    g.add_argument("--duration", type=float, default=600, help="秒")
+    g.add_argument("--base-rate", type=float, default=1.5, help="平時每分鐘來客")
+    g.add_argument("--rush-rate", type=float, default=8.0, help="尖峰每分鐘來客")
+    g.add_argument("--service-rate", type=float, default=2.0, help="每分鐘叫號")
+    g.add_argument("--seed", type=int)
+    g.add_argument("-o", "--out", required=True)
+    g.set_defaults(func=cmd_generate)
+
+    s = sub.add_parser("serve", help="重播軌跡")
+    s.add_argument("trace")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=8081)
+    s.add_argument("--speed", type=float, default=1.0, help="播放倍速")
+    s.add_argument("--loop", action="store_true")
+    s.set_defaults(func=cmd_serve)
+
+    r = sub.add_parser("record", help="錄製真實上游")
+    r.add_argument("--url", required=True)
+    r.add_argument("--interval", type=float, default=2.0)
+    r.add_argument("--timeout", type=float, default=5.0)
+    r.add_argument("--duration", type=float, default=0, help="秒（0=直到 Ctrl-C）")
+    r.add_argument("-o", "--out", required=True)
+    r.set_defaults(func=cmd_record)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())